@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""sweep chunk size of a sending connection: fixed sizes vs auto tuning
+
+file data is read in python, not by os.sendfile, and sent over a TCP
+connection on loopback, receiver reads it into a buffer of BUFFER size.
+
+    python3 benchmark/bench_chunk.py [--size 1G] [--mode dukto] [--chunk-size 16K 64K 256K 1M 4M]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.dukto import DuktoPacket  # noqa: E402
+from ndrop.nitroshare import Packet  # noqa: E402
+from ndrop.stats import TransferStats  # noqa: E402
+from ndrop.transport import ChunkTuner, send_chunks, set_socket_buffer_size, set_socket_buffer, \
+    parse_size, human_size  # noqa: E402
+
+
+class Agent(object):
+    def send_feed_file(self, *args):
+        pass
+
+    def send_finish_file(self, name):
+        pass
+
+
+def drain(sock, buffer_size):
+    buff = bytearray(buffer_size)
+    while sock.recv_into(buff):
+        pass
+    sock.close()
+
+
+def run(path, mode, size, auto, buffer_size):
+    file_size = os.path.getsize(path)
+    server = socket.socket()
+    set_socket_buffer(server, socket.SO_RCVBUF)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    sock = socket.socket()
+    set_socket_buffer(sock, socket.SO_SNDBUF)
+    sock.connect(server.getsockname())
+    peer, _ = server.accept()
+    server.close()
+    t = threading.Thread(target=drain, args=(peer, buffer_size))
+    t.start()
+    stats = TransferStats('send')
+    tuner = ChunkTuner(sock, size=size, auto=auto)
+    first = tuner.size
+    packet = DuktoPacket() if mode == 'dukto' else Packet()
+    start = time.perf_counter()
+    send_chunks(sock, packet.pack_files(
+        Agent(), file_size, [(path, os.path.basename(path), file_size)], stats=stats, tuner=tuner), stats, tuner)
+    sock.shutdown(socket.SHUT_WR)
+    t.join()
+    elapsed = time.perf_counter() - start
+    sock.close()
+    record = stats.as_dict()
+    calls = sum(record['calls'].values())
+    name = 'auto %s' % human_size(first) if auto else human_size(first)
+    print('%-10s %-12s %10s/s  chunk %8s  calls %7d  socket %.2fs' % (
+        mode, name, human_size(file_size / elapsed), human_size(tuner.size), calls,
+        record['stages'].get('socket', 0.0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], nargs='+', default=['dukto', 'nitroshare'])
+    parser.add_argument('--chunk-size', type=parse_size, nargs='+',
+                        default=[parse_size(s) for s in ['16K', '64K', '256K', '1M', '4M']])
+    parser.add_argument('--buffer-size', type=parse_size, default=parse_size('256K'))
+    parser.add_argument('--socket-buffer', type=parse_size, default=0)
+    args = parser.parse_args()
+    set_socket_buffer_size(args.socket_buffer)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        with open(path, 'wb') as f:
+            data = os.urandom(1024 * 1024)
+            for _ in range(args.size // len(data)):
+                f.write(data)
+        for mode in args.mode:
+            for size in args.chunk_size:
+                run(path, mode, size, False, args.buffer_size)
+            run(path, mode, min(args.chunk_size), True, args.buffer_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""loopback transfer of log-like text and random data with --compress none, zlib, zstd
+
+wire is bytes sent on the connection, time of a link of --link speed is
+estimated from it and CPU time of both ends on loopback.
+
+    python3 benchmark/bench_compress.py [--text 64M] [--random 64M] [--link 100M]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.compress import CODECS  # noqa: E402
+from ndrop.transport import parse_size, human_size  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+def make_text(path, size):
+    words = ['GET', 'POST', '/api/v1/items', '200', '404', 'user=%d', 'latency=%dms', 'INFO', 'WARN']
+    with open(path, 'w') as f:
+        while f.tell() < size:
+            f.write('2024-01-01 12:%02d:%02d %s\n' % (
+                random.randint(0, 59), random.randint(0, 59),
+                ' '.join(w % random.randint(0, 9999) if '%' in w else w for w in random.sample(words, 5))))
+
+
+def transfer(path, saved_dir, port, codec, args):
+    server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=args.mode, hash_algorithm='none')
+    server.saved_to(saved_dir)
+    threading.Thread(target=server.wait_for_request, daemon=True).start()
+    time.sleep(0.2)
+    client = Client('127.0.0.1:%d' % port, mode=args.mode, hash_algorithm='none', compress=codec)
+    start = time.perf_counter()
+    client.send_files([path])
+    elapsed = time.perf_counter() - start
+    for transport in server._transport:
+        transport.quit_request()
+    return elapsed, client.transfer_stats[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--text', type=parse_size, default=parse_size('64M'))
+    parser.add_argument('--random', type=parse_size, default=parse_size('64M'))
+    parser.add_argument('--link', type=parse_size, default=parse_size('100M'), help='bytes per second')
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='nitroshare')
+    parser.add_argument('--port', type=int, default=24942)
+    args = parser.parse_args()
+
+    print('cpu: %s, codecs: %s' % (os.cpu_count(), ', '.join(CODECS)))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data')
+        os.makedirs(path)
+        make_text(os.path.join(path, 'access.log'), args.text)
+        with open(os.path.join(path, 'media.bin'), 'wb') as f:
+            f.write(os.urandom(args.random))
+        for i, codec in enumerate([None] + CODECS):
+            saved_dir = os.path.join(tmp, 'saved%d' % i)
+            os.makedirs(saved_dir)
+            elapsed, record = transfer(path, saved_dir, args.port + i * 2, codec, args)
+            ratio = record['compress']['ratio'] if record['compress'] else 1.0
+            print('%-5s wire %10s  ratio %5.2f  loopback %6.2fs  link %6.2fs' % (
+                codec or 'none', human_size(record['bytes']), ratio, elapsed,
+                max(elapsed, record['bytes'] / args.link)))
+
+
+if __name__ == '__main__':
+    main()
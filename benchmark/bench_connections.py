@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""loopback transfer of a tree of many files by 1, 2, 4... connections
+
+receiver runs in its own process. NitroShare is used by default, its sender
+waits for the receiver to finish every transfer.
+
+    python3 benchmark/bench_connections.py [--files 5000] [--file-size 16K] [--connections 1 2 4 8]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.transport import parse_size, human_size  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+def make_tree(root, files, file_size):
+    data = os.urandom(file_size)
+    for i in range(files):
+        path = os.path.join(root, 'd%d' % (i // 100))
+        if i % 100 == 0:
+            os.makedirs(path)
+        with open(os.path.join(path, 'f%d' % i), 'wb') as f:
+            f.write(data)
+
+
+def serve(port, saved_dir, mode):
+    server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=mode, hash_algorithm='none')
+    server.saved_to(saved_dir)
+    server.wait_for_request()
+
+
+def transfer(path, saved_dir, port, connections, args):
+    server = multiprocessing.Process(target=serve, args=(port, saved_dir, args.mode), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    client = Client('127.0.0.1:%d' % port, mode=args.mode, hash_algorithm='none', connections=connections)
+    start = time.perf_counter()
+    client.send_files([path])
+    elapsed = time.perf_counter() - start
+    server.terminate()
+    server.join()
+    shutil.rmtree(os.path.join(saved_dir, os.path.basename(path)))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=5000)
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('16K'))
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='nitroshare')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--port', type=int, default=24642)
+    args = parser.parse_args()
+
+    print('cpu: %s' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tree')
+        make_tree(path, args.files, args.file_size)
+        saved_dir = os.path.join(tmp, 'saved')
+        os.makedirs(saved_dir)
+        for i, connections in enumerate(args.connections):
+            elapsed = transfer(path, saved_dir, args.port + i * 2, connections, args)
+            print('connections %-3d %8.0f files/s %10s/s' % (
+                connections, args.files / elapsed, human_size(args.files * args.file_size / elapsed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""loopback transfer of a mutated image to a receiver which has the old one, full vs --delta
+
+CHANGES random ranges of CHANGE_SIZE are rewritten in place, and INSERTS short
+runs of bytes are inserted, which move the data behind them.
+
+    python3 benchmark/bench_delta.py [--size 256M] [--changes 16] [--change-size 64K] [--inserts 2]
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.transport import CHUNK_SIZE, parse_size, human_size  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+def mutate(src, dst, args):
+    with open(src, 'rb') as f:
+        data = bytearray(f.read())
+    for _ in range(args.changes):
+        pos = random.randrange(len(data) - args.change_size)
+        data[pos:pos + args.change_size] = os.urandom(args.change_size)
+    for _ in range(args.inserts):
+        pos = random.randrange(len(data))
+        data[pos:pos] = os.urandom(random.randint(1, 100))
+    with open(dst, 'wb') as f:
+        f.write(data)
+
+
+def transfer(path, saved_dir, port, delta, args):
+    server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=args.mode, hash_algorithm='none')
+    server.saved_to(saved_dir)
+    threading.Thread(target=server.wait_for_request, daemon=True).start()
+    time.sleep(0.2)
+    client = Client('127.0.0.1:%d' % port, mode=args.mode, hash_algorithm='none', delta=delta)
+    start = time.perf_counter()
+    client.send_files([path])
+    elapsed = time.perf_counter() - start
+    for transport in server._transport:
+        transport.quit_request()
+    return elapsed, client.transfer_stats[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('256M'))
+    parser.add_argument('--changes', type=int, default=16)
+    parser.add_argument('--change-size', type=parse_size, default=parse_size('64K'))
+    parser.add_argument('--inserts', type=int, default=2)
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='nitroshare')
+    parser.add_argument('--port', type=int, default=25042)
+    args = parser.parse_args()
+
+    print('cpu: %s' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as tmp:
+        old = os.path.join(tmp, 'old.img')
+        with open(old, 'wb') as f:
+            while f.tell() < args.size:
+                f.write(os.urandom(min(CHUNK_SIZE * 16, args.size - f.tell())))
+        path = os.path.join(tmp, 'vm.img')
+        mutate(old, path, args)
+        size = os.path.getsize(path)
+        for i, delta in enumerate([False, True]):
+            saved_dir = os.path.join(tmp, 'saved%d' % i)
+            os.makedirs(saved_dir)
+            shutil.copy(old, os.path.join(saved_dir, 'vm.img'))
+            elapsed, record = transfer(path, saved_dir, args.port + i * 2, delta, args)
+            print('%-6s %10s of %10s on wire %6.2f%%  %6.2fs' % (
+                'delta' if delta else 'full', human_size(record['bytes']), human_size(size),
+                record['bytes'] * 100.0 / size, elapsed))
+
+
+if __name__ == '__main__':
+    main()
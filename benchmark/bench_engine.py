@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""loopback load of many concurrent senders, thread engine vs asyncio engine of receiver
+
+a receiver runs as "ndrop --listen" in a process of its own, for each
+--engine. PEERS connections send at the same time, every one sends ROUNDS
+transfers of FILES small files one after another. they come from one
+asyncio loop of this process, the same for both engines. threads and peak
+memory of receiver are read from /proc (linux). every session of receiver
+has a disk writer thread of its own, unless --write-queue is 0.
+
+    python3 benchmark/bench_engine.py [--peers 200] [--rounds 5] [--files 4] [--file-size 16K] [--write-queue 16]
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.aio import AsyncDuktoClient, AsyncNitroshareClient, ENGINES  # noqa: E402
+from ndrop.scan import scan_files  # noqa: E402
+from ndrop.netdrop import WRITE_QUEUE  # noqa: E402
+from ndrop.transport import parse_size, human_size  # noqa: E402
+
+
+class Sender(object):
+    """upper level of one connection, keeps result of last transfer"""
+    result = None
+
+    def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        pass
+
+    def send_finish_file(self, path):
+        pass
+
+    def send_same_file(self, path, file_size):
+        pass
+
+    def send_finish(self, err):
+        self.result = err
+
+
+def proc_status(pid):
+    """{field: value} of /proc/PID/status, empty if there is none"""
+    status = {}
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                status[key] = value.strip()
+    except OSError:
+        pass
+    return status
+
+
+class Monitor(threading.Thread):
+    """peak thread count of process, sampled while load runs"""
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.threads = 0
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            threads = proc_status(self.pid).get('Threads')
+            if threads:
+                self.threads = max(self.threads, int(threads))
+            time.sleep(0.01)
+
+
+async def load(client_class, addr, total_size, files, peers, rounds):
+    """return (transfers done, failed)"""
+    results = []
+
+    async def peer():
+        sender = Sender()
+        transport = client_class(sender, addr)
+        for _ in range(rounds):
+            await transport.send_files_async(total_size, files)
+            results.append('%s' % sender.result == 'done')
+
+    await asyncio.gather(*[peer() for _ in range(peers)])
+    return results.count(True), results.count(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--peers', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('16K'))
+    parser.add_argument('--write-queue', type=int, default=WRITE_QUEUE)
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='dukto')
+    parser.add_argument('--port', type=int, default=25262)
+    args = parser.parse_args()
+
+    # failed transfers are counted
+    logging.getLogger('ndrop').setLevel(logging.CRITICAL)
+    print('cpu: %s' % os.cpu_count())
+    client_class = AsyncDuktoClient if args.mode == 'dukto' else AsyncNitroshareClient
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'src')
+        os.makedirs(src)
+        for i in range(args.files):
+            with open(os.path.join(src, 'f%d.bin' % i), 'wb') as f:
+                f.write(os.urandom(args.file_size))
+        total_size, files = scan_files([os.path.join(src, name) for name in sorted(os.listdir(src))])
+        for i, engine in enumerate(ENGINES):
+            port = args.port + i * 2
+            saved_dir = os.path.join(tmp, 'saved-%s' % engine)
+            os.makedirs(saved_dir)
+            server = subprocess.Popen([
+                sys.executable, '-m', 'ndrop', '--listen', '127.0.0.1:%d:%d' % (port, port + 1),
+                '--mode', args.mode, '--engine', engine, '--max-sessions', '0', '--hash', 'none',
+                '--write-queue', '%d' % args.write_queue, saved_dir,
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                time.sleep(1.5)
+                monitor = Monitor(server.pid)
+                monitor.start()
+                start = time.perf_counter()
+                done, failed = asyncio.run(load(
+                    client_class, '127.0.0.1:%d' % port, total_size, files, args.peers, args.rounds))
+                seconds = time.perf_counter() - start
+                monitor.stopped = True
+                monitor.join()
+                memory = proc_status(server.pid).get('VmHWM', '?')
+                print('%-8s %d peers x %d transfers of %d x %s: %6.2fs, %7.1f transfers/s, %s/s,'
+                      ' failed %d, threads %d, peak memory %s' % (
+                          engine, args.peers, args.rounds, args.files, human_size(args.file_size),
+                          seconds, done / seconds, human_size(done * total_size / seconds),
+                          failed, monitor.threads, memory))
+            finally:
+                server.send_signal(signal.SIGINT)
+                try:
+                    server.wait(5)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+                shutil.rmtree(saved_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""loopback transfer of the same files to N receivers, one by one vs NetDropFanOut
+
+every receiver runs in its own process. read is bytes read by the sender
+process, rchar of /proc/self/io, the files are read N times one by one and
+once by fan-out. one by one doesn't use sendfile, whose reads aren't counted.
+
+    python3 benchmark/bench_fanout.py [--size 256M] [--files 4] [--receivers 4]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.netdrop import NetDropFanOut  # noqa: E402
+from ndrop.transport import CHUNK_SIZE, parse_size, human_size  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+class FanOut(NetDropFanOut):
+    def write(self, message):
+        pass
+
+
+def read_chars():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def serve(port, saved_dir, mode):
+    server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=mode, hash_algorithm='none')
+    server.saved_to(saved_dir)
+    server.wait_for_request()
+
+
+def run(name, send):
+    rchar = read_chars()
+    start = time.perf_counter()
+    send()
+    elapsed = time.perf_counter() - start
+    read = '-' if rchar is None else human_size(read_chars() - rchar)
+    print('%-12s %8.2fs  read %10s' % (name, elapsed, read))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('256M'))
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--receivers', type=int, default=4)
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='nitroshare')
+    parser.add_argument('--port', type=int, default=24742)
+    args = parser.parse_args()
+
+    print('cpu: %s' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tree')
+        os.makedirs(path)
+        data = os.urandom(CHUNK_SIZE * 16)
+        for i in range(args.files):
+            with open(os.path.join(path, 'f%d.bin' % i), 'wb') as f:
+                for _ in range(args.size // args.files // len(data)):
+                    f.write(data)
+        saved_dirs = []
+        servers = []
+        for i in range(args.receivers):
+            saved_dir = os.path.join(tmp, 'saved%d' % i)
+            os.makedirs(saved_dir)
+            saved_dirs.append(saved_dir)
+            server = multiprocessing.Process(
+                target=serve, args=(args.port + i * 2, saved_dir, args.mode), daemon=True)
+            server.start()
+            servers.append(server)
+        time.sleep(0.5)
+
+        def clients(**kwargs):
+            return [Client('127.0.0.1:%d' % (args.port + i * 2), mode=args.mode, **kwargs)
+                    for i in range(args.receivers)]
+
+        def cleanup():
+            for saved_dir in saved_dirs:
+                shutil.rmtree(os.path.join(saved_dir, 'tree'), ignore_errors=True)
+
+        def one_by_one():
+            for client in clients(hash_algorithm='none', sendfile=False):
+                client.send_files([path])
+
+        def fanout():
+            FanOut(clients(hash_algorithm='none', read_ahead=0), hash_algorithm='none').send_files([path])
+
+        run('one by one', one_by_one)
+        cleanup()
+        run('fan-out', fanout)
+        for server in servers:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""throughput of file hash: hashlib only, and loopback transfer hashed on both sides
+
+    python3 benchmark/bench_hash.py [--size 1G] [--mode dukto]
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.pipeline import HASH_ALGORITHMS  # noqa: E402
+from ndrop.transport import CHUNK_SIZE, parse_size, human_size  # noqa: E402
+from _agents import Server as AgentServer, Client  # noqa: E402
+
+
+class Server(AgentServer):
+    def __init__(self, *args, **kwargs):
+        self.finished = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def recv_finish(self, from_addr, err):
+        super().recv_finish(from_addr, err)
+        self.finished.set()
+
+
+def hash_only(algorithm, total):
+    data = os.urandom(CHUNK_SIZE)
+    start = time.perf_counter()
+    h = hashlib.new(algorithm)
+    for _ in range(total // CHUNK_SIZE):
+        h.update(data)
+    return time.perf_counter() - start
+
+
+def transfer(algorithm, path, saved_dir, mode, port):
+    server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=mode, hash_algorithm=algorithm)
+    server.saved_to(saved_dir)
+    threading.Thread(target=server.wait_for_request, daemon=True).start()
+    time.sleep(0.2)
+    client = Client('127.0.0.1:%d' % port, mode=mode, hash_algorithm=algorithm)
+    start = time.perf_counter()
+    client.send_files([path])
+    server.finished.wait()
+    elapsed = time.perf_counter() - start
+    for transport in server._transport:
+        transport.quit_request()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='dukto')
+    parser.add_argument('--port', type=int, default=24242)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        with open(path, 'wb') as f:
+            data = os.urandom(CHUNK_SIZE * 16)
+            for _ in range(args.size // len(data)):
+                f.write(data)
+        size = os.path.getsize(path)
+        saved_dir = os.path.join(tmp, 'saved')
+        os.makedirs(saved_dir)
+
+        print('%-8s %14s %14s' % ('hash', 'hashlib', 'transfer'))
+        for i, algorithm in enumerate(HASH_ALGORITHMS):
+            if algorithm == 'none':
+                hashed = '-'
+            else:
+                hashed = '%s/s' % human_size(size / hash_only(algorithm, size))
+            elapsed = transfer(algorithm, path, saved_dir, args.mode, args.port + i * 2)
+            os.remove(os.path.join(saved_dir, 'data.bin'))
+            print('%-8s %14s %14s' % (algorithm, hashed, '%s/s' % human_size(size / elapsed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""loopback latency of many small sends over TLS, full handshake vs resumed session
+
+every send is a connection of its own, as a text or a small file dropped
+to the same peer again and again. a self-signed cert is made by openssl.
+
+    python3 benchmark/bench_latency.py [--count 200] [--file-size 1K]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.transport import parse_size, tls_sessions  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+def make_cert(tmp):
+    cert = os.path.join(tmp, 'cert.pem')
+    key = os.path.join(tmp, 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=ndrop',
+        '-out', cert, '-keyout', key, '-days', '1'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def measure(send, count):
+    """return median and mean seconds of one send"""
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        send(i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], sum(times) / len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('1K'))
+    parser.add_argument('--port', type=int, default=25242)
+    args = parser.parse_args()
+
+    logging.getLogger('ndrop').setLevel(logging.WARNING)
+    print('cpu: %s' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as tmp:
+        ssl_ck = make_cert(tmp)
+        path = os.path.join(tmp, 'small.txt')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(args.file_size))
+        saved_dir = os.path.join(tmp, 'saved')
+        servers = []
+        for i, mode in enumerate(['dukto', 'nitroshare']):
+            port = args.port + i * 2
+            server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=mode, ssl_ck=ssl_ck, hash_algorithm='none')
+            server.saved_to(saved_dir)
+            threading.Thread(target=server.wait_for_request, daemon=True).start()
+            servers.append((mode, port, server))
+        time.sleep(0.2)
+        for name, idle in [('full handshake', 0), ('resumed session', 300)]:
+            tls_sessions.idle = idle
+            tls_sessions.clear()
+            for mode, port, server in servers:
+                client = Client('127.0.0.1:%d' % port, mode=mode, ssl_ck=ssl_ck, hash_algorithm='none')
+                client._list_files = False
+                if mode == 'dukto':
+                    what = 'text'
+                    median, mean = measure(lambda i: client.send_text('message %d' % i), args.count)
+                else:
+                    what = 'file'
+                    median, mean = measure(lambda i: client.send_files([path]), args.count)
+                print('%-16s %-10s %s x %d: median %6.2fms, mean %6.2fms' % (
+                    name, mode, what, args.count, median * 1000, mean * 1000))
+        for mode, port, server in servers:
+            for transport in server._transport:
+                transport.quit_request()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""compare sender framing: bytearray + slicing copies vs list of buffers by sendmsg
+
+both are sent by send_chunks, sender CPU time is measured on sender thread,
+receiver only drains socket.
+
+    python3 benchmark/bench_pack.py [--size 1G]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.dukto import DuktoPacket  # noqa: E402
+from ndrop.transport import send_chunks, CHUNK_SIZE, parse_size, human_size  # noqa: E402
+
+
+class Agent(object):
+    def send_feed_file(self, *args):
+        pass
+
+    def send_finish_file(self, name):
+        pass
+
+
+def drain(sock):
+    buff = bytearray(CHUNK_SIZE * 4)
+    while sock.recv_into(buff):
+        pass
+    sock.close()
+
+
+def pack_slicing(path, size):
+    """old dukto framing: copy header and data into bytearray, yield slices"""
+    data = bytearray()
+    data.extend((1).to_bytes(8, byteorder='little', signed=True))
+    data.extend(size.to_bytes(8, byteorder='little', signed=True))
+    data.extend(os.path.basename(path).encode('utf-8'))
+    data.append(0)
+    data.extend(size.to_bytes(8, byteorder='little', signed=True))
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE - len(data))
+            if not chunk:
+                break
+            data.extend(chunk)
+            if len(data) >= CHUNK_SIZE:
+                yield data[:CHUNK_SIZE]
+                del data[:CHUNK_SIZE]
+    if data:
+        yield data
+
+
+def send_slicing(sock, path, size):
+    send_chunks(sock, pack_slicing(path, size))
+
+
+def send_vectored(sock, path, size):
+    packet = DuktoPacket()
+    files = [(path, os.path.basename(path), size)]
+    send_chunks(sock, [packet.pack_files_header(1, size)])
+    send_chunks(sock, packet.pack_files(Agent(), size, files))
+
+
+def run(sender, path, size):
+    a, b = socket.socketpair()
+    t = threading.Thread(target=drain, args=(b,))
+    t.start()
+    start = time.perf_counter()
+    cpu = time.thread_time()
+    sender(a, path, size)
+    cpu = time.thread_time() - cpu
+    a.shutdown(socket.SHUT_WR)
+    t.join()
+    elapsed = time.perf_counter() - start
+    a.close()
+    print('%-14s %10s/s  sender cpu %.2fs/GB' % (
+        sender.__name__, human_size(size / elapsed), cpu * (1 << 30) / size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        with open(path, 'wb') as f:
+            data = os.urandom(CHUNK_SIZE * 16)
+            for _ in range(args.size // len(data)):
+                f.write(data)
+        size = os.path.getsize(path)
+        for sender in (send_slicing, send_vectored):
+            run(sender, path, size)
+
+
+if __name__ == '__main__':
+    main()
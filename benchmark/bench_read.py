@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""compare sender file reading: in sending thread vs ReadAhead thread
+
+file is dropped from page cache before every run, receiver sleeps DELAY
+after every buffer to act as a slow network.
+
+    python3 benchmark/bench_read.py [--size 1G] [--delay 0.0002] [--file PATH]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.dukto import DuktoPacket  # noqa: E402
+from ndrop.stats import TransferStats  # noqa: E402
+from ndrop.transport import send_chunks, CHUNK_SIZE, parse_size, human_size  # noqa: E402
+
+
+class Agent(object):
+    def send_feed_file(self, *args):
+        pass
+
+    def send_finish_file(self, name):
+        pass
+
+
+def drain(sock, delay):
+    buff = bytearray(CHUNK_SIZE)
+    while sock.recv_into(buff):
+        if delay:
+            time.sleep(delay)
+    sock.close()
+
+
+def drop_cache(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def run(path, read_ahead, delay):
+    size = os.path.getsize(path)
+    drop_cache(path)
+    stats = TransferStats('send')
+    packet = DuktoPacket()
+    a, b = socket.socketpair()
+    t = threading.Thread(target=drain, args=(b, delay))
+    t.start()
+    start = time.perf_counter()
+    send_chunks(a, packet.pack_files(
+        Agent(), size, [(path, os.path.basename(path), size)], stats=stats, read_ahead=read_ahead), stats)
+    a.shutdown(socket.SHUT_WR)
+    t.join()
+    elapsed = time.perf_counter() - start
+    a.close()
+    record = stats.as_dict()
+    print('read_ahead %-3d %10s/s  read %.2fs  stall %.2fs  socket %.2fs' % (
+        read_ahead, human_size(size / elapsed),
+        record['stages'].get('read', 0.0), record['stall'], record['stages'].get('socket', 0.0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    parser.add_argument('--delay', type=float, default=0.0002)
+    parser.add_argument('--file', help='existing file, such as on NFS or spinning disk')
+    parser.add_argument('--read-ahead', type=int, nargs='+', default=[0, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = os.path.join(tmp, 'data.bin')
+            with open(path, 'wb') as f:
+                data = os.urandom(CHUNK_SIZE * 16)
+                for _ in range(args.size // len(data)):
+                    f.write(data)
+        for read_ahead in args.read_ahead:
+            run(path, read_ahead, args.delay)
+
+
+if __name__ == '__main__':
+    main()
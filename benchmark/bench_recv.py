@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""compare socket reader: recv() + bytearray vs recv_into() pooled buffer
+
+    python3 benchmark/bench_recv.py [--size 1G] [--buffer-size 256K]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.transport import StreamBuffer, CHUNK_SIZE, parse_size, human_size  # noqa: E402
+
+
+def sender(sock, total):
+    data = b'\x00' * CHUNK_SIZE
+    view = memoryview(data)
+    while total > 0:
+        n = min(total, len(data))
+        sock.sendall(view[:n])
+        total -= n
+    sock.close()
+
+
+def recv_extend(sock, buffer_size):
+    """old reader: allocate bytes every recv, copy into growing bytearray"""
+    buff = bytearray()
+    received = 0
+    while True:
+        data = sock.recv(CHUNK_SIZE)
+        if not data:
+            break
+        buff.extend(data)
+        received += len(buff[:len(buff)])
+        del buff[:len(buff)]
+    return received
+
+
+def recv_into(sock, buffer_size):
+    """new reader: recv_into preallocated buffer, consume through cursor"""
+    buff = StreamBuffer(buffer_size)
+    received = 0
+    while buff.recv_into(sock):
+        received += len(buff.read(len(buff)))
+    return received
+
+
+def run(reader, total, buffer_size):
+    a, b = socket.socketpair()
+    t = threading.Thread(target=sender, args=(a, total))
+    tracemalloc.start()
+    start = time.perf_counter()
+    t.start()
+    received = reader(b, buffer_size)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    t.join()
+    b.close()
+    assert received == total, (received, total)
+    print('%-12s %10s/s  peak alloc %10s' % (
+        reader.__name__, human_size(total / elapsed), human_size(peak)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    parser.add_argument('--buffer-size', type=parse_size, default=CHUNK_SIZE * 4)
+    args = parser.parse_args()
+    for reader in (recv_extend, recv_into):
+        run(reader, args.size, args.buffer_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""compare tree scan for send_files: os.walk + getsize + relpath vs scan_files
+
+synthetic tree has DIRS directories of FILES empty files, LEVELS deep.
+memory is what the result keeps, list of tuples vs Manifest.
+
+    python3 benchmark/bench_scan.py [--dirs 2000] [--files 50] [--levels 3] [--path PATH]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.scan import scan_files, SCAN_THREADS  # noqa: E402
+from ndrop.transport import human_size  # noqa: E402
+
+
+def walk_files(paths):
+    """old scanner of NetDropClient.send_files"""
+    all_files = []
+    total_size = 0
+    for f in paths:
+        abs_path = os.path.abspath(f)
+        base_path = os.path.dirname(abs_path)
+        rel_path = os.path.relpath(abs_path, base_path)
+        if os.path.isdir(abs_path):
+            size = -1
+        else:
+            size = os.path.getsize(abs_path)
+            total_size += size
+        all_files.append((abs_path, rel_path, size))
+        if size == -1:
+            for root, dirs, files in os.walk(abs_path):
+                for name in dirs:
+                    sub_abs_path = os.path.join(root, name)
+                    all_files.append((sub_abs_path, os.path.relpath(sub_abs_path, base_path), -1))
+                for name in files:
+                    sub_abs_path = os.path.join(root, name)
+                    size = os.path.getsize(sub_abs_path)
+                    total_size += size
+                    all_files.append((sub_abs_path, os.path.relpath(sub_abs_path, base_path), size))
+    return total_size, all_files
+
+
+def make_tree(root, dirs, files, levels):
+    fanout = max(2, round(dirs ** (1.0 / levels)))
+    made = 0
+    pending = [root]
+    while pending and made < dirs:
+        parent = pending.pop(0)
+        for i in range(fanout):
+            path = os.path.join(parent, 'd%d' % i)
+            os.mkdir(path)
+            for j in range(files):
+                open(os.path.join(path, 'f%d' % j), 'wb').close()
+            pending.append(path)
+            made += 1
+            if made >= dirs:
+                break
+
+
+def run(name, scanner, path):
+    start = time.perf_counter()
+    total_size, files = scanner([path])
+    elapsed = time.perf_counter() - start
+    del files
+    tracemalloc.start()
+    total_size, files = scanner([path])
+    kept, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-16s %8d entries %8.2fs %10.0f entries/s  memory %10s' % (
+        name, len(files), elapsed, len(files) / elapsed, human_size(kept)))
+    return list(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dirs', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=SCAN_THREADS)
+    parser.add_argument('--path', help='existing tree, such as on NFS')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.path
+        if not path:
+            path = os.path.join(tmp, 'tree')
+            os.mkdir(path)
+            make_tree(path, args.dirs, args.files, args.levels)
+        expected = run('os.walk', walk_files, path)
+        for threads in (1, args.threads):
+            files = run('scan_files x%d' % threads, lambda paths: scan_files(paths, threads), path)
+            assert files == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""loopback push of a tree which receiver mostly has, full vs --skip-same
+
+CHANGED files of the tree are rewritten, others are on receiver already. the
+second --skip-same push finds digests of receiver in its index file.
+
+    python3 benchmark/bench_skip.py [--files 2000] [--file-size 128K] [--changed 20]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.transport import parse_size, human_size  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+def make_tree(root, args):
+    for i in range(args.files):
+        sub = os.path.join(root, 'd%02d' % (i % 50))
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, 'f%05d' % i), 'wb') as f:
+            f.write(os.urandom(args.file_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--file-size', type=parse_size, default=parse_size('128K'))
+    parser.add_argument('--changed', type=int, default=20)
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='nitroshare')
+    parser.add_argument('--port', type=int, default=25142)
+    args = parser.parse_args()
+
+    print('cpu: %s' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'tree')
+        make_tree(src, args)
+        size = args.files * args.file_size
+        runs = [('full', False), ('skip cold', True), ('skip warm', True)]
+        for i, (name, skip_same) in enumerate(runs):
+            if i < 2:
+                saved_dir = os.path.join(tmp, 'saved%d' % i)
+                shutil.copytree(src, os.path.join(saved_dir, 'tree'))
+            for n in range(args.changed):
+                with open(os.path.join(src, 'd%02d' % (n % 50), 'f%05d' % n), 'wb') as f:
+                    f.write(os.urandom(args.file_size))
+            port = args.port + i * 2
+            server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=args.mode, hash_algorithm='none')
+            server.saved_to(saved_dir)
+            threading.Thread(target=server.wait_for_request, daemon=True).start()
+            time.sleep(0.2)
+            client = Client('127.0.0.1:%d' % port, mode=args.mode, hash_algorithm='none', skip_same=skip_same)
+            client._list_files = False
+            start = time.perf_counter()
+            client.send_files([src])
+            elapsed = time.perf_counter() - start
+            for transport in server._transport:
+                transport.quit_request()
+            record = client.transfer_stats[-1]
+            print('%-10s %10s of %10s on wire, skipped %10s  %6.2fs' % (
+                name, human_size(record['bytes']), human_size(size), human_size(record['skipped']), elapsed))
+
+
+if __name__ == '__main__':
+    main()
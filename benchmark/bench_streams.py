@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""loopback transfer of one large file by 1, 2, 4... parallel connections
+
+    python3 benchmark/bench_streams.py [--size 1G] [--streams 1 2 4 8] [--no-sendfile] [--cert C --key K]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ndrop.transport import CHUNK_SIZE, parse_size, human_size  # noqa: E402
+from _agents import Server, Client  # noqa: E402
+
+
+def transfer(path, saved_dir, port, streams, args):
+    ssl_ck = (args.cert, args.key) if args.cert else None
+    server = Server('127.0.0.1:%d:%d' % (port, port + 1), mode=args.mode, ssl_ck=ssl_ck, hash_algorithm='none')
+    server.saved_to(saved_dir)
+    threading.Thread(target=server.wait_for_request, daemon=True).start()
+    time.sleep(0.2)
+    client = Client('127.0.0.1:%d' % port, mode=args.mode, ssl_ck=ssl_ck, hash_algorithm='none',
+                    sendfile=not args.no_sendfile, streams=streams)
+    start = time.perf_counter()
+    client.send_files([path])
+    # received when the file is renamed from .part
+    saved = os.path.join(saved_dir, os.path.basename(path))
+    while not os.path.exists(saved):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    for transport in server._transport:
+        transport.quit_request()
+    os.remove(saved)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=parse_size, default=parse_size('1G'))
+    parser.add_argument('--mode', choices=['dukto', 'nitroshare'], default='dukto')
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--no-sendfile', action='store_true')
+    parser.add_argument('--cert')
+    parser.add_argument('--key')
+    parser.add_argument('--port', type=int, default=24342)
+    args = parser.parse_args()
+
+    print('cpu: %s' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'data.bin')
+        with open(path, 'wb') as f:
+            data = os.urandom(CHUNK_SIZE * 16)
+            for _ in range(args.size // len(data)):
+                f.write(data)
+        size = os.path.getsize(path)
+        saved_dir = os.path.join(tmp, 'saved')
+        os.makedirs(saved_dir)
+        for i, streams in enumerate(args.streams):
+            elapsed = transfer(path, saved_dir, args.port + i * 2, streams, args)
+            print('streams %-3d %10s/s' % (streams, human_size(size / elapsed)))
+
+
+if __name__ == '__main__':
+    main()
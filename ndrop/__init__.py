@@ -30,6 +30,12 @@ def init_config(cfg_path=None):
 target_dir = {target_dir}
 enable_hdpi = False
 create_node_by_text = True
+hash = md5
+limit_rate = 0
+limit_rate_total = 0
+max_transfers = 4
+max_peer_transfers = 1
+engine = thread
 """
 
         dir_name = os.path.dirname(cfg_path)
@@ -46,6 +52,12 @@ create_node_by_text = True
             getattr(gConfig, section)[k] = v
     gConfig.app['enable_hdpi'] = gConfig.app.get('enable_hdpi') == 'True'
     gConfig.app['create_node_by_text'] = gConfig.app.get('create_node_by_text') == 'True'
+    gConfig.app.setdefault('hash', 'md5')
+    gConfig.app.setdefault('limit_rate', '0')
+    gConfig.app.setdefault('limit_rate_total', '0')
+    gConfig.app['max_transfers'] = int(gConfig.app.get('max_transfers', 4))
+    gConfig.app['max_peer_transfers'] = int(gConfig.app.get('max_peer_transfers', 1))
+    gConfig.app.setdefault('engine', 'thread')
 
 
 def save_config(cfg_path=None):
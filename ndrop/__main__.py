@@ -8,12 +8,26 @@ import glob
 
 from . import about
 from . import hfs
-from .netdrop import NetDropServer, NetDropClient
+from .netdrop import NetDropServer, NetDropClient, NetDropFanOut, parse_destination
+from .netdrop import MAX_SESSIONS, WRITE_QUEUE, READ_AHEAD, CONNECTIONS
+from .transport import parse_size, set_recv_buffer_size, set_chunk_size, set_socket_buffer_size, \
+    RECV_BUFFER_SIZE, CHUNK_SIZE
+from .pipeline import HASH_ALGORITHMS, READ_AHEAD_SIZE
+from .compress import CODECS
+from .ratelimit import set_total_rate
+from .aio import ENGINES
 
 
 logger = logging.getLogger(__name__)
 
 
+def chunk_size(text):
+    """size of --chunk-size, or 'auto'"""
+    if text == 'auto':
+        return text
+    return parse_size(text)
+
+
 def run():
     description = '%s\n%s' % (about.description, about.detail)
     epilog = 'NOTE: Output data to STDOUT if "PARAM" is "-". ' \
@@ -35,9 +49,86 @@ def run():
                        metavar='<ip[:port]>',
                        help='listen on...')
 
-    group.add_argument('--send',
-                       metavar='<ip[:port]>',
-                       help='send to...')
+    group.add_argument('--send', action='append',
+                       metavar='<[mode://]ip[:port]>',
+                       help='send to... several receivers by repeating it or separated by ",",'
+                       ' every file is read once for all of them.')
+
+    group.add_argument('--no-sendfile', action='store_true',
+                       help='read file data in python instead of os.sendfile when sending.')
+
+    group.add_argument('--read-ahead', type=int, default=READ_AHEAD,
+                       metavar='<num>',
+                       help='buffers of %sM read from disk by reader thread while sending.'
+                       ' 0 is to read in sending thread. default: %s.' % (READ_AHEAD_SIZE // (1024 * 1024), READ_AHEAD))
+
+    group.add_argument('--streams', type=int, default=1,
+                       metavar='<num>',
+                       help='send large files by NUM parallel connections, receiver must be ndrop.'
+                       ' default: 1.')
+
+    group.add_argument('--connections', type=int, default=CONNECTIONS,
+                       metavar='<num>',
+                       help='send files by NUM connections at the same time, every one is a transfer'
+                       ' of its own. default: %s.' % CONNECTIONS)
+
+    group.add_argument('--resume', action='store_true',
+                       help='skip data already in .part files of receiver, it must be ndrop.'
+                       ' send all again if it is not.')
+
+    group.add_argument('--compress', choices=['auto', 'zstd', 'zlib'],
+                       metavar='<codec>',
+                       help='compress data of files which compress well, receiver must be ndrop:'
+                       ' [auto, zstd, zlib]. auto is zstd if "zstandard" is installed, else zlib.'
+                       ' send raw if receiver is not ndrop.')
+
+    group.add_argument('--delta', action='store_true',
+                       help='send only changed blocks of files which receiver already has, it must be ndrop.'
+                       ' send whole files if it is not.')
+
+    group.add_argument('--skip-same', action='store_true',
+                       help='skip files whose content receiver already has in its directory, it must be ndrop.'
+                       ' send all if it is not.')
+
+    group.add_argument('--max-sessions', type=int, default=MAX_SESSIONS,
+                       metavar='<num>',
+                       help='receive from NUM senders at the same time. 0 is unlimited.'
+                       ' default: %s.' % MAX_SESSIONS)
+    group.add_argument('--buffer-size', type=parse_size, default=RECV_BUFFER_SIZE,
+                       metavar='<size>',
+                       help='receive buffer of every connection, such as 256K, 4M.'
+                       ' default: %sK.' % (RECV_BUFFER_SIZE // 1024))
+    group.add_argument('--chunk-size', type=chunk_size,
+                       metavar='<size>',
+                       help='data read and sent at a time by every connection, such as 256K, not larger'
+                       ' than send buffer of socket. "auto" doubles it while throughput rises.'
+                       ' default: %sK.' % (CHUNK_SIZE // 1024))
+    group.add_argument('--socket-buffer', type=parse_size, default=0,
+                       metavar='<size>',
+                       help='SO_SNDBUF of sending and SO_RCVBUF of receiving sockets, such as 4M.'
+                       ' default: tuned by kernel.')
+    group.add_argument('--limit-rate', type=parse_size, default=0,
+                       metavar='<size>',
+                       help='bytes per second of every transfer, sent, received or downloaded'
+                       ' from HFS, such as 512K, 10M. default: unlimited.')
+    group.add_argument('--limit-rate-total', type=parse_size, default=0,
+                       metavar='<size>',
+                       help='bytes per second shared by all concurrent transfers. default: unlimited.')
+    group.add_argument('--engine', choices=ENGINES, default='thread',
+                       metavar='<engine>',
+                       help='I/O of servers and senders: [%s]. thread serves every connection by a thread,'
+                       ' asyncio serves all connections and discovery by one event loop, it sends stock'
+                       ' transfers only. default: thread.' % ', '.join(ENGINES))
+    group.add_argument('--write-queue', type=int, default=WRITE_QUEUE,
+                       metavar='<num>',
+                       help='buffers queued to disk writer thread of every connection.'
+                       ' 0 is to write in receiving thread. default: %s.' % WRITE_QUEUE)
+    group.add_argument('--stats-file', metavar='<file>',
+                       help='append time of every stage and I/O calls of every transfer'
+                       ' to FILE, one JSON per line.')
+    group.add_argument('--hash', choices=HASH_ALGORITHMS, default='md5',
+                       metavar='<algorithm>',
+                       help='digest of every file: [%s]. default: md5.' % ', '.join(HASH_ALGORITHMS))
 
     parser.add_argument(
         'param', nargs='*',
@@ -80,9 +171,41 @@ def run():
     app_logger.addHandler(handler)
 
     print(about.banner)
+    if args.compress and args.compress != 'auto' and args.compress not in CODECS:
+        parser.error('--compress %s: "zstandard" is not installed' % args.compress)
+    if args.chunk_size == 'auto':
+        set_chunk_size(auto=True)
+    else:
+        set_chunk_size(args.chunk_size)
+    set_socket_buffer_size(args.socket_buffer)
+    set_total_rate('send', args.limit_rate_total)
+    set_total_rate('recv', args.limit_rate_total)
+    if args.send and args.engine == 'asyncio':
+        if args.resume or args.streams > 1 or args.compress or args.delta or args.skip_same:
+            logger.warning('--resume, --streams, --compress, --delta and --skip-same'
+                           ' are ignored by asyncio engine')
     if args.send:
-        mode = args.mode or 'dukto'
-        client = NetDropClient(args.send, mode=mode, ssl_ck=(args.cert, args.key))
+        dests = [dest for send in args.send for dest in send.split(',') if dest]
+        if len(dests) > 1:
+            if args.resume or args.streams > 1 or args.connections > 1 or args.delta or args.skip_same:
+                logger.warning('--resume, --streams, --connections, --delta and --skip-same'
+                               ' are ignored for several receivers')
+            clients = []
+            for dest in dests:
+                mode, addr = parse_destination(dest, args.mode or 'dukto')
+                clients.append(NetDropClient(
+                    addr, mode=mode, ssl_ck=(args.cert, args.key),
+                    hash_algorithm='none', stats_file=args.stats_file, read_ahead=0, compress=args.compress,
+                    limit_rate=args.limit_rate, engine=args.engine))
+            client = NetDropFanOut(clients, hash_algorithm=args.hash, read_ahead=args.read_ahead)
+        else:
+            mode, addr = parse_destination(dests[0], args.mode or 'dukto')
+            client = NetDropClient(
+                addr, mode=mode, ssl_ck=(args.cert, args.key),
+                sendfile=not args.no_sendfile, hash_algorithm=args.hash, resume=args.resume,
+                stats_file=args.stats_file, read_ahead=args.read_ahead, streams=args.streams,
+                connections=args.connections, compress=args.compress, delta=args.delta,
+                skip_same=args.skip_same, limit_rate=args.limit_rate, engine=args.engine)
         if args.text:
             client.send_text(' '.join(args.param))
         else:
@@ -104,10 +227,19 @@ def run():
         parser.error('the following arguments are required: <mode>')
 
     if args.hfs:
-        hfs.start(listen, root_path=saved_dir, cert=args.cert, key=args.key)
+        hfs.start(listen, root_path=saved_dir, cert=args.cert, key=args.key, limit_rate=args.limit_rate)
     else:
         logger.info('File Transfer Server start (Press CTRL+C to quit)')
-        server = NetDropServer(listen, mode=args.mode, ssl_ck=(args.cert, args.key))
+        set_recv_buffer_size(args.buffer_size)
+        max_sessions = args.max_sessions
+        if args.engine == 'asyncio' and saved_dir == '-':
+            # a transfer waiting for STDOUT holds executor threads, one at a time
+            max_sessions = 1
+        server = NetDropServer(
+            listen, mode=args.mode, ssl_ck=(args.cert, args.key),
+            max_sessions=max_sessions, write_queue=args.write_queue,
+            hash_algorithm=args.hash, stats_file=args.stats_file, limit_rate=args.limit_rate,
+            engine=args.engine)
         server.saved_to(saved_dir)
         server.wait_for_request()
 
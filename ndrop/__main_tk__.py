@@ -8,6 +8,7 @@ import re
 import argparse
 import threading
 import queue
+import itertools
 import webbrowser
 import logging
 import ipaddress
@@ -17,7 +18,7 @@ import tkinterdnd2 as tkdnd
 import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter.simpledialog import Dialog as BaseDialog
-from tkinter.messagebox import showinfo
+from tkinter.messagebox import showinfo, showerror
 from tkinter.filedialog import askdirectory, askopenfilenames
 from tkinter.scrolledtext import ScrolledText
 import appdirs
@@ -26,15 +27,26 @@ from . import init_config, save_config, gConfig
 from . import hdpitk
 from . import about
 from . import hfs
-from .netdrop import NetDropServer, NetDropClient
-from .transport import get_broadcast_address, human_size
+from .netdrop import NetDropServer, NetDropClient, NetDropFanOut
+from .pipeline import HASH_ALGORITHMS
+from .transport import get_broadcast_address, human_size, parse_size
+from .ratelimit import set_total_rate, format_cap
+from .scheduler import TransferScheduler, QUEUED
+from .aio import ENGINES
 
 logger = logging.getLogger(__name__)
 
 
 class GUIProgressBar(ttk.Progressbar):
+    # every bar has a style of its own for its speed label, ttk can't delete
+    # a style, so styles of destroyed bars are used again
+    _free_styles = []
+    _style_ids = itertools.count()
+
     def __init__(self, parent, **kwargs):
         self.parent = parent
+        # (from_addr, err) of transfer, set before close
+        self.result = None
         self.style = ttk.Style()
         # add label in the layout
         self.style.layout(
@@ -55,11 +67,18 @@ class GUIProgressBar(ttk.Progressbar):
                 ),
             ]
         )
-        super().__init__(parent, style='text.Horizontal.TProgressbar', **kwargs)
+        if self._free_styles:
+            self.style_name = self._free_styles.pop()
+        else:
+            self.style_name = '%d.text.Horizontal.TProgressbar' % next(self._style_ids)
+        self.style.configure(self.style_name, text='')
+        super().__init__(parent, style=self.style_name, **kwargs)
         self.interval = 100
         self.step_count = 0
         self.time_index = 0
         self.speed = ''
+        # configured cap of transfer, shown behind speed
+        self.cap = ''
         self.count = [0] * (1000 // self.interval)
         self.parent.after(self.interval, self.on_timer_update)
 
@@ -71,11 +90,12 @@ class GUIProgressBar(ttk.Progressbar):
             self.step_count = 0
             # 0 ~ 9
             self.time_index = (self.time_index + 1) % (1000 // self.interval)
-            self.parent.on_progressbar_update_speed(self.speed)
+            speed = f'{self.speed} {self.cap}' if self.cap else self.speed
+            self.parent.on_progressbar_update_speed(self, speed)
 
     def update(self, step):
         self.step_count += step
-        self.parent.on_progressbar_update(step)
+        self.parent.on_progressbar_update(self, step)
 
     def write(self, message, file=None):
         logger.info(message)
@@ -87,22 +107,25 @@ class GUIProgressBar(ttk.Progressbar):
             speed = sum(self.count) / (len([x for x in self.count if x != 0]) * self.interval / 1000)
             self.speed = f'{human_size(speed):>9}/s'
         self.step_count = -1
-        self.parent.on_progressbar_close(self.speed.strip())
+        self.parent.on_progressbar_close(self, self.speed.strip())
+
+    def destroy(self):
+        super().destroy()
+        self._free_styles.append(self.style_name)
 
 
 class GUINetDropServer(NetDropServer):
-    def __init__(self, parent, *args):
+    def __init__(self, parent, *args, **kwargs):
         self.parent = parent
-        super().__init__(*args)
+        super().__init__(*args, **kwargs)
 
-    def init_bar(self, max_value):
+    def init_bar(self, max_value, limit=None):
         progress = GUIProgressBar(
             self.parent.host_client, orient=tk.HORIZONTAL,
             maximum=max_value,
             mode='determinate')
-        progress.grid(row=1, column=1, sticky='nsew')
-        progress.lift()
-        self.parent.host_client.progress = progress
+        progress.cap = format_cap(limit)
+        self.parent.host_client.show_progress(progress)
         return progress
 
     def add_node(self, node):
@@ -120,29 +143,49 @@ class GUINetDropServer(NetDropServer):
 
     def recv_finish(self, from_addr, err):
         self.parent.host_client.result = (from_addr, err)
+        session = self._sessions.get(from_addr)
+        if session and session.bar:
+            session.bar.result = (from_addr, err)
         super().recv_finish(from_addr, err)
 
 
 class GUINetDropClient(NetDropClient):
-    def __init__(self, parent, ip, mode, cert=None, key=None):
+    def __init__(self, parent, ip, mode, cert=None, key=None, **kwargs):
         self.parent = parent
-        super().__init__(ip, mode.lower(), ssl_ck=(cert, key))
+        kwargs.setdefault('hash_algorithm', gConfig.app['hash'])
+        kwargs.setdefault('limit_rate', parse_size(gConfig.app['limit_rate']))
+        kwargs.setdefault('engine', gConfig.app['engine'])
+        super().__init__(ip, mode.lower(), ssl_ck=(cert, key), **kwargs)
 
-    def init_bar(self, max_value):
+    def init_bar(self, max_value, limit=None):
         progress = GUIProgressBar(
             self.parent, orient=tk.HORIZONTAL,
             maximum=max_value,
             mode='determinate')
-        progress.grid(row=1, column=1, sticky='nsew')
-        progress.lift()
-        self.parent.progress = progress
+        progress.cap = format_cap(limit)
+        self.parent.show_progress(progress)
         return progress
 
     def send_finish(self, err):
         self.parent.result = (None, err)
+        if self._bar:
+            self._bar.result = (None, err)
         super().send_finish(err)
 
 
+class GUINetDropFanOut(NetDropFanOut):
+    def write(self, message):
+        logger.info(message)
+
+
+def job_name(files):
+    """first of FILES and count of others"""
+    name = os.path.basename(os.path.normpath(files[0]))
+    if len(files) > 1:
+        name = '%s +%s' % (name, len(files) - 1)
+    return name
+
+
 IMAGES = {
     'back': 'BackTile.png',
     'pc': 'PcLogo.png',
@@ -321,14 +364,20 @@ class ScrolledWindow(ttk.Frame):
 
 class Client(ttk.Frame):
     node = None
+    # bar shown on status, of the latest transfer
     progress = None
     agent = None
+    selected = False
+    # jobs of scheduler waiting for this peer
+    queued = 0
 
     def __init__(self, parent, node, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
         self.parent = parent
         self.node = node
 
+        # bars of concurrent transfers, newest last
+        self.bars = []
         self.queue = queue.SimpleQueue()
         self.virtual_event = '<<client_queue_event>>'
         self.bind(self.virtual_event, self.queue_handler)
@@ -337,6 +386,7 @@ class Client(ttk.Frame):
 
         self.style = ttk.Style()
         self.style.configure('client.TLabel', background='white')
+        self.style.configure('selected.TLabel', background='light sky blue')
 
         self.label_image = ttk.Label(self, image=self.image, style='client.TLabel')
         self.label_image.grid(row=0, column=0, rowspan=2, sticky='w')
@@ -345,7 +395,7 @@ class Client(ttk.Frame):
             text = f'{node.get("user")}\n@{node["name"]}'
         else:
             text = f'{node.get("mode")}\n@{node["name"]}'
-        label_text = ttk.Label(
+        self.label_text = label_text = ttk.Label(
             self, text=text,
             anchor='w', style='client.TLabel', justify=tk.LEFT)
         label_text.grid(row=0, column=1, sticky='ew')
@@ -355,7 +405,7 @@ class Client(ttk.Frame):
             self.status.set('ready')
         else:
             self.status.set(f'{self.node["ip"]} - ready')
-        label_status = ttk.Label(
+        self.label_status = label_status = ttk.Label(
             self, textvariable=self.status,
             anchor='w', style='client.TLabel', justify=tk.LEFT)
         label_status.grid(row=1, column=1, sticky='nsew')
@@ -371,6 +421,7 @@ class Client(ttk.Frame):
 
         for widget in [self] + list(self.children.values()):
             widget.bind('<Button-1>', self.click)
+            widget.bind('<Control-Button-1>', self.toggle_select)
             widget.drop_target_register(*self.dnd_types)
             widget.dnd_bind('<<DropEnter>>', self.drop_enter)
             widget.dnd_bind('<<DropPosition>>', self.drop_position)
@@ -383,36 +434,61 @@ class Client(ttk.Frame):
         for child in widget.children.values():
             bind_tree(child, event, callback)
 
+    def show_progress(self, progress):
+        """show bar of a new transfer over status, bars of others stay under it"""
+        progress.grid(row=1, column=1, sticky='nsew')
+        progress.lift()
+        self.bars.append(progress)
+        self.progress = progress
+
     def queue_handler(self, event):
         item = self.queue.get_nowait()
-        if self.progress:
-            if item[0] == 'step':
-                self.progress.step(item[1])
-            elif item[0] == 'speed':
-                self.progress.style.configure('text.Horizontal.TProgressbar', text=item[1])
-            elif item[0] == 'close':
-                self.progress.destroy()
+        # host client and a peer of several jobs may show concurrent transfers
+        progress = item[1]
+        if item[0] == 'step':
+            progress.step(item[2])
+        elif item[0] == 'speed':
+            # timer may tick after close, style of the bar may be another's
+            if progress in self.bars:
+                progress.style.configure(progress.style_name, text=item[2])
+        elif item[0] == 'close':
+            progress.destroy()
+            if progress in self.bars:
+                self.bars.remove(progress)
+            from_addr, err = progress.result or self.result
+            self.status.set(f'{self.node["ip"]} - {err} - {item[2]}')
+            if self.bars:
+                # latest transfer which is still running
+                self.progress = self.bars[-1]
+                self.progress.lift()
+            else:
                 self.progress = None
                 self.agent = None
-                from_addr, err = self.result
-                self.status.set(f'{self.node["ip"]} - {err} - {item[1]}')
 
-    def on_progressbar_update_speed(self, speed):
-        self.queue.put_nowait(('speed', speed))
+    def on_progressbar_update_speed(self, progress, speed):
+        self.queue.put_nowait(('speed', progress, speed))
         self.event_generate(self.virtual_event)
 
-    def on_progressbar_update(self, step):
-        self.queue.put_nowait(('step', step))
+    def on_progressbar_update(self, progress, step):
+        self.queue.put_nowait(('step', progress, step))
         self.event_generate(self.virtual_event)
 
-    def on_progressbar_close(self, speed):
-        self.queue.put_nowait(('close', speed))
+    def on_progressbar_close(self, progress, speed):
+        self.queue.put_nowait(('close', progress, speed))
         self.event_generate(self.virtual_event)
 
+    def show_queued(self, jobs):
+        """count of queued JOBS of this peer on status, while no transfer is shown"""
+        count = sum(1 for job in jobs if job.state == QUEUED and self.node['ip'] in job.peers)
+        if count != self.queued and not self.progress:
+            if count:
+                self.status.set(f'{self.node["ip"]} - {count} queued')
+            else:
+                self.status.set(f'{self.node["ip"]} - ready')
+        self.queued = count
+
     def click(self, event):
-        if self.agent:
-            logger.info('| => %(mode)s@%(name)s(%(ip)s)' % self.node)
-            return
+        # files chosen while transfering are queued by scheduler
         if self.node['type'] == 'host':
             logger.info('%(mode)s@%(name)s(%(ip)s)' % self.node)
             return
@@ -439,15 +515,27 @@ class Client(ttk.Frame):
         else:
             self.status.set(f'{self.node["ip"]} - ready')
 
+    def toggle_select(self, event):
+        """Ctrl+click selects several clients, files dropped on one are sent to all"""
+        if self.node['type'] == 'host' or self.node['ip'] == '?':
+            return 'break'
+        self.selected = not self.selected
+        style = 'selected.TLabel' if self.selected else 'client.TLabel'
+        for label in (self.label_image, self.label_text, self.label_status):
+            label.configure(style=style)
+        return 'break'
+
+    def selected_clients(self):
+        return [client for client in self.parent.winfo_children()
+                if isinstance(client, Client) and client.selected]
+
     def in_dnd_types(self, dnd_type, dnd_types):
         for types in dnd_types:
             if dnd_type in types:
                 return True
 
     def drop_position(self, event):
-        if self.agent:
-            # be trasfering
-            return tkdnd.REFUSE_DROP
+        # files dropped while transfering are queued by scheduler
         if self.node['type'] == 'host':
             return tkdnd.REFUSE_DROP
         if self.node['ip'] == '?':
@@ -485,12 +573,42 @@ class Client(ttk.Frame):
         ).start()
 
     def send_files(self, files):
-        self.agent = GUINetDropClient(self, self.node['ip'], self.node['mode'])
-        threading.Thread(
-            name='Ndrop client',
-            target=self.agent.send_files,
-            args=(files, ),
-        ).start()
+        """queue FILES in scheduler, they are sent when this peer is free"""
+        if self.selected:
+            clients = self.selected_clients()
+            if len(clients) > 1:
+                self.send_files_to(clients, files)
+                return
+        agent = GUINetDropClient(self, self.node['ip'], self.node['mode'])
+        self.winfo_toplevel().scheduler.submit(
+            [self.node['ip']], job_name(files),
+            lambda: self.run_send(agent, files), cancel=agent.cancel)
+
+    def run_send(self, agent, files):
+        """job of scheduler, return result of transfer"""
+        self.agent = agent
+        agent.send_files(files)
+        return agent.result
+
+    def send_files_to(self, clients, files):
+        """queue FILES for every one of CLIENTS, file is read once when all are free"""
+        agents = [
+            GUINetDropClient(client, client.node['ip'], client.node['mode'], hash_algorithm='none', read_ahead=0)
+            for client in clients]
+        fanout = GUINetDropFanOut(agents, hash_algorithm=gConfig.app['hash'])
+        self.winfo_toplevel().scheduler.submit(
+            [client.node['ip'] for client in clients], job_name(files),
+            lambda: self.run_fanout(clients, agents, fanout, files), cancel=fanout.cancel)
+
+    def run_fanout(self, clients, agents, fanout, files):
+        """job of scheduler, return first failed result of receivers, or 'done'"""
+        for client, agent in zip(clients, agents):
+            client.agent = agent
+        fanout.send_files(files)
+        for client, result, record in fanout.summary:
+            if '%s' % result != 'done':
+                return result
+        return 'done'
 
 
 class Dialog(BaseDialog):
@@ -564,6 +682,22 @@ class SettingDialog(Dialog):
         node_by_text = 1 if kwargs.get('create_node_by_text') else 0
         self.node_by_text = tk.IntVar()
         self.node_by_text.set(node_by_text)
+
+        self.hash = tk.StringVar()
+        self.hash.set(kwargs.get('hash', 'md5'))
+
+        self.limit_rate = tk.StringVar()
+        self.limit_rate.set(kwargs.get('limit_rate', '0'))
+        self.limit_rate_total = tk.StringVar()
+        self.limit_rate_total.set(kwargs.get('limit_rate_total', '0'))
+
+        self.max_transfers = tk.IntVar()
+        self.max_transfers.set(kwargs.get('max_transfers', 4))
+        self.max_peer_transfers = tk.IntVar()
+        self.max_peer_transfers.set(kwargs.get('max_peer_transfers', 1))
+
+        self.engine = tk.StringVar()
+        self.engine.set(kwargs.get('engine', 'thread'))
         super().__init__(master, title)
 
     def body(self, master):
@@ -583,6 +717,48 @@ class SettingDialog(Dialog):
         checkbox = ttk.Checkbutton(master, text='Create node by recving TEXT', variable=self.node_by_text)
         checkbox.grid(row=4, column=0, sticky='ew')
 
+        frame = ttk.Frame(master)
+        frame.grid(row=5, column=0, sticky='ew')
+        label = ttk.Label(frame, text='File hash:')
+        label.pack(side=tk.LEFT)
+        combo = ttk.Combobox(frame, values=HASH_ALGORITHMS, textvariable=self.hash, width=10, state="readonly")
+        combo.pack(side=tk.LEFT)
+
+        frame = ttk.Frame(master)
+        frame.grid(row=6, column=0, sticky='ew')
+        label = ttk.Label(frame, text='Limit rate of transfer (B/s):')
+        label.pack(side=tk.LEFT)
+        entry = ttk.Entry(frame, textvariable=self.limit_rate, width=8)
+        entry.pack(side=tk.LEFT)
+        label = ttk.Label(frame, text='total:')
+        label.pack(side=tk.LEFT)
+        entry = ttk.Entry(frame, textvariable=self.limit_rate_total, width=8)
+        entry.pack(side=tk.LEFT)
+        label = ttk.Label(frame, text='(such as 512K, 10M, 0 is unlimited)')
+        label.pack(side=tk.LEFT)
+
+        frame = ttk.Frame(master)
+        frame.grid(row=7, column=0, sticky='ew')
+        label = ttk.Label(frame, text='Transfers at once:')
+        label.pack(side=tk.LEFT)
+        spinbox = ttk.Spinbox(frame, from_=0, to=64, textvariable=self.max_transfers, width=4)
+        spinbox.pack(side=tk.LEFT)
+        label = ttk.Label(frame, text='to one device:')
+        label.pack(side=tk.LEFT)
+        spinbox = ttk.Spinbox(frame, from_=0, to=64, textvariable=self.max_peer_transfers, width=4)
+        spinbox.pack(side=tk.LEFT)
+        label = ttk.Label(frame, text='(0 is unlimited)')
+        label.pack(side=tk.LEFT)
+
+        frame = ttk.Frame(master)
+        frame.grid(row=8, column=0, sticky='ew')
+        label = ttk.Label(frame, text='I/O engine:')
+        label.pack(side=tk.LEFT)
+        combo = ttk.Combobox(frame, values=ENGINES, textvariable=self.engine, width=10, state="readonly")
+        combo.pack(side=tk.LEFT)
+        label = ttk.Label(frame, text='(asyncio sends without ndrop extension)')
+        label.pack(side=tk.LEFT)
+
         master.rowconfigure(1, weight=1)
         master.columnconfigure(0, weight=1)
         master.pack(fill=tk.BOTH)
@@ -601,6 +777,21 @@ class SettingDialog(Dialog):
 
         box.pack()
 
+    def validate(self):
+        for rate in (self.limit_rate.get(), self.limit_rate_total.get()):
+            try:
+                parse_size(rate)
+            except ValueError:
+                showerror('Error', f'Invalid limit rate: {rate}')
+                return False
+        try:
+            if self.max_transfers.get() < 0 or self.max_peer_transfers.get() < 0:
+                raise ValueError
+        except (tk.TclError, ValueError):
+            showerror('Error', 'Invalid count of transfers')
+            return False
+        return True
+
     def apply(self):
         target_dir = self.target_dir.get()
         hdpi = self.hdpi.get()
@@ -609,6 +800,12 @@ class SettingDialog(Dialog):
             os.path.normpath(target_dir),
             hdpi == 1,
             node_by_text == 1,
+            self.hash.get(),
+            self.limit_rate.get().strip(),
+            self.limit_rate_total.get().strip(),
+            self.max_transfers.get(),
+            self.max_peer_transfers.get(),
+            self.engine.get(),
         )
 
     def change_folder(self, event):
@@ -786,7 +983,8 @@ class HFSDialog(Dialog):
         self.hfs_server = hfs.start(listen,
                   root_path=gConfig.app['target_dir'],
                   cert=cert, key=key,
-                  daemon=True)
+                  daemon=True,
+                  limit_rate=parse_size(gConfig.app['limit_rate']))
         self.master = master
         self.master.after(100, self.poll_log_queue)
         super().__init__(master, title)
@@ -833,6 +1031,69 @@ class HFSDialog(Dialog):
         logger.info('-- HFS server close --')
 
 
+class JobsDialog(Dialog):
+    """queued and active transfers of scheduler, which can be reordered or cancelled"""
+    def __init__(self, master, title=None, scheduler=None, **kwargs):
+        self.scheduler = scheduler
+        self.jobs = {}
+        super().__init__(master, title)
+        self.refresh()
+
+    def body(self, master):
+        columns = ('peers', 'files', 'priority', 'state')
+        self.tree = ttk.Treeview(master, columns=columns, show='headings', height=8, selectmode='browse')
+        for column, width in zip(columns, (120, 160, 60, 60)):
+            self.tree.heading(column, text=column.capitalize())
+            self.tree.column(column, width=width)
+        self.tree.grid(row=0, sticky='nsew')
+
+        master.rowconfigure(0, weight=1)
+        master.columnconfigure(0, weight=1)
+        master.pack(fill=tk.BOTH, expand=1)
+
+    def buttonbox(self):
+        box = ttk.Frame(self)
+        for text, command in (
+                ('Up', self.raise_job), ('Down', self.lower_job), ('Cancel job', self.cancel_job)):
+            w = ttk.Button(box, text=text, width=10, command=command)
+            w.pack(side=tk.LEFT, padx=5, pady=5)
+        w = ttk.Button(box, text="OK", width=10, command=self.hide, default=tk.ACTIVE)
+        w.pack(side=tk.LEFT, padx=5, pady=5)
+        self.bind("<Escape>", lambda event: self.hide())
+        box.pack()
+
+    def refresh(self, jobs=None):
+        jobs = self.scheduler.jobs() if jobs is None else jobs
+        selection = self.tree.selection()
+        self.jobs = dict(('%s' % job.id, job) for job in jobs)
+        self.tree.delete(*self.tree.get_children())
+        for job in jobs:
+            self.tree.insert('', tk.END, iid='%s' % job.id, values=(
+                ', '.join(job.peers), job.name, job.priority, job.state))
+        for iid in selection:
+            if iid in self.jobs:
+                self.tree.selection_set(iid)
+
+    def selected_job(self):
+        selection = self.tree.selection()
+        return self.jobs.get(selection[0]) if selection else None
+
+    def raise_job(self):
+        job = self.selected_job()
+        if job:
+            self.scheduler.set_priority(job, job.priority + 1)
+
+    def lower_job(self):
+        job = self.selected_job()
+        if job:
+            self.scheduler.set_priority(job, job.priority - 1)
+
+    def cancel_job(self):
+        job = self.selected_job()
+        if job:
+            self.scheduler.cancel(job)
+
+
 class QueueHandler(logging.Handler):
     def __init__(self, log_queue):
         super().__init__()
@@ -852,6 +1113,7 @@ class GuiApp(tkdnd.Tk):
     host_client = None
     ip_client = None
     message_box = None
+    jobs_dialog = None
 
     def __init__(self, *args):
         super().__init__(*args)
@@ -863,6 +1125,8 @@ class GuiApp(tkdnd.Tk):
 
         self.geometry('320x360')
         self.queue = queue.SimpleQueue()
+        self.scheduler = TransferScheduler(
+            gConfig.app['max_transfers'], gConfig.app['max_peer_transfers'], on_change=self.on_jobs_change)
 
         uname = platform.uname()
         ipaddrs, _ = get_broadcast_address()
@@ -918,6 +1182,12 @@ class GuiApp(tkdnd.Tk):
         footer.columnconfigure(0, weight=1)
         footer.columnconfigure(4, weight=1)
 
+        self.jobs_text = tk.StringVar()
+        self.jobs_text.set('no transfers queued')
+        label = ttk.Label(footer, textvariable=self.jobs_text, style='footer.TLabel')
+        label.grid(row=1, column=0, columnspan=5)
+        label.bind('<Button-1>', self.show_jobs)
+
         self.rowconfigure(2, weight=1)
         self.columnconfigure(0, weight=1)
 
@@ -935,6 +1205,16 @@ class GuiApp(tkdnd.Tk):
         self.queue.put_nowait(('recv_text', text, from_addr))
         self.event_generate('<<server_queue_event>>')
 
+    def on_jobs_change(self):
+        self.queue.put_nowait(('jobs', ))
+        self.event_generate('<<server_queue_event>>')
+
+    def show_jobs(self, event):
+        if not self.jobs_dialog:
+            self.jobs_dialog = JobsDialog(self, 'Transfers', scheduler=self.scheduler)
+        self.jobs_dialog.refresh()
+        self.jobs_dialog.show(modal=False)
+
     def open_folder(self, event):
         webbrowser.open(gConfig.app['target_dir'])
 
@@ -944,17 +1224,42 @@ class GuiApp(tkdnd.Tk):
             target_dir=gConfig.app['target_dir'],
             enable_hdpi=gConfig.app['enable_hdpi'],
             create_node_by_text=gConfig.app['create_node_by_text'],
+            hash=gConfig.app['hash'],
+            limit_rate=gConfig.app['limit_rate'],
+            limit_rate_total=gConfig.app['limit_rate_total'],
+            max_transfers=gConfig.app['max_transfers'],
+            max_peer_transfers=gConfig.app['max_peer_transfers'],
+            engine=gConfig.app['engine'],
         )
         dlg.show()
         if dlg.result:
-            target_dir, hdpi, node_by_text = dlg.result
+            target_dir, hdpi, node_by_text, hash_algorithm, limit_rate, limit_rate_total, \
+                max_transfers, max_peer_transfers, engine = dlg.result
             if gConfig.app['enable_hdpi'] != hdpi:
                 showinfo('Information', 'Close and open app again for HDPI')
+            if gConfig.app['engine'] != engine:
+                showinfo('Information', 'Following sends use the engine, close and open app again for receiving')
             gConfig.app['target_dir'] = target_dir
             gConfig.app['enable_hdpi'] = hdpi
             gConfig.app['create_node_by_text'] = node_by_text
+            gConfig.app['hash'] = hash_algorithm
+            gConfig.app['limit_rate'] = limit_rate
+            gConfig.app['limit_rate_total'] = limit_rate_total
+            gConfig.app['max_transfers'] = max_transfers
+            gConfig.app['max_peer_transfers'] = max_peer_transfers
+            gConfig.app['engine'] = engine
             save_config()
             self.server.saved_to(gConfig.app['target_dir'])
+            self.server.set_hash_algorithm(gConfig.app['hash'])
+            self.set_limit_rate()
+            self.scheduler.set_limits(max_transfers, max_peer_transfers)
+
+    def set_limit_rate(self):
+        """limits of settings for following transfers"""
+        total = parse_size(gConfig.app['limit_rate_total'])
+        set_total_rate('send', total)
+        set_total_rate('recv', total)
+        self.server.set_limit_rate(parse_size(gConfig.app['limit_rate']))
 
     def show_hfs(self, event):
         dlg = HFSDialog(self, 'HFS')
@@ -983,6 +1288,18 @@ class GuiApp(tkdnd.Tk):
                         client.node['ip'] == node['ip'] and \
                         client.node['mode'] == node['mode']:
                     client.destroy()
+        elif item[0] == 'jobs':
+            jobs = self.scheduler.jobs()
+            active = sum(1 for job in jobs if job.state != QUEUED)
+            if jobs:
+                self.jobs_text.set(f'{active} active, {len(jobs) - active} queued')
+            else:
+                self.jobs_text.set('no transfers queued')
+            for client in self.frame.winfo_children():
+                if isinstance(client, Client):
+                    client.show_queued(jobs)
+            if self.jobs_dialog and self.jobs_dialog.is_visible():
+                self.jobs_dialog.refresh(jobs)
         elif item[0] == 'recv_text':
             text = item[1]
             from_addr = '%s:%s' % item[2]
@@ -1009,8 +1326,10 @@ class GuiApp(tkdnd.Tk):
         cert = None
         key = None
 
-        self.server = GUINetDropServer(self, listen, mode, (cert, key))
+        self.server = GUINetDropServer(self, listen, mode, (cert, key), engine=gConfig.app['engine'])
         self.server.saved_to(gConfig.app['target_dir'])
+        self.server.set_hash_algorithm(gConfig.app['hash'])
+        self.set_limit_rate()
         threading.Thread(
             name='Ndrop server',
             target=self.server.wait_for_request,
@@ -0,0 +1,570 @@
+import socket
+import asyncio
+import logging
+import threading
+import platform
+import itertools
+import concurrent.futures
+
+from .stats import TransferStats
+from .transport import ThreadingTCPServer, StreamBuffer, FileRange, BufferList, ChunkTuner, \
+    tls_sessions, set_socket_buffer, EXT_MAGIC
+from . import dukto
+from . import nitroshare
+
+
+logger = logging.getLogger(__name__)
+
+# 'thread': socketserver servers and blocking clients, 'asyncio': coroutines of one event loop
+ENGINES = ('thread', 'asyncio')
+# connections waiting for accept on listening socket, kernel caps it by somaxconn
+BACKLOG = 1024
+# threads of executor, which parse, write and read files for connections. a
+# session waiting for disk holds one, others go on with the rest
+EXECUTOR_THREADS = 64
+
+
+class EventLoop(object):
+    """asyncio loop of all servers and clients of the engine, run by a thread of its own
+
+    other threads, such as CLI or a job of GUI, wait for result of a
+    coroutine while the loop serves every connection. the loop only moves
+    data, file I/O and parsing are done by its executor.
+    """
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """the loop, it starts at first use"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+                    max_workers=EXECUTOR_THREADS, thread_name_prefix='Ndrop executor'))
+                self._thread = threading.Thread(
+                    name='Ndrop asyncio', target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def call(self, coro):
+        """run coroutine by the loop and return its result
+
+        KeyboardInterrupt cancels the coroutine, it is waited for, so it can
+        finish its transfer as interrupted.
+        """
+        loop = self.get()
+        tasks = []
+        done = threading.Event()
+
+        def start():
+            task = loop.create_task(coro)
+            task.add_done_callback(lambda task: done.set())
+            tasks.append(task)
+
+        loop.call_soon_threadsafe(start)
+        while True:
+            try:
+                done.wait()
+                return tasks[0].result()
+            except KeyboardInterrupt:
+                loop.call_soon_threadsafe(lambda: tasks[0].cancel())
+
+    def join(self):
+        """wait for the loop, it runs as long as the process"""
+        self.get()
+        self._thread.join()
+
+    def semaphore(self, value):
+        """asyncio.BoundedSemaphore of the loop, before python 3.10 it binds to loop of the creating thread"""
+        async def create():
+            return asyncio.BoundedSemaphore(value)
+        return self.call(create())
+
+
+event_loop = EventLoop()
+
+
+async def with_timeout(aw, timeout):
+    """await AW, raise socket.timeout as a blocking socket when it takes longer than TIMEOUT"""
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout('timed out')
+
+
+class StreamRequest(object):
+    """socket of RecvHandler on asyncio transport
+
+    handler may run in a thread of executor, data of sendall() is written
+    by the loop at once, in order. the hello of an offer, with timeout of
+    hashing, reaches sender before .part and basis files are hashed.
+    """
+    def __init__(self, transport, timeout, loop):
+        self.transport = transport
+        self.timeout = timeout
+        self._loop = loop
+
+    def sendall(self, data):
+        self._loop.call_soon_threadsafe(self.transport.write, bytes(data))
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+
+class RecvProtocol(asyncio.BufferedProtocol):
+    """receive a transfer into pooled buffer of RecvHandler, which parses it as in ThreadingTCPServer
+
+    transport reads into free space of the buffer while the coroutine
+    waits for data. received data is parsed in executor, as parser writes
+    files through agent, which may wait for disk. reading is paused
+    meanwhile, and while it sleeps for limit, so the buffer doesn't change
+    under the parser and sender is held back.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.handler = None
+        self.transport = None
+        self._received = 0
+        self._calls = 0
+        self._closed = False
+        self._waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.pause_reading()
+        handler_class = self.server.RequestHandlerClass
+        handler = handler_class.__new__(handler_class)
+        handler.request = StreamRequest(transport, self.server.request_timeout, asyncio.get_event_loop())
+        handler.client_address = transport.get_extra_info('peername')[:2]
+        handler.server = self.server
+        self.handler = handler
+        asyncio.ensure_future(self.run())
+
+    def get_buffer(self, sizehint):
+        return self.handler._recv_buff.free_space()
+
+    def buffer_updated(self, nbytes):
+        self.handler._recv_buff.commit(nbytes)
+        self._received += nbytes
+        self._calls += 1
+        self.wake()
+
+    def eof_received(self):
+        self._closed = True
+        self.wake()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self.wake()
+
+    def wake(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def recv(self, timeout):
+        """wait for data, return bytes received since last call, 0 when peer closed"""
+        if not self._received and not self._closed:
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await with_timeout(self._waiter, timeout)
+            finally:
+                self._waiter = None
+        self.handler.stats.count('recv_into', self._calls)
+        size = self._received
+        self._received = self._calls = 0
+        return size
+
+    async def in_executor(self, func, *args):
+        """run blocking FUNC of handler or agent in executor, reading is paused meanwhile"""
+        self.transport.pause_reading()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+        finally:
+            self.transport.resume_reading()
+
+    async def run(self):
+        sessions = self.server.sessions
+        try:
+            if sessions:
+                # wait for a free session, connection isn't read meanwhile
+                async with sessions:
+                    await self.serve()
+            else:
+                await self.serve()
+        except Exception as err:
+            self.server.handle_error(self.handler.client_address, err)
+        finally:
+            self.transport.close()
+
+    async def serve(self):
+        self.handler.setup()
+        try:
+            self.transport.resume_reading()
+            await self.handle()
+        finally:
+            # buffer goes back to pool, transport mustn't read into it
+            self.transport.pause_reading()
+            self.handler.finish()
+
+    async def handle(self):
+        handler = self.handler
+        request = handler.request
+        agent = self.server.agent
+        from_addr = handler.client_address
+        if self.server.ssl_context:
+            logger.info('[%s] connect from %s:%s - TLS, user space' % ((handler._name, ) + from_addr))
+        else:
+            logger.info('[%s] connect from %s:%s' % ((handler._name, ) + from_addr))
+        stats = agent.recv_start(from_addr) or TransferStats('recv')
+        stats.mode = handler._name.lower()
+        stats.peer = from_addr
+        handler.stats = stats
+        limit = agent.recv_limit(from_addr)
+        err = ''
+        while True:
+            try:
+                with stats.stage('socket'):
+                    size = await self.recv(request.timeout)
+                stats.bytes += size
+                if not size:
+                    err = 'abort'
+                    break
+                if limit:
+                    delay = limit.delay(size)
+                    if delay > 0:
+                        # kernel buffer fills while sleeping, window of sender closes
+                        self.transport.pause_reading()
+                        with stats.stage('limit'):
+                            await asyncio.sleep(delay)
+                        self.transport.resume_reading()
+                if handler._ext:
+                    head = bytes(handler._recv_buff.peek(len(EXT_MAGIC)))
+                    if EXT_MAGIC.startswith(head):
+                        # offer of ndrop extension, .part and basis files are hashed
+                        begins = await self.in_executor(handler.unpack_ext)
+                    else:
+                        begins = handler.unpack_ext()
+                    if not begins:
+                        continue
+                if handler._range:
+                    ret = await self.in_executor(handler.feed_range)
+                else:
+                    ret = await self.in_executor(handler.parse)
+                if ret:
+                    await self.in_executor(self.finish_transfer)
+                    err = 'done'
+                    break
+            except Exception as e:
+                err = e
+                logger.error('%s' % err)
+                await self.in_executor(self.abort_transfer, err)
+                break
+        if handler._range and err == 'abort':
+            handler._range.abort(ConnectionError('Connection closed'))
+        # writer and hasher threads of session are joined
+        await self.in_executor(agent.recv_finish, from_addr, err)
+
+    def finish_transfer(self):
+        handler = self.handler
+        # data is on disk before reporting success
+        self.server.agent.recv_flush(handler.client_address)
+        if not handler._range:
+            handler.finish_transfer()
+
+    def abort_transfer(self, err):
+        handler = self.handler
+        if handler._range:
+            handler._range.abort(err)
+        else:
+            handler.abort_transfer(err)
+
+
+class AsyncTCPServer(object):
+    """serve connections of RecvHandler by coroutines of event_loop, as ThreadingTCPServer by threads
+
+    sessions: asyncio semaphore shared by all servers to limit concurrent connections
+    ssl_context: TLS is done by asyncio in user space, there is no kTLS
+    """
+    request_timeout = ThreadingTCPServer.request_timeout
+
+    def __init__(self, server_address, RequestHandlerClass, sessions=None, ssl_context=None):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.sessions = sessions
+        self.ssl_context = ssl_context
+        self.agent = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # accepted connections take receive buffer of listening socket
+            set_socket_buffer(self.socket, socket.SO_RCVBUF)
+            self.socket.bind(server_address)
+        except Exception:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.get_event_loop().create_server(
+            lambda: RecvProtocol(self), sock=self.socket, ssl=self.ssl_context, backlog=BACKLOG)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    def handle_error(self, client_address, err):
+        logger.error('%s:%s - %s' % (client_address[0], client_address[1], err))
+
+
+class AsyncUDPServer(asyncio.DatagramProtocol):
+    """datagrams of discovery handled by the loop, by RequestHandlerClass of socketserver.UDPServer"""
+    def __init__(self, server_address, RequestHandlerClass):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.agent = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.socket.bind(server_address)
+        except Exception:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        self._transport = None
+
+    async def start(self):
+        self._transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+            lambda: self, sock=self.socket)
+
+    def datagram_received(self, data, client_address):
+        try:
+            self.RequestHandlerClass((data, self.socket), client_address, self)
+        except Exception as err:
+            logger.error('%s:%s - %s' % (client_address[0], client_address[1], err))
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+
+class AsyncServer(object):
+    """DuktoServer or NitroshareServer served by event_loop instead of threads
+
+    sockets are bound at once, connections, discovery and hello are
+    coroutines from wait_for_request.
+    """
+    _tcp_handler = None
+    _udp_handler = None
+    _hello_task = None
+
+    def create_servers(self, ip, sessions=None, ssl_context=None):
+        self._udp_server = AsyncUDPServer((ip, self._udp_port), self._udp_handler)
+        self._udp_server.agent = self
+        self._tcp_server = AsyncTCPServer(
+            (ip, self._tcp_port), self._tcp_handler,
+            sessions=sessions, ssl_context=ssl_context)
+        self._tcp_server.agent = self
+
+    def start_servers(self):
+        event_loop.call(self.serve())
+
+    def stop_servers(self):
+        event_loop.call(self.close())
+
+    async def serve(self):
+        await self._udp_server.start()
+        await self._tcp_server.start()
+        self._hello_task = asyncio.ensure_future(self.loop_hello())
+
+    async def loop_hello(self):
+        while self._loop_hello:
+            self.hello()
+            await asyncio.sleep(self._hello_interval)
+
+    async def close(self):
+        if self._hello_task:
+            self._hello_task.cancel()
+        self._udp_server.close()
+        self._tcp_server.close()
+
+    def recv_max_streams(self, from_addr):
+        # parsing a striped file waits for its range connections, it would hold the loop
+        return 1
+
+
+class AsyncDuktoServer(AsyncServer, dukto.DuktoServer):
+    _tcp_handler = dukto.TCPHandler
+    _udp_handler = dukto.UDPHandler
+
+
+class AsyncNitroshareServer(AsyncServer, nitroshare.NitroshareServer):
+    _tcp_handler = nitroshare.TCPHandler
+    _udp_handler = nitroshare.UDPHandler
+
+
+async def send_chunks(writer, chunks, stats=None, tuner=None, limit=None, timeout=None):
+    """send chunks of pack_files by asyncio stream WRITER, as transport.send_chunks
+
+    chunks are made in executor, pack_files reads files, and data of
+    FanOutReader waits for other receivers. transport may keep data in its
+    write buffer, so buffers which pack_files reuses are copied in one
+    bytes, as by TLS socket of threads.
+    """
+    loop = asyncio.get_event_loop()
+    stats = stats or TransferStats('send')
+    chunks = iter(chunks)
+    while True:
+        with stats.stage('pack'):
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        with stats.stage('socket'):
+            if isinstance(chunk, FileRange):
+                size = 0
+                if chunk.header:
+                    writer.write(chunk.header)
+                    stats.count('send')
+                    stats.bytes += len(chunk.header)
+                    size = len(chunk.header)
+                sent = await loop.sendfile(writer.transport, chunk.file, chunk.offset, chunk.count)
+                stats.count('sendfile')
+                stats.bytes += sent
+                size += sent
+                if sent != chunk.count:
+                    raise IOError('File Changed: [%s] %s => %s.' % (
+                        chunk.file.name, chunk.offset + chunk.count, chunk.offset + sent))
+            elif isinstance(chunk, BufferList):
+                writer.write(b''.join(chunk))
+                stats.count('send')
+                stats.bytes += chunk.size
+                size = chunk.size
+            else:
+                writer.write(bytes(chunk))
+                stats.count('send')
+                stats.bytes += len(chunk)
+                size = len(chunk)
+            await with_timeout(writer.drain(), timeout)
+        if limit:
+            delay = limit.delay(size)
+            if delay > 0:
+                with stats.stage('limit'):
+                    await asyncio.sleep(delay)
+        if tuner:
+            tuner.sent(size)
+    if tuner:
+        stats.chunk = max(stats.chunk, tuner.size)
+
+
+async def wait_for_close(reader, timeout):
+    """read until peer closes connection, as transport.wait_for_close"""
+    try:
+        while await with_timeout(reader.read(1024), timeout):
+            pass
+    except OSError:
+        pass
+
+
+class AsyncClient(object):
+    """send of DuktoClient or NitroshareClient by a coroutine of event_loop
+
+    it sends stock Dukto or NitroShare transfer, options of ndrop extension
+    (resume, streams, compress, delta and skip-same) are left to thread engine.
+    caller waits for the transfer, while the loop sends it.
+    """
+    def send_files(self, total_size, files, stats=None, source=None, limit=None):
+        event_loop.call(self.send_files_async(total_size, files, stats, source, limit))
+
+    async def open_connection(self):
+        """(reader, writer) of asyncio stream connected to peer"""
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            set_socket_buffer(sock, socket.SO_SNDBUF)
+            sock.setblocking(False)
+            await with_timeout(loop.sock_connect(sock, self._address), self._timeout)
+            ssl_context = None
+            if self._cert and self._key:
+                # Finished of handshake and first data are small writes before any reply
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                ssl_context = tls_sessions.context()
+            reader, writer = await with_timeout(asyncio.open_connection(
+                sock=sock, ssl=ssl_context, server_hostname='' if ssl_context else None), self._timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return reader, writer
+
+    def pack_files_header(self, total_size, files):
+        pass
+
+    async def finish_files(self, reader, writer):
+        """after data of files is sent"""
+        pass
+
+    async def send_files_async(self, total_size, files, stats=None, source=None, limit=None):
+        stats = stats or TransferStats('send')
+        stats.peer = self._address
+        writer = None
+        err = 'done'
+        try:
+            reader, writer = await self.open_connection()
+            tls = writer.get_extra_info('sslcontext') is not None
+            header = self.pack_files_header(total_size, files)
+            zero_copy = self._sendfile and not tls and source is None
+            tuner = ChunkTuner(writer.get_extra_info('socket'))
+            chunks = itertools.chain([header], self._packet.pack_files(
+                self, total_size, files, sendfile=zero_copy, stats=stats,
+                read_ahead=self._read_ahead, source=source, tuner=tuner))
+            await send_chunks(writer, chunks, stats, tuner, limit, self._timeout)
+            await self.finish_files(reader, writer)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            err = e
+            logger.error(err)
+        if writer:
+            writer.close()
+        self.send_finish(err)
+
+
+class AsyncDuktoClient(AsyncClient, dukto.DuktoClient):
+    def send_text(self, text):
+        event_loop.call(self.send_text_async(text))
+
+    async def send_text_async(self, text):
+        writer = None
+        err = 'done'
+        try:
+            reader, writer = await self.open_connection()
+            writer.write(self._packet.pack_text(text))
+            await with_timeout(writer.drain(), self._timeout)
+            await self.finish_files(reader, writer)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            err = e
+            logger.error(err)
+        if writer:
+            writer.close()
+        self.send_finish(err)
+
+    def pack_files_header(self, total_size, files):
+        return self._packet.pack_files_header(len(files), total_size)
+
+    async def finish_files(self, reader, writer):
+        if writer.get_extra_info('sslcontext') is not None:
+            await wait_for_close(reader, self._timeout)
+
+
+class AsyncNitroshareClient(AsyncClient, nitroshare.NitroshareClient):
+    def pack_files_header(self, total_size, files):
+        return self._packet.pack_files_header(platform.uname().node, total_size, len(files))
+
+    async def finish_files(self, reader, writer):
+        # receive feedback message
+        data = StreamBuffer()
+        while True:
+            buff = await with_timeout(reader.read(4096), self._timeout)
+            if not buff:
+                break
+            data.extend(buff)
+        self._packet.unpack_tcp(self, data, self._address)
@@ -0,0 +1,297 @@
+import os
+import zlib
+import struct
+import logging
+import collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .stats import TransferStats
+
+
+logger = logging.getLogger(__name__)
+
+# codecs in order of preference, zstd needs "zstandard" package
+CODECS = ['zstd', 'zlib'] if zstandard else ['zlib']
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+# data from the middle of a file, compressed to guess whether the file compresses
+SAMPLE_SIZE = 64 * 1024
+# file whose sample isn't smaller than this part of it is sent raw, such as media or archive
+COMPRESSIBLE = 0.9
+# connection of compression or delta is a series of frames, type and size before data
+FRAME_HEADER = struct.Struct('<BI')
+FRAME_RAW = 0
+FRAME_PACKED = 1
+# data is in basis file of receiver, basis index and offset follow header
+FRAME_COPY = 2
+COPY_REF = struct.Struct('<IQ')
+# data copied from basis file before parser takes it
+COPY_SIZE = 1024 * 256
+
+
+def offer_codecs(codec):
+    """codecs offered to receiver for --compress CODEC, 'auto' is all available ones"""
+    if codec == 'auto':
+        return list(CODECS)
+    if codec not in CODECS:
+        raise ValueError('compression %s is not available' % codec)
+    return [codec]
+
+
+def choose_codec(offered):
+    """first offered codec which this end can decompress, None if no one"""
+    for codec in offered or []:
+        if codec in CODECS:
+            return codec
+
+
+class FrameEncoder(object):
+    """frames of one connection, compressed file data and Copy of delta transfer
+
+    data of FRAME_PACKED frames is one stream of the whole connection, so small
+    files compress together. file whose sample doesn't compress is sent in
+    FRAME_RAW frames, which may be sent by os.sendfile.
+    codec: None sends data in FRAME_RAW frames, for delta without compression
+    """
+    def __init__(self, codec=None, stats=None):
+        self.codec = codec
+        self.stats = stats or TransferStats('send')
+        self.stats.codec = codec
+        # compressor holds data which isn't flushed yet
+        self._pending = False
+        self.packing = codec is not None
+        if codec is None:
+            return
+        elif codec == 'zstd':
+            self._stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif codec == 'zlib':
+            self._stream = zlib.compressobj(ZLIB_LEVEL)
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+        else:
+            raise ValueError('unknown compression: %s' % codec)
+
+    def start_file(self, file, offset, size):
+        """return whether data of FILE from OFFSET is compressed"""
+        if self.codec is None:
+            return False
+        left = size - offset
+        if left <= SAMPLE_SIZE:
+            # small file compresses with others
+            self.packing = True
+            return self.packing
+        with self.stats.stage('compress'):
+            sample = os.pread(file.fileno(), SAMPLE_SIZE, offset + (left - SAMPLE_SIZE) // 2)
+            self.packing = len(zlib.compress(sample, 1)) < len(sample) * COMPRESSIBLE
+        self.stats.count('pread')
+        if not self.packing:
+            logger.debug('send raw: %s' % file.name)
+        return self.packing
+
+    def compress(self, buffers):
+        """return FRAME_PACKED frame of BUFFERS, b'' while compressor holds them"""
+        with self.stats.stage('compress'):
+            data = b''.join([self._stream.compress(buff) for buff in buffers])
+        self.stats.plain += sum(len(buff) for buff in buffers)
+        self._pending = True
+        return self.frame(data)
+
+    def flush(self):
+        """return FRAME_PACKED frame of data held by compressor, b'' if none"""
+        if not self._pending:
+            return b''
+        with self.stats.stage('compress'):
+            data = self._stream.flush(self._flush_mode)
+        self._pending = False
+        return self.frame(data)
+
+    def frame(self, data):
+        if not data:
+            return b''
+        self.stats.packed += FRAME_HEADER.size + len(data)
+        return FRAME_HEADER.pack(FRAME_PACKED, len(data)) + data
+
+    def raw_header(self, size):
+        """header of FRAME_RAW frame of SIZE bytes, after data held by compressor"""
+        self.stats.plain += size
+        self.stats.packed += FRAME_HEADER.size + size
+        return self.flush() + FRAME_HEADER.pack(FRAME_RAW, size)
+
+    def copy_header(self, copy):
+        """FRAME_COPY frame of delta.Copy, after data held by compressor"""
+        self.stats.plain += copy.count
+        self.stats.copied += copy.count
+        self.stats.packed += FRAME_HEADER.size + COPY_REF.size
+        return self.flush() + FRAME_HEADER.pack(FRAME_COPY, copy.count) + COPY_REF.pack(copy.index, copy.offset)
+
+
+class ZlibDecompressor(object):
+    """zlib stream of a connection, output of every call is limited"""
+    def __init__(self):
+        self._stream = zlib.decompressobj()
+
+    def decompress(self, data, max_length):
+        """return MAX_LENGTH bytes at most, input left is decoded by next call"""
+        tail = self._stream.unconsumed_tail
+        if tail:
+            data = tail + bytes(data)
+        return self._stream.decompress(data, max_length)
+
+
+class ZstdDecompressor(object):
+    """zstd stream of a connection, output of every call is limited
+
+    decompressobj of zstandard returns all output of its input, stream_reader
+    reads input from this object as it arrives instead.
+    """
+    def __init__(self):
+        self._input = collections.deque()
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            self, read_size=COPY_SIZE, read_across_frames=True, closefd=False)
+
+    def read(self, size):
+        """input of stream_reader, none yet isn't end of stream"""
+        if not self._input:
+            raise BlockingIOError()
+        return self._input.popleft()
+
+    def decompress(self, data, max_length):
+        """return MAX_LENGTH bytes at most, input left is decoded by next call"""
+        if data:
+            # data is a view of receive buffer
+            self._input.append(bytes(data))
+        output = []
+        size = 0
+        while size < max_length:
+            try:
+                # input is read only while no output is made, it isn't lost
+                chunk = self._reader.read1(max_length - size)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            output.append(chunk)
+            size += len(chunk)
+        return b''.join(output)
+
+
+class FrameDecoder(object):
+    """decode frames of FrameEncoder from receive buffer
+
+    data: StreamBuffer of decoded data for parser
+    bases: paths of basis files of delta transfer, FRAME_COPY is read from them
+    """
+    def __init__(self, codec, data, stats=None, bases=None):
+        self.codec = codec
+        self.data = data
+        self.stats = stats or TransferStats('recv')
+        self.stats.codec = codec
+        self._bases = bases or []
+        self._basis = None
+        if codec is None:
+            self._stream = None
+        elif codec == 'zstd':
+            self._stream = ZstdDecompressor()
+        elif codec == 'zlib':
+            self._stream = ZlibDecompressor()
+        else:
+            raise ValueError('unknown compression: %s' % codec)
+        self._type = FRAME_RAW
+        # data of current frame which isn't received or copied yet
+        self._left = 0
+        # decompressor may hold more output of data fed to it
+        self._inflating = False
+        # decoded data fills buffer, there is more to decode
+        self._more = False
+
+    def pending(self):
+        """decoded data is left, feed again before receiving more"""
+        return self._more
+
+    def feed(self, buff):
+        """decode whole and partial frames in BUFF, return buffer of decoded data
+
+        decoding stops when the buffer holds COPY_SIZE, as a small frame may
+        expand a lot or copy a lot from basis file, see pending()
+        """
+        while len(self.data) < COPY_SIZE:
+            if self._inflating:
+                self.inflate(b'')
+                continue
+            if self._type == FRAME_COPY and self._left > 0:
+                self.copy()
+                continue
+            if len(buff) == 0:
+                break
+            if not self._left:
+                if not self.read_header(buff):
+                    break
+                continue
+            data = buff.read(self._left)
+            self._left -= len(data)
+            self.stats.packed += len(data)
+            if self._type == FRAME_PACKED:
+                self.inflate(data)
+            else:
+                self.data.extend(data)
+                self.stats.plain += len(data)
+        self._more = self._inflating or (self._type == FRAME_COPY and self._left > 0) or \
+            (len(self.data) >= COPY_SIZE and len(buff) > 0)
+        return self.data
+
+    def inflate(self, data):
+        """decompress DATA, COPY_SIZE of output at most, the rest is held by decompressor"""
+        with self.stats.stage('decompress'):
+            data = self._stream.decompress(data, COPY_SIZE)
+        self._inflating = len(data) == COPY_SIZE
+        self.data.extend(data)
+        self.stats.plain += len(data)
+
+    def read_header(self, buff):
+        """return False to wait for the rest of header"""
+        if len(buff) < FRAME_HEADER.size:
+            return False
+        typ, size = FRAME_HEADER.unpack(bytes(buff.peek(FRAME_HEADER.size)))
+        if typ == FRAME_COPY:
+            if len(buff) < FRAME_HEADER.size + COPY_REF.size:
+                return False
+            buff.read(FRAME_HEADER.size)
+            index, offset = COPY_REF.unpack(bytes(buff.read(COPY_REF.size)))
+            if index >= len(self._bases):
+                raise ValueError('unknown basis file: %s' % index)
+            # opened for one frame, file may be replaced when it is received
+            self._basis = open(self._bases[index], 'rb')
+            self._basis.seek(offset)
+            self.stats.packed += FRAME_HEADER.size + COPY_REF.size
+        elif typ == FRAME_RAW or (typ == FRAME_PACKED and self._stream):
+            buff.read(FRAME_HEADER.size)
+            self.stats.packed += FRAME_HEADER.size
+        else:
+            raise ValueError('unknown frame: %s' % typ)
+        self._type = typ
+        self._left = size
+        if typ == FRAME_COPY and not size:
+            self.close()
+        return True
+
+    def copy(self):
+        with self.stats.stage('read'):
+            data = self._basis.read(min(self._left, COPY_SIZE))
+        self.stats.count('read')
+        if not data:
+            raise IOError('File Changed: %s' % self._basis.name)
+        self._left -= len(data)
+        self.data.extend(data)
+        self.stats.plain += len(data)
+        self.stats.copied += len(data)
+        if not self._left:
+            self.close()
+
+    def close(self):
+        if self._basis:
+            self._basis.close()
+            self._basis = None
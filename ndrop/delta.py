@@ -0,0 +1,169 @@
+import os
+import zlib
+import base64
+import struct
+import hashlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# smaller files are sent whole
+DELTA_MIN_SIZE = 1024 * 1024
+# block of signatures is about square root of basis size
+DELTA_MIN_BLOCK = 4 * 1024
+DELTA_MAX_BLOCK = 1024 * 1024
+# file data read for matching at a time
+DELTA_READ_SIZE = 4 * 1024 * 1024
+# unmatched blocks in a row searched byte by byte for moved data, then block
+# by block until the next match, new data isn't searched in python for long
+ROLL_BLOCKS = 16
+# adler32 and blake2b of every whole block of basis file
+BLOCK_SUM = struct.Struct('<I16s')
+ADLER_MOD = 65521
+
+
+def block_size(size):
+    block = DELTA_MIN_BLOCK
+    while block * block < size and block < DELTA_MAX_BLOCK:
+        block *= 2
+    return block
+
+
+def strong_sum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signatures(path):
+    """return (block, sums) of file at PATH, sums is base64 of BLOCK_SUM of every whole block"""
+    block = block_size(os.path.getsize(path))
+    sums = bytearray()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if len(data) < block:
+                break
+            sums += BLOCK_SUM.pack(zlib.adler32(data), strong_sum(data))
+    return block, base64.b64encode(sums).decode('ascii')
+
+
+class Copy(object):
+    """COUNT bytes at OFFSET of basis file INDEX, receiver copies them instead of receiving"""
+    __slots__ = ('index', 'offset', 'count')
+
+    def __init__(self, index, offset, count):
+        self.index = index
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+class Basis(object):
+    """signatures of file which receiver has, sender finds its blocks in new file
+
+    index: number of basis file in answer of receiver, for Copy
+    """
+    def __init__(self, index, block, sums):
+        self.index = index
+        self.block = block
+        self._weak = {}
+        self._strong = []
+        for i, (weak, strong) in enumerate(BLOCK_SUM.iter_unpack(base64.b64decode(sums))):
+            self._weak.setdefault(weak, []).append(i)
+            self._strong.append(strong)
+
+    def find(self, weak, data):
+        """offset in basis of block DATA, whose adler32 is WEAK, None if it isn't there"""
+        blocks = self._weak.get(weak)
+        if blocks:
+            strong = strong_sum(data)
+            for i in blocks:
+                if self._strong[i] == strong:
+                    return i * self.block
+
+    def roll(self, data, pos, weak):
+        """search block after POS byte by byte, by rolling adler32 WEAK of block at POS
+
+        return (pos, offset) of found block, or (next pos to search, None)
+        """
+        block = self.block
+        table = self._weak
+        a = weak & 0xffff
+        b = weak >> 16
+        end = min(pos + block, len(data) - block)
+        for i in range(pos, end):
+            out = data[i]
+            a = (a - out + data[i + block]) % ADLER_MOD
+            b = (b - block * out + a - 1) % ADLER_MOD
+            weak = b << 16 | a
+            if weak in table:
+                offset = self.find(weak, data[i + 1:i + 1 + block])
+                if offset is not None:
+                    return i + 1, offset
+        return end + 1, None
+
+    def match(self, f, offset, size, literal_size, copy_size):
+        """yield literal data and Copy for data of file F from OFFSET to SIZE
+
+        literal_size, copy_size: max length of yielded item
+        """
+        block = self.block
+        f.seek(offset)
+        left = size - offset
+        data = b''
+        pos = 0     # next block to match in data
+        lit = 0     # start of literal data, not yielded yet
+        copy = None
+        misses = 0
+        while True:
+            if left and len(data) - pos < block * 2:
+                # drop yielded data, keep some for rolling
+                read = f.read(min(max(DELTA_READ_SIZE, block * 2), left))
+                if not read:
+                    raise IOError('File Changed: %s' % f.name)
+                left -= len(read)
+                data = data[lit:] + read
+                pos -= lit
+                lit = 0
+                continue
+            if len(data) - pos < block:
+                break
+            window = data[pos:pos + block]
+            weak = zlib.adler32(window)
+            found = self.find(weak, window)
+            if found is None:
+                if misses < ROLL_BLOCKS:
+                    pos, found = self.roll(data, pos, weak)
+                else:
+                    pos += block
+            if found is None:
+                misses += 1
+                if pos - lit >= literal_size:
+                    if copy:
+                        yield copy
+                        copy = None
+                    while pos - lit >= literal_size:
+                        yield data[lit:lit + literal_size]
+                        lit += literal_size
+                continue
+            misses = 0
+            if pos > lit:
+                if copy:
+                    yield copy
+                    copy = None
+                for start in range(lit, pos, literal_size):
+                    yield data[start:min(start + literal_size, pos)]
+            if copy and copy.offset + copy.count == found and copy.count + block <= copy_size:
+                copy.count += block
+            else:
+                if copy:
+                    yield copy
+                copy = Copy(self.index, found, block)
+            pos += block
+            lit = pos
+        if copy:
+            yield copy
+        for start in range(lit, len(data), literal_size):
+            yield data[start:start + literal_size]
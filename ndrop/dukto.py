@@ -3,13 +3,19 @@ import time
 import logging
 import os.path
 import threading
+import itertools
 import socket
 import socketserver
-import ssl
 import getpass
 import platform
 
-from .transport import Transport, get_broadcast_address, CHUNK_SIZE, set_chunk_size
+from .stats import TransferStats
+from .transport import Transport, ThreadingTCPServer, RecvHandler, FileRange, BufferList, \
+    get_broadcast_address, local_name, ext_offer, StripeSender, create_ssl_context, tls_mode, can_sendfile, send_chunks, wait_for_close, \
+    encode_chunks, skip_files, tls_sessions, set_socket_buffer, ChunkTuner, SENDFILE_MIN_SIZE, SENDFILE_CHUNK_SIZE
+from .pipeline import ReadAhead, READ_AHEAD_SIZE
+from .compress import FrameEncoder, offer_codecs
+from .delta import Copy
 from .about import get_system_symbol
 
 
@@ -31,6 +37,7 @@ STATUS = {
 class DuktoPacket():
     _name = 'Dukto'
     _status = STATUS['idle']
+    resume = None
     _record = 0
     _recv_record = 0
     _total_size = 0
@@ -106,17 +113,28 @@ class DuktoPacket():
         data.extend(total_size.to_bytes(8, byteorder='little', signed=True))
         return data
 
-    def pack_files(self, agent, total_size, files):
-        data = bytearray()
+    def pack_files(self, agent, total_size, files, sendfile=False, resume=None, stats=None, read_ahead=0,
+                   source=None, compress=None, delta=None, tuner=None):
+        """sendfile: yield FileRange for file data instead of reading it
+        resume: {name: offset}, data before offset is in .part file of receiver
+        read_ahead: count of buffers read by ReadAhead thread, 0 to read in this thread
+        source: FanOutReader, file data read once for several receivers
+        compress: FrameEncoder, its sample of file decides whether data is compressed,
+            only raw data is sent by sendfile
+        delta: {name: Basis}, data which receiver has in basis file is sent as Copy
+        stats: TransferStats, time of reading file is 'read'
+        tuner: ChunkTuner of connection, size of data read and sent at a time
+        """
+        stats = stats or TransferStats('send')
+        tuner = tuner or ChunkTuner()
+        data = BufferList(tuner.size)
         total_send_size = 0
         transfer_abort = False
         for path, name, size in files:
             # packet format
             # B * n B    D    B * size
             # name  0x00 size data
-            data.extend(name.encode('utf-8'))
-            data.append(0x00)
-            data.extend(size.to_bytes(8, byteorder='little', signed=True))
+            data.append(name.encode('utf-8') + b'\x00' + size.to_bytes(8, byteorder='little', signed=True))
             send_size = 0
             if size < 0:  # directory
                 agent.send_feed_file(
@@ -129,69 +147,153 @@ class DuktoPacket():
             else:
                 file_changed = False
                 with open(path, 'rb') as f:
-                    while not file_changed:
-                        chunk = f.read(CHUNK_SIZE - len(data))
-                        if not chunk:
-                            break
-                        if (send_size + len(chunk)) > size:
-                            file_changed = True
-                            # correct size
-                            chunk = chunk[:size - send_size]
-                            logger.error('File Changed: [%s] %s => %s.' % (name, size, send_size))
-                            cont = input('Drop data and continue? [Yes/No]')
-                            if cont.lower() != 'yes':
-                                transfer_abort = True
-                        send_size += len(chunk)
-                        total_send_size += len(chunk)
-                        agent.send_feed_file(
-                            name, chunk,
-                            send_size, size, total_send_size, total_size,
-                        )
-                        data.extend(chunk)
-                        if len(data) >= CHUNK_SIZE:
-                            yield data[:CHUNK_SIZE]
-                            del data[:CHUNK_SIZE]
-            agent.send_finish_file(name)
+                    if resume and name in resume:
+                        # skipped data is only passed to agent for progress and hash
+                        offset = resume[name]
+                        while send_size < offset:
+                            chunk = FileRange(f, send_size, min(SENDFILE_CHUNK_SIZE, offset - send_size))
+                            send_size += len(chunk)
+                            total_send_size += len(chunk)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                        f.seek(send_size)
+                    packing = compress.start_file(f, send_size, size) if compress else False
+                    basis = delta.get(name) if delta else None
+                    if basis:
+                        # receiver copies data of its basis file
+                        for piece in basis.match(f, send_size, size, tuner.size, SENDFILE_CHUNK_SIZE):
+                            if isinstance(piece, Copy):
+                                # sent data is hashed from the same range of file
+                                chunk = FileRange(f, send_size, len(piece))
+                                if data:
+                                    yield data
+                                    data = BufferList(tuner.size)
+                                yield piece
+                            else:
+                                chunk = piece
+                                data.append(piece)
+                            send_size += len(piece)
+                            total_send_size += len(piece)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                            if data.full():
+                                yield data
+                                data = BufferList(tuner.size)
+                        # check whether file grows as below
+                        f.seek(send_size)
+                    elif sendfile and not packing and size >= SENDFILE_MIN_SIZE and \
+                            os.fstat(f.fileno()).st_size == size:
+                        # header from buffer, file data by os.sendfile
+                        header = b''.join(data)
+                        data = BufferList(tuner.size)
+                        while send_size < size:
+                            chunk = FileRange(
+                                f, send_size, min(SENDFILE_CHUNK_SIZE, size - send_size), header)
+                            header = None
+                            send_size += len(chunk)
+                            total_send_size += len(chunk)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                            yield chunk
+                        # check whether file grows as below
+                        f.seek(send_size)
+                    reader = source
+                    if reader is None and read_ahead and size - send_size > READ_AHEAD_SIZE:
+                        reader = ReadAhead(f, read_ahead, stats=stats)
+                    try:
+                        while not file_changed:
+                            read_size = tuner.size - data.size
+                            # a long file header may fill whole chunk, read(0) would be end of file
+                            if read_size <= 0:
+                                read_size = tuner.size
+                            if reader:
+                                chunk = reader.read(read_size)
+                            else:
+                                with stats.stage('read'):
+                                    chunk = f.read(read_size)
+                                stats.count('read')
+                            if not chunk:
+                                break
+                            if (send_size + len(chunk)) > size:
+                                file_changed = True
+                                # correct size
+                                chunk = chunk[:size - send_size]
+                                logger.error('File Changed: [%s] %s => %s.' % (name, size, send_size))
+                                cont = input('Drop data and continue? [Yes/No]')
+                                if cont.lower() != 'yes':
+                                    transfer_abort = True
+                            send_size += len(chunk)
+                            total_send_size += len(chunk)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                            # buffer of reader is sent by reference
+                            data.append(chunk.view if reader else chunk)
+                            if data.full():
+                                yield data
+                                data = BufferList(tuner.size)
+                                if reader:
+                                    reader.recycle()
+                    finally:
+                        if reader:
+                            reader.close()
+                    # before closing file, FileRange may be read for hash
+                    agent.send_finish_file(name)
+            if size <= 0:
+                agent.send_finish_file(name)
+            if data.full():
+                yield data
+                data = BufferList(tuner.size)
             if transfer_abort:
                 break
-        if len(data) > 0:
+        if data:
             yield data
-            data.clear()
         if transfer_abort:
             sys.exit('Transfer Abort!!!')
 
     def unpack_tcp(self, agent, data, from_addr):
+        """data: StreamBuffer, file data is passed to agent as memoryview"""
         while len(data) > 0:
             if self._status == STATUS['idle']:
-                value = data[:8]
-                del data[:8]
+                if len(data) < 16:
+                    return
+                value = data.read(8)
                 self._record = int.from_bytes(value, byteorder='little', signed=True)
                 self._recv_record = 0
-                value = data[:8]
-                del data[:8]
+                value = data.read(8)
                 self._total_size = int.from_bytes(value, byteorder='little', signed=True)
                 self._total_recv_size = 0
+                if self._record == 0:
+                    # ndrop sender skipped all files, receiver has them
+                    data.clear()
+                    return True
                 self._status = STATUS['filename']
             elif self._status == STATUS['filename']:
-                pos = data.find(b'\0', 0)
+                pos = data.find(b'\0')
                 if pos < 0:
                     return
-                value = data[:pos]
-                del data[:pos + 1]
-                if sys.platform == 'win32':
-                    self._filename = value.decode('utf-8').replace('/', '\\')
-                else:
-                    self._filename = value.decode('utf-8').replace('\\', '/')
+                value = str(data.read(pos + 1)[:pos], 'utf-8')
+                self._filename = local_name(value)
                 self._status = STATUS['filesize']
             elif self._status == STATUS['filesize']:
                 if len(data) < 8:
                     return
-                value = data[:8]
-                del data[:8]
+                value = data.read(8)
                 self._filesize = int.from_bytes(value, byteorder='little', signed=True)
                 self._recv_file_size = 0
 
                 if self._filesize > 0:
+                    if self.resume and self._filename in self.resume:
+                        # data before offset is in .part file, sender skips it
+                        self._recv_file_size = self.resume.pop(self._filename)
+                        self._total_recv_size += self._recv_file_size
                     self._status = STATUS['data']
                 else:
                     if self._filesize < 0:    # directory
@@ -208,22 +310,23 @@ class DuktoPacket():
                     self._recv_record += 1
                     if self._recv_record == self._record and  \
                             self._total_recv_size == self._total_size:
+                        # transfer complete, last one is directory or empty file
                         self._status = STATUS['idle']
                         data.clear()
+                        return True
                     else:
                         self._status = STATUS['filename']
             elif self._status == STATUS['data']:
-                size = min(self._filesize - self._recv_file_size, len(data))
-                self._recv_file_size += size
-                self._total_recv_size += size
+                chunk = data.read(self._filesize - self._recv_file_size)
+                self._recv_file_size += len(chunk)
+                self._total_recv_size += len(chunk)
 
                 agent.recv_feed_file(
-                    self._filename, data[:size],
+                    self._filename, chunk,
                     self._recv_file_size, self._filesize,
                     self._total_recv_size, self._total_size,
                     from_addr,
                 )
-                del data[:size]
 
                 if self._recv_file_size == self._filesize:
                     self._status = STATUS['filename']
@@ -247,34 +350,9 @@ class UDPHandler(socketserver.BaseRequestHandler):
             self._packet.unpack_udp(self.server.agent, data, self.client_address)
 
 
-class TCPHandler(socketserver.BaseRequestHandler):
-    def setup(self):
-        self._recv_buff = bytearray()
-        self._packet = DuktoPacket()
-        self.request.settimeout(20)
-
-    def handle(self):
-        logger.info('[Dukto] connect from %s:%s' % self.client_address)
-        err = ''
-        while True:
-            try:
-                data = self.request.recv(CHUNK_SIZE)
-                if not data:
-                    err = 'abort'
-                    break
-                self._recv_buff.extend(data)
-                ret = self._packet.unpack_tcp(self.server.agent, self._recv_buff, self.client_address)
-            except Exception as e:
-                err = e
-                logger.error('%s' % err)
-                break
-            if ret:
-                err = 'done'
-                break
-        self.server.agent.recv_finish(self.client_address, err)
-
-    def finish(self):
-        pass
+class TCPHandler(RecvHandler):
+    _name = 'Dukto'
+    _packet_class = DuktoPacket
 
 
 class DuktoServer(Transport):
@@ -295,8 +373,9 @@ class DuktoServer(Transport):
     _node = None
     _nodes = None
     _loop_hello = True
+    _hello_interval = 30
 
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    def __init__(self, upper_level, addr, ssl_ck=None, sessions=None):
         if ssl_ck:
             self._cert, self._key = ssl_ck
         addr = addr.split(':')
@@ -313,24 +392,26 @@ class DuktoServer(Transport):
         self._packet = DuktoPacket()
 
         self._nodes = {}
-        self._udp_server = socketserver.UDPServer((ip, self._udp_port), UDPHandler)
-        self._udp_server.agent = self
-
-        self._tcp_server = socketserver.TCPServer((ip, self._tcp_port), TCPHandler)
+        ssl_context = None
         if self._cert and self._key:
-            self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            self._ssl_context.load_cert_chain(self._cert, keyfile=self._key)
-            self._tcp_server.socket = self._ssl_context.wrap_socket(
-                self._tcp_server.socket, server_side=True)
-        self._tcp_server.agent = self
-        set_chunk_size()
+            ssl_context = create_ssl_context(True, self._cert, self._key)
+        self.create_servers(ip, sessions, ssl_context)
 
         self._unicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self._ip_addrs, self._broadcasts = get_broadcast_address(ip)
 
-    def wait_for_request(self):
+    def create_servers(self, ip, sessions=None, ssl_context=None):
+        """bind UDP and TCP servers, they serve from wait_for_request"""
+        self._udp_server = socketserver.UDPServer((ip, self._udp_port), UDPHandler)
+        self._udp_server.agent = self
+        self._tcp_server = ThreadingTCPServer(
+            (ip, self._tcp_port), TCPHandler,
+            sessions=sessions, ssl_context=ssl_context)
+        self._tcp_server.agent = self
+
+    def start_servers(self):
         threading.Thread(
             name='dukto server',
             target=self._udp_server.serve_forever,
@@ -342,6 +423,12 @@ class DuktoServer(Transport):
             daemon=True,
         ).start()
 
+    def stop_servers(self):
+        self._udp_server.shutdown()
+
+    def wait_for_request(self):
+        self.start_servers()
+
         logger.info('My Node: %s' % self.format_node())
         if self._tcp_server.server_address[0] == '0.0.0.0':
             logger.info('[Dukto] listen on %s:%s(tcp):%s(udp) - bind on %s' % (
@@ -361,7 +448,7 @@ class DuktoServer(Transport):
     def quit_request(self):
         self._loop_hello = False
         self.say_goodbye()
-        self._udp_server.shutdown()
+        self.stop_servers()
 
     def fileno(self):
         return self._tcp_server.fileno()
@@ -379,12 +466,42 @@ class DuktoServer(Transport):
                 recv_size, file_size,
                 total_recv_size, total_size, from_addr)
 
+    def recv_start(self, from_addr):
+        return self._upper_level.recv_start(from_addr)
+
+    def recv_limit(self, from_addr):
+        return self._upper_level.recv_limit(from_addr)
+
+    def recv_flush(self, from_addr):
+        self._upper_level.recv_flush(from_addr)
+
     def recv_finish_file(self, path, from_addr):
         if path == TEXT_TAG:
             self._upper_level.recv_finish_text(from_addr)
         else:
             self._upper_level.recv_finish_file(path, from_addr)
 
+    def recv_part_file(self, path, from_addr):
+        return self._upper_level.recv_part_file(path, from_addr)
+
+    def recv_basis_file(self, path, from_addr):
+        return self._upper_level.recv_basis_file(path, from_addr)
+
+    def recv_hash_index(self, from_addr):
+        return self._upper_level.recv_hash_index(from_addr)
+
+    def recv_same_file(self, path, digest, from_addr):
+        return self._upper_level.recv_same_file(path, digest, from_addr)
+
+    def recv_max_streams(self, from_addr):
+        return self._upper_level.recv_max_streams(from_addr)
+
+    def recv_stripes(self, token, stripes, from_addr):
+        self._upper_level.recv_stripes(token, stripes, from_addr)
+
+    def recv_range(self, token, path, begin, count, from_addr):
+        return self._upper_level.recv_range(token, path, begin, count, from_addr)
+
     def recv_finish(self, from_addr, err):
         self._upper_level.recv_finish(from_addr, err)
 
@@ -410,10 +527,13 @@ class DuktoServer(Transport):
             except Exception as err:
                 logger.error('[Dukto] send to "%s" error: %s' % (dest, err))
 
+    def hello(self):
+        self.say_hello(('<broadcast>', self._udp_port))
+
     def loop_say_hello(self):
         while self._loop_hello:
-            self.say_hello(('<broadcast>', self._udp_port))
-            time.sleep(30)
+            self.hello()
+            time.sleep(self._hello_interval)
 
     def say_goodbye(self):
         data = self._packet.pack_goodbye()
@@ -470,10 +590,25 @@ class DuktoClient(Transport):
     _packet = None
     _address = None
     _timeout = 5
-
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    _sendfile = True
+    _resume = False
+    _read_ahead = 0
+    _streams = 1
+    _compress = None
+    _delta = False
+    _skip_same = False
+
+    def __init__(self, upper_level, addr, ssl_ck=None, sendfile=True, resume=False, read_ahead=0, streams=1,
+                 compress=None, delta=False, skip_same=False):
         if ssl_ck:
             self._cert, self._key = ssl_ck
+        self._sendfile = sendfile
+        self._resume = resume
+        self._read_ahead = read_ahead
+        self._streams = streams
+        self._compress = compress
+        self._delta = delta
+        self._skip_same = skip_same
         self._upper_level = upper_level
         addr = addr.split(':')
         ip = addr.pop(0)
@@ -483,21 +618,20 @@ class DuktoClient(Transport):
             tcp_port = DEFAULT_TCP_PORT
         self._address = (ip, tcp_port)
         self._packet = DuktoPacket()
-        set_chunk_size()
 
     def send_text(self, text):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_socket_buffer(sock, socket.SO_SNDBUF)
         if self._cert and self._key:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            sock = ssl_context.wrap_socket(sock, server_side=False)
+            sock = tls_sessions.wrap_socket(sock, self._address)
         data = self._packet.pack_text(text)
         sock.settimeout(self._timeout)
         err = 'done'
         try:
             sock.connect(self._address)
             sock.sendall(data)
+            if self._cert and self._key:
+                wait_for_close(sock)
         except KeyboardInterrupt:
             pass
         except socket.timeout as e:
@@ -506,24 +640,68 @@ class DuktoClient(Transport):
         except Exception as e:
             err = e
             logger.error(err)
-        sock.close()
+        tls_sessions.close(sock, self._address)
         self.send_finish(err)
 
-    def send_files(self, total_size, files):
+    def connect(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_socket_buffer(sock, socket.SO_SNDBUF)
         if self._cert and self._key:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            sock = ssl_context.wrap_socket(sock, server_side=False)
-        header = self._packet.pack_files_header(len(files), total_size)
+            sock = tls_sessions.wrap_socket(sock, self._address)
         sock.settimeout(self._timeout)
-        err = 'done'
         try:
             sock.connect(self._address)
-            sock.sendall(header)
-            for chunk in self._packet.pack_files(self, total_size, files):
-                sock.sendall(chunk)
+        except Exception:
+            sock.close()
+            raise
+        if self._cert and self._key:
+            logger.info('[Dukto] %s:%s - %s' % (self._address + (tls_mode(sock), )))
+        return sock
+
+    def send_files(self, total_size, files, stats=None, source=None, limit=None):
+        stats = stats or TransferStats('send')
+        stats.peer = self._address
+        sock = None
+        stripes = None
+        err = 'done'
+        try:
+            sock = self.connect()
+            resume = None
+            compress = None
+            delta = None
+            if self._resume or self._streams > 1 or self._compress or self._delta or self._skip_same:
+                codecs = offer_codecs(self._compress) if self._compress else None
+                with stats.stage('resume'):
+                    ext = ext_offer(
+                        sock, files, self._timeout, resume=self._resume, streams=self._streams, compress=codecs,
+                        delta=self._delta and source is None, check=self._skip_same and source is None)
+                if ext is None:
+                    logger.info('[Dukto] %s:%s - not ndrop, send all files in one connection' % self._address)
+                    tls_sessions.close(sock, self._address)
+                    sock = self.connect()
+                else:
+                    resume, ranges, token, streams, codec, delta, skipped = ext
+                    if skipped:
+                        total_size, files = skip_files(self, total_size, files, skipped)
+                    if codec or delta:
+                        compress = FrameEncoder(codec, stats)
+                    if ranges:
+                        stripes = StripeSender(
+                            self.connect, token, ranges, streams - 1, sendfile=self._sendfile, stats=stats,
+                            limit=limit)
+            header = self._packet.pack_files_header(len(files), total_size)
+            zero_copy = self._sendfile and can_sendfile(sock) and source is None
+            tuner = ChunkTuner(sock)
+            chunks = itertools.chain([header], self._packet.pack_files(
+                self, total_size, files, sendfile=zero_copy, resume=resume, stats=stats,
+                read_ahead=self._read_ahead, source=source, compress=compress, delta=delta, tuner=tuner))
+            if compress:
+                chunks = encode_chunks(chunks, compress)
+            send_chunks(sock, chunks, stats, tuner, limit)
+            if stripes:
+                stripes.join()
+            if self._cert and self._key:
+                wait_for_close(sock)
         except KeyboardInterrupt:
             pass
         except socket.timeout as e:
@@ -532,7 +710,10 @@ class DuktoClient(Transport):
         except Exception as e:
             err = e
             logger.error(err)
-        sock.close()
+        if stripes:
+            stripes.stop()
+        if sock:
+            tls_sessions.close(sock, self._address)
         self.send_finish(err)
 
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
@@ -541,5 +722,8 @@ class DuktoClient(Transport):
     def send_finish_file(self, path):
         self._upper_level.send_finish_file(path)
 
+    def send_same_file(self, path, file_size):
+        self._upper_level.send_same_file(path, file_size)
+
     def send_finish(self, err):
         self._upper_level.send_finish(err)
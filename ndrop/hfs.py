@@ -6,7 +6,9 @@ import threading
 import logging
 
 from .about import banner
-from .transport import get_broadcast_address
+from . import transport
+from .transport import get_broadcast_address, create_ssl_context
+from .ratelimit import create_limit
 
 
 logger = logging.getLogger(__name__)
@@ -20,12 +22,25 @@ class Handler(SimpleHTTPRequestHandler):
             format % args)
         logger.info(message)
 
+    def copyfile(self, source, outputfile):
+        """send file of download, limited by server.limit_rate and total rate of 'send'"""
+        limit = create_limit('send', self.server.limit_rate)
+        if not limit:
+            return super().copyfile(source, outputfile)
+        while True:
+            data = source.read(transport.CHUNK_SIZE)
+            if not data:
+                break
+            outputfile.write(data)
+            limit.wait(len(data))
+
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    # bytes per second of every download, 0 is unlimited
+    limit_rate = 0
 
 
-def start(listen, root_path=None, cert=None, key=None, daemon=False):
+def start(listen, root_path=None, cert=None, key=None, daemon=False, limit_rate=0):
     if listen:
         ip, _, port = listen.partition(':')
         port = int(port) if port else 8000
@@ -37,12 +52,10 @@ def start(listen, root_path=None, cert=None, key=None, daemon=False):
     os.chdir(root_path)
 
     server = ThreadingSimpleServer((ip, port), Handler)
+    server.limit_rate = limit_rate
     if cert and key:
-        import ssl
-        server.socket = ssl.wrap_socket(
-            server.socket,
-            keyfile=key, certfile=cert,
-            server_side=True)
+        ssl_context = create_ssl_context(True, cert, key)
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True)
         proto = 'https'
     else:
         proto = 'http'
@@ -0,0 +1,180 @@
+import os
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# digests of receive directory, kept in it between runs
+INDEX_NAME = '.ndrop-index'
+INDEX_VERSION = 1
+# received data of unfinished files isn't indexed
+PART_SUFFIX = '.part'
+HASH_READ_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """blake2b of content of file at PATH, the same on sender and receiver"""
+    md = hashlib.blake2b(digest_size=16)
+    buff = bytearray(HASH_READ_SIZE)
+    view = memoryview(buff)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buff)
+            if not n:
+                break
+            md.update(view[:n])
+    return md.hexdigest()
+
+
+def in_directory(root, path):
+    """whether PATH, after links, is in directory ROOT"""
+    root = os.path.realpath(root)
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def link_file(source, path):
+    """hard link SOURCE as PATH which doesn't exist, copy it if it can't be linked"""
+    try:
+        os.link(source, path)
+    except OSError as err:
+        if err.errno == errno.EEXIST:
+            raise
+        shutil.copyfile(source, path)
+
+
+class HashIndex(object):
+    """digests of files in receive directory ROOT, found by size
+
+    directory is listed for every check, a file is hashed again only when
+    its size or mtime changes, or when it is first asked for. digests are
+    cached in INDEX_NAME file of ROOT.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._path = os.path.join(root, INDEX_NAME)
+        # {rel_path: [size, mtime_ns, digest]}, digest is None until asked for
+        self._files = None
+        # {digest: [rel_path]} of hashed files
+        self._digests = {}
+        # digests added since index file is saved
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        self._files = {}
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self._files = data['files']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning('drop index %s: %s' % (self._path, err))
+
+    def save(self):
+        files = dict((name, entry) for name, entry in self._files.items() if entry[2])
+        tmp_path = self._path + PART_SUFFIX
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'files': files}, f)
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            logger.warning('drop index %s: %s' % (self._path, err))
+
+    def scan(self):
+        """update files from directory listing, drop changed digests"""
+        files = {}
+        stack = ['']
+        while stack:
+            rel_root = stack.pop()
+            try:
+                it = os.scandir(os.path.join(self.root, rel_root))
+            except OSError as err:
+                logger.debug('%s' % err)
+                continue
+            with it:
+                for entry in it:
+                    name = os.path.join(rel_root, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(name)
+                            continue
+                        if not entry.is_file(follow_symlinks=False) or name == INDEX_NAME or \
+                                name.endswith(PART_SUFFIX):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    old = self._files.get(name)
+                    if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                        files[name] = old
+                    else:
+                        files[name] = [st.st_size, st.st_mtime_ns, None]
+        self._files = files
+
+    def candidates(self, sizes):
+        """return {size: [digest]} of files whose size is in SIZES"""
+        sizes = set(sizes)
+        result = {}
+        with self._lock:
+            if self._files is None:
+                self.load()
+            self.scan()
+            changed = False
+            for name, entry in self._files.items():
+                if entry[0] not in sizes:
+                    continue
+                if entry[2] is None:
+                    path = os.path.join(self.root, name)
+                    # a directory may be replaced by a link after scan
+                    if not in_directory(self.root, path):
+                        continue
+                    try:
+                        entry[2] = file_digest(path)
+                    except OSError as err:
+                        logger.debug('%s' % err)
+                        continue
+                    changed = True
+                result.setdefault(entry[0], set()).add(entry[2])
+            self._digests = {}
+            for name, entry in self._files.items():
+                if entry[2]:
+                    self._digests.setdefault(entry[2], []).append(name)
+            if changed or self._dirty:
+                self.save()
+                self._dirty = False
+        return dict((size, sorted(digests)) for size, digests in result.items())
+
+    def find(self, digest):
+        """path of an unchanged file with DIGEST, None if there is none"""
+        with self._lock:
+            for name in self._digests.get(digest, []):
+                entry = self._files.get(name)
+                if not entry or entry[2] != digest:
+                    continue
+                path = os.path.join(self.root, name)
+                if not in_directory(self.root, path):
+                    continue
+                try:
+                    st = os.stat(path, follow_symlinks=False)
+                except OSError:
+                    continue
+                if st.st_size == entry[0] and st.st_mtime_ns == entry[1]:
+                    return path
+
+    def add(self, path, digest):
+        """file at PATH has DIGEST, such as one linked by receiver"""
+        st = os.stat(path, follow_symlinks=False)
+        with self._lock:
+            if self._files is None:
+                self.load()
+            name = os.path.relpath(path, self.root)
+            self._files[name] = [st.st_size, st.st_mtime_ns, digest]
+            self._digests.setdefault(digest, []).append(name)
+            self._dirty = True
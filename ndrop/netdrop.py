@@ -1,67 +1,406 @@
 
 import io
 import sys
-import argparse
+import errno
+import shutil
 import logging
 import os.path
 import select
-import hashlib
+import threading
+import time
+import collections
 
 from tqdm import tqdm
 
 from . import dukto
 from . import nitroshare
+from . import aio
+from .transport import human_size
+from . import transport
+from .pipeline import Chunk, ChunkPool, Stage, FanOut, create_hasher
+from .stats import TransferStats, append_record
+from .scan import scan_files, split_batches
+from .index import HashIndex, link_file, in_directory
+from .ratelimit import create_limit, format_cap
 
 
 logger = logging.getLogger(__name__)
 
+MAX_SESSIONS = 16
+# chunks queued to disk writer of every session, 0 is to write in receiving thread
+WRITE_QUEUE = 16
+# buffers of READ_AHEAD_SIZE read before sending, 0 is to read in sending thread
+READ_AHEAD = 4
+STDOUT_LOCK = threading.Lock()
+# received data is written to NAME.part, renamed to NAME when file is complete
+PART_SUFFIX = '.part'
+# records of finished transfers kept in NetDrop.transfer_stats
+STATS_HISTORY = 100
+# connections of one transfer when max_sessions is unlimited
+MAX_STREAMS = 32
+# seconds without data of range connections, before striped file fails
+STRIPE_TIMEOUT = 20
+# connections sending files at the same time, every one is a transfer of its own
+CONNECTIONS = 1
+# times a batch of files is sent again after its connection fails
+BATCH_RETRIES = 3
+
 
 class NetDrop(object):
     _name = 'Ndrop'
     _bar = None
+    _desc = None
     _transport = None
+    _stats_file = None
+    transfer_stats = None
 
-    def init_bar(self, max_value):
+    def init_bar(self, max_value, limit=None):
+        """limit: RateLimit of transfer, its cap is shown behind speed"""
         return tqdm(
-            total=max_value,
+            total=max_value, desc=self._desc,
             unit='B', unit_scale=True, unit_divisor=1024,
+            postfix=format_cap(limit) or None,
         )
 
+    def init_stats(self, stats_file=None):
+        self._stats_file = stats_file
+        self.transfer_stats = collections.deque(maxlen=STATS_HISTORY)
+
+    def report_stats(self, stats):
+        """called when a transfer finishes, with its TransferStats"""
+        record = stats.as_dict()
+        self.transfer_stats.append(record)
+        logger.debug('%s - %s' % (stats.peer, stats))
+        if self._stats_file:
+            try:
+                append_record(self._stats_file, record)
+            except OSError as e:
+                logger.error('%s' % e)
+
+
+def check_free_space(path, size):
+    """fail before receiving if disk can't hold SIZE"""
+    free = shutil.disk_usage(path).free
+    if size > free:
+        raise OSError(errno.ENOSPC, 'No space left on device: need %s, free %s' % (
+            human_size(size), human_size(free)))
+
+
+def preallocate(file_io, size):
+    """reserve disk blocks of announced size, raise OSError if disk is full"""
+    if size <= 0:
+        return
+    fd = file_io.fileno()
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as err:
+            if err.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                raise
+    os.ftruncate(fd, size)
+
+
+def close_file(file_io, path=None):
+    """drop preallocated size behind written data if transfer is interrupted,
+    rename complete .part file to PATH
+    """
+    if file_io.closed:
+        return
+    try:
+        file_io.truncate()
+    finally:
+        file_io.close()
+    if path:
+        os.replace(file_io.name, path)
+
+
+def open_part_file(part_name, offset, file_size):
+    """keep first OFFSET bytes of resumed file"""
+    if offset > 0:
+        file_io = open(part_name, 'r+b')
+        file_io.truncate(offset)
+    else:
+        file_io = open(part_name, 'wb')
+    try:
+        preallocate(file_io, file_size)
+        file_io.seek(offset)
+    except Exception:
+        file_io.close()
+        raise
+    return file_io
+
+
+def hash_prefix(hasher, file_io, offset):
+    """pass data of resumed file, which isn't received again, to hasher"""
+    with open(file_io.name, 'rb') as f:
+        while offset > 0:
+            data = f.read(min(offset, transport.SENDFILE_CHUNK_SIZE))
+            if not data:
+                break
+            hasher.update(data)
+            offset -= len(data)
+
+
+class FileWriter(Stage):
+    """write received data on its own thread
+
+    item: (file_io, chunk), (file_io, None) to close or (file_io, path) to close and rename
+    """
+    def handle(self, item):
+        file_io, data = item
+        if isinstance(data, Chunk):
+            with self.stats.stage('write'):
+                file_io.write(data.view)
+            self.stats.count('write')
+        elif file_io is sys.stdout.buffer:
+            file_io.flush()
+        else:
+            close_file(file_io, data)
+
+    def done(self, item):
+        file_io, data = item
+        if isinstance(data, Chunk):
+            data.release()
+        elif self.error and file_io is not sys.stdout.buffer:
+            close_file(file_io)
+
+
+class StripeRange(object):
+    """range of StripedFile received by a connection of its own"""
+    def __init__(self, stripe, begin, count):
+        self.stripe = stripe
+        self.begin = begin
+        self.count = count
+
+    def write(self, pos, data):
+        self.stripe.write(pos, data)
+        self.stripe.report(len(data))
+
+    def finish(self):
+        self.stripe.finish_range(self.begin)
+
+    def abort(self, err):
+        self.stripe.abort(err)
+
+
+class StripedFile(object):
+    """file received by a transfer and range connections at the same time
+
+    ranges are written by os.pwrite into the preallocated .part file, data
+    behind the last range comes in the transfer.
+    ranges: [[begin, count]], data before first range is resumed.
+    """
+    def __init__(self, part_name, size, ranges):
+        self.part_name = part_name
+        self.size = size
+        self.resumed = ranges[0][0]
+        self.file_io = None
+        self.error = None
+        self._ranges = [tuple(r) for r in ranges]
+        self._claimed = set()
+        self._done = set()
+        # data of transfer is written in order from here
+        self._tail = ranges[-1][0] + ranges[-1][1]
+        self._writers = 0
+        self._closing = False
+        self._bar = None
+        self._unreported = 0
+        self._progress = time.monotonic()
+        self._cond = threading.Condition()
+
+    def open(self):
+        with self._cond:
+            if self.file_io is None:
+                # range may come before its directory in transfer
+                os.makedirs(os.path.dirname(self.part_name), exist_ok=True)
+                self.file_io = open_part_file(self.part_name, self.resumed, self.size)
+            return self.file_io
+
+    def range(self, begin, count):
+        """StripeRange for one connection, None if it isn't a range of file"""
+        with self._cond:
+            if (begin, count) not in self._ranges or begin in self._claimed:
+                return
+            self._claimed.add(begin)
+        return StripeRange(self, begin, count)
+
+    def write(self, pos, data):
+        fd = self.open().fileno()
+        with self._cond:
+            if self.error:
+                raise self.error
+            if self._closing:
+                raise IOError('File is closed: %s' % self.part_name)
+            self._writers += 1
+        start = pos
+        try:
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(fd, view, pos)
+                pos += n
+                view = view[n:]
+        finally:
+            with self._cond:
+                self._writers -= 1
+                self._progress = time.monotonic()
+                if start == self._tail:
+                    self._tail = pos
+                self._cond.notify_all()
+
+    def set_bar(self, bar):
+        """progress of ranges is shown on BAR of transfer"""
+        with self._cond:
+            self._bar = bar
+            bar.update(self._unreported)
+            self._unreported = 0
+
+    def report(self, size):
+        with self._cond:
+            if self._bar is None:
+                self._unreported += size
+                return
+            bar = self._bar
+        bar.update(size)
+
+    def finish_range(self, begin):
+        with self._cond:
+            self._done.add(begin)
+            self._cond.notify_all()
+
+    def abort(self, err):
+        with self._cond:
+            if self.error is None:
+                self.error = err
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        """wait for all ranges, fail if no data comes in TIMEOUT seconds"""
+        with self._cond:
+            while len(self._done) < len(self._ranges):
+                if self.error:
+                    raise self.error
+                if time.monotonic() - self._progress > timeout:
+                    raise TimeoutError('Ranges of %s are not received in %ss' % (self.part_name, timeout))
+                self._cond.wait(1)
+
+    def valid_size(self):
+        """length of data which is received from begin of file"""
+        size = self.resumed
+        for begin, count in self._ranges:
+            if begin not in self._done:
+                return size
+            size = begin + count
+        return self._tail
+
+    def close(self, path=None):
+        """rename complete file to PATH, or keep received data for resume"""
+        with self._cond:
+            self._closing = True
+            while self._writers:
+                self._cond.wait()
+            file_io = self.file_io
+        if file_io is None:
+            return
+        file_io.seek(self.size if path else self.valid_size())
+        close_file(file_io, path)
+
+
+class RecvSession(object):
+    """receive state of one connection"""
+    def __init__(self, from_addr):
+        self.from_addr = from_addr
+        self.file_io = None
+        self.hasher = None
+        self.bar = None
+        self.writer = None
+        self.pool = None
+        self.stdout_locked = False
+        self.part_files = []
+        # StripedFile by path
+        self.stripes = {}
+        self.stripe = None
+        self.limit = None
+        self.files = 0
+        self.recv_size = 0
+        self.start_time = time.time()
+        self.stats = TransferStats('recv', peer=from_addr)
+
+    def __str__(self):
+        elapsed = time.time() - self.start_time
+        return '%s:%s - %s files, %s in %.2fs' % (
+            self.from_addr[0], self.from_addr[1],
+            self.files, human_size(self.recv_size), elapsed)
+
 
 class NetDropServer(NetDrop):
     _name = 'NdropServer'
     _transport = None
-    _md5 = None
-    _file_io = None
-    _bar = None
     _drop_directory = None
     _read_only = False
     _nodes = None
+    _sessions = None
+    _sessions_lock = None
 
-    def __init__(self, addr, mode=None, ssl_ck=None):
+    def __init__(self, addr, mode=None, ssl_ck=None,
+                 max_sessions=MAX_SESSIONS, write_queue=WRITE_QUEUE, hash_algorithm='md5',
+                 stats_file=None, limit_rate=0, engine='thread'):
+        self._engine = engine
+        self._write_queue = write_queue
+        self._max_streams = max(1, max_sessions - 1) if max_sessions else MAX_STREAMS
+        self._hash_algorithm = hash_algorithm
+        self._limit_rate = limit_rate
+        self.init_stats(stats_file)
         self._transport = []
+        # limit concurrent connections of all transports
+        sessions = None
+        if engine == 'asyncio':
+            dukto_server, nitroshare_server = aio.AsyncDuktoServer, aio.AsyncNitroshareServer
+            if max_sessions:
+                sessions = aio.event_loop.semaphore(max_sessions)
+        else:
+            dukto_server, nitroshare_server = dukto.DuktoServer, nitroshare.NitroshareServer
+            if max_sessions:
+                sessions = threading.BoundedSemaphore(max_sessions)
         if not mode or mode == 'dukto':
-            self._transport.append(dukto.DuktoServer(self, addr, ssl_ck=ssl_ck))
+            self._transport.append(dukto_server(
+                self, addr, ssl_ck=ssl_ck, sessions=sessions))
         if not mode or mode == 'nitroshare':
-            self._transport.append(nitroshare.NitroshareServer(self, addr, ssl_ck=ssl_ck))
+            self._transport.append(nitroshare_server(
+                self, addr, ssl_ck=ssl_ck, sessions=sessions))
         self._drop_directory = os.path.abspath('./')
         if not os.access(self._drop_directory, os.W_OK):
             self._read_only = True
             logger.warn('No permission to WRITE: %s' % self._drop_directory)
         self._nodes = {}
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._part_files = set()
+        # HashIndex of drop directory, made when a sender asks for it
+        self._index = None
+        # StripedFile by (transfer token, path)
+        self._stripes = {}
+        self._stripes_cond = threading.Condition(self._sessions_lock)
 
     def wait_for_request(self):
         try:
             for transport in self._transport:
                 transport.wait_for_request()
+            if self._engine == 'asyncio':
+                # connections are served by thread of event loop
+                aio.event_loop.join()
+                return
             while True:
                 r, w, e = select.select(self._transport, [], [], 0.5)
                 for transport in self._transport:
                     if transport in r:
                         transport.handle_request()
         except KeyboardInterrupt:
+            with self._sessions_lock:
+                from_addrs = list(self._sessions.keys())
+            for from_addr in from_addrs:
+                self.recv_finish(from_addr, 'quit')
             for transport in self._transport:
-                transport.recv_finish(transport._ip_addrs[0], 'quit')
                 transport.quit_request()
             logger.info('\n-- Quit --')
 
@@ -79,16 +418,46 @@ class NetDropServer(NetDrop):
             self._read_only = True
             logger.warn('No permission to WRITE: %s' % self._drop_directory)
 
+    def set_hash_algorithm(self, algorithm):
+        """for following transfers, 'none' is to disable"""
+        self._hash_algorithm = algorithm
+
+    def set_limit_rate(self, rate):
+        """bytes per second of every following connection, 0 is unlimited"""
+        self._limit_rate = rate
+
+    def get_session(self, from_addr):
+        with self._sessions_lock:
+            session = self._sessions.get(from_addr)
+            if session is None:
+                session = self._sessions[from_addr] = RecvSession(from_addr)
+            return session
+
+    def recv_start(self, from_addr):
+        return self.get_session(from_addr).stats
+
+    def recv_limit(self, from_addr):
+        session = self.get_session(from_addr)
+        session.limit = create_limit('recv', self._limit_rate)
+        return session.limit
+
     def recv_feed_file(self,
                        path, data,
                        recv_size, file_size,
                        total_recv_size, total_size,
                        from_addr):
-        if self._bar is None:   # create process bar for every transfer
-            self._bar = self.init_bar(total_size)
-        if not self._file_io:  # new file, directory
+        session = self.get_session(from_addr)
+        if session.bar is None:   # create process bar for every transfer
+            if self._drop_directory != '-' and not self._read_only:
+                check_free_space(self._drop_directory, total_size)
+            session.bar = self.init_bar(total_size, session.limit)
+        if not session.file_io:  # new file, directory
             if self._drop_directory == '-':
-                self._file_io = sys.stdout.buffer
+                if not session.stdout_locked:
+                    # transfers to STDOUT can't be mixed, one by one
+                    STDOUT_LOCK.acquire()
+                    session.stdout_locked = True
+                session.file_io = sys.stdout.buffer
             elif self._read_only:
                 logger.warn('No permission WRITING to "%s" and drop it...' % os.path.join(
                     self._drop_directory, path))
@@ -96,53 +465,275 @@ class NetDropServer(NetDrop):
                 name = os.path.join(self._drop_directory, path)
                 if file_size < 0:    # directory
                     if not os.path.exists(name):
-                        os.mkdir(name)
+                        os.makedirs(name, exist_ok=True)
+                elif path in session.stripes:
+                    session.stripe = session.stripes[path]
+                    with session.stats.stage('file'):
+                        session.file_io = session.stripe.open()
                 else:
-                    self._file_io = open(name, 'wb')
+                    offset = recv_size - len(data)
+                    part_name = self.claim_part_file(session, name, offset)
+                    with session.stats.stage('file'):
+                        session.file_io = open_part_file(part_name, offset, file_size)
             if file_size < 0:
                 return
-            self._md5 = hashlib.md5()  # create md5 for file
+            if session.file_io and self._write_queue and not session.writer:
+                session.pool = ChunkPool(self._write_queue, transport.RECV_BUFFER_SIZE)
+                session.writer = FileWriter('Ndrop writer', self._write_queue, session.stats)
+            if session.file_io and self._drop_directory != '-' and not session.hasher:
+                # hash chunks of writer on its own thread, or receive buffer in place
+                session.hasher = create_hasher(
+                    self._hash_algorithm, threaded=bool(session.writer), maxsize=self._write_queue,
+                    stats=session.stats)
+            offset = recv_size - len(data)
+            if session.stripe:  # file is hashed when all ranges are received
+                session.bar.update(session.stripe.resumed)
+                session.stripe.set_bar(session.bar)
+            elif offset > 0:  # resumed file
+                if session.hasher:
+                    hash_prefix(session.hasher, session.file_io, offset)
+                session.bar.update(offset)
 
-        if self._file_io and not self._read_only:
-            self._file_io.write(data)
-        self._bar.update(len(data))
-        self._md5.update(data)
+        if session.file_io and not self._read_only:
+            if session.stripe:
+                with session.stats.stage('write'):
+                    session.stripe.write(recv_size - len(data), data)
+                session.stats.count('pwrite')
+            elif session.writer:
+                # copy out of receive buffer, wait if writer is behind
+                with session.stats.stage('stall'):
+                    chunk = session.pool.acquire()
+                try:
+                    chunk.fill(data)
+                    if session.hasher:
+                        session.hasher.update(chunk)
+                    session.writer.put((session.file_io, chunk))
+                except Exception:
+                    chunk.release()
+                    raise
+            else:
+                with session.stats.stage('write'):
+                    session.file_io.write(data)
+                session.stats.count('write')
+                if session.hasher:
+                    session.hasher.update(data)
+        session.bar.update(len(data))
+        session.recv_size += len(data)
 
     def recv_finish_file(self, path, from_addr):
+        session = self.get_session(from_addr)
+        session.files += 1
         if self._drop_directory == '-':
-            self._file_io.flush()
+            if session.writer:
+                session.writer.put((session.file_io, None))
+            else:
+                session.file_io.flush()
         else:
-            if self._file_io:
-                self._file_io.close()
-                self._file_io = None
-                digest = self._md5.hexdigest()
-                self._bar.write('%s  %s' % (digest, path), file=sys.stderr)
-                self._md5 = None
+            if session.file_io:
+                name = os.path.join(self._drop_directory, path)
+                if session.stripe:
+                    self.finish_stripe(session, path, name)
+                elif session.writer:
+                    session.writer.put((session.file_io, name))
+                else:
+                    with session.stats.stage('file'):
+                        close_file(session.file_io, name)
+                session.file_io = None
+                if session.hasher:
+                    digest = session.hasher.hexdigest()
+                    session.bar.write('%s  %s' % (digest, path), file=sys.stderr)
+                else:
+                    session.bar.write('%s' % (path), file=sys.stderr)
             elif self._read_only:
                 pass
             else:   # directory
                 if not path.endswith(os.sep):
                     path += os.sep
-                self._bar.write('%s' % (path), file=sys.stderr)
+                session.bar.write('%s' % (path), file=sys.stderr)
+
+    def finish_stripe(self, session, path, name):
+        """wait for range connections of striped file, hash it from disk"""
+        stripe = session.stripe
+        with session.stats.stage('stall'):
+            stripe.wait(STRIPE_TIMEOUT)
+        if session.hasher:
+            hash_prefix(session.hasher, session.file_io, stripe.size)
+        with session.stats.stage('file'):
+            stripe.close(name)
+        self.release_stripe(session, path)
+
+    def release_stripe(self, session, path):
+        stripe = session.stripes.pop(path)
+        if session.stripe is stripe:
+            session.stripe = None
+            session.file_io = None
+        with self._sessions_lock:
+            for key, value in list(self._stripes.items()):
+                if value is stripe:
+                    del self._stripes[key]
+
+    def recv_max_streams(self, from_addr):
+        if self._drop_directory == '-' or self._read_only:
+            return 1
+        return self._max_streams
+
+    def recv_stripes(self, token, stripes, from_addr):
+        if self._drop_directory == '-' or self._read_only:
+            raise IOError('Parallel connections are not accepted')
+        session = self.get_session(from_addr)
+        for path, (size, ranges) in stripes.items():
+            name = self.drop_path(path)
+            part_name = self.claim_part_file(session, name, ranges[0][0])
+            stripe = session.stripes[path] = StripedFile(part_name, size, ranges)
+            with self._stripes_cond:
+                self._stripes[(token, path)] = stripe
+                self._stripes_cond.notify_all()
+
+    def recv_range(self, token, path, begin, count, from_addr):
+        with self._stripes_cond:
+            # range connection may be faster than accept of transfer
+            self._stripes_cond.wait_for(lambda: (token, path) in self._stripes, STRIPE_TIMEOUT)
+            stripe = self._stripes.get((token, path))
+        if stripe:
+            return stripe.range(begin, count)
+
+    def claim_part_file(self, session, name, offset):
+        """.part file which isn't written by other connection, until session finishes"""
+        part_name = name + PART_SUFFIX
+        with self._sessions_lock:
+            count = 0
+            while part_name in self._part_files:
+                if offset > 0:
+                    raise IOError('File is being received: %s' % part_name)
+                count += 1
+                part_name = '%s.%s%s' % (name, count, PART_SUFFIX)
+            self._part_files.add(part_name)
+        session.part_files.append(part_name)
+        return part_name
+
+    def release_part_files(self, session):
+        with self._sessions_lock:
+            self._part_files.difference_update(session.part_files)
+        session.part_files = []
+
+    def recv_part_file(self, path, from_addr):
+        if self._drop_directory == '-' or self._read_only:
+            return
+        return self.drop_path(path + PART_SUFFIX)
+
+    def recv_basis_file(self, path, from_addr):
+        if self._drop_directory == '-' or self._read_only:
+            return
+        return self.drop_path(path)
+
+    def drop_path(self, path):
+        """PATH of peer in drop directory, IOError if it, or a link in it, leads out"""
+        name = os.path.join(self._drop_directory, path)
+        if not in_directory(self._drop_directory, name):
+            raise IOError('Out of drop directory: %s' % path)
+        return name
+
+    def recv_hash_index(self, from_addr):
+        if self._drop_directory == '-' or self._read_only:
+            return
+        with self._sessions_lock:
+            if self._index is None or self._index.root != self._drop_directory:
+                self._index = HashIndex(self._drop_directory)
+            return self._index
+
+    def recv_same_file(self, path, digest, from_addr):
+        """hard link or copy the file which has DIGEST as PATH"""
+        session = self.get_session(from_addr)
+        index = self.recv_hash_index(from_addr)
+        source = index.find(digest) if index else None
+        if source is None:
+            raise IOError('File is not found: %s %s' % (digest, path))
+        name = self.drop_path(path)
+        if not (os.path.exists(name) and os.path.samefile(source, name)):
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            part_name = self.claim_part_file(session, name, 0)
+            with session.stats.stage('file'):
+                if os.path.lexists(part_name):
+                    os.remove(part_name)
+                link_file(source, part_name)
+                os.replace(part_name, name)
+            index.add(name, digest)
+        size = os.path.getsize(name)
+        session.files += 1
+        session.stats.skipped += size
+        logger.debug('%s is the same as %s' % (name, source))
+
+    def recv_flush(self, from_addr):
+        """wait for writer before reporting success, raise its error"""
+        session = self.get_session(from_addr)
+        if session.hasher:
+            hasher = session.hasher
+            session.hasher = None
+            hasher.close()
+        if session.writer:
+            writer = session.writer
+            session.writer = None
+            writer.close()
 
     def recv_finish(self, from_addr, err):
         """interrupt current transport and finish immediately"""
-        if self._bar is not None:
-            self._bar.close()
-            logger.info(err)
-            self._bar = None
+        with self._sessions_lock:
+            session = self._sessions.pop(from_addr, None)
+        if session is None:
+            return
+        for path, stripe in list(session.stripes.items()):
+            # keep data received from begin of file for resume
+            stripe.abort(ConnectionAbortedError('%s' % err))
+            try:
+                stripe.close()
+            except Exception as e:
+                logger.error('%s' % e)
+            self.release_stripe(session, path)
+        if session.hasher:
+            try:
+                session.hasher.close()
+            except Exception as e:
+                logger.error('%s' % e)
+            session.hasher = None
+        if session.writer:
+            try:
+                if session.file_io and session.file_io is not sys.stdout.buffer:
+                    session.writer.put((session.file_io, None))
+                    session.file_io = None
+                session.writer.close()
+            except Exception as e:
+                logger.error('%s' % e)
+            session.writer = None
+        if session.stdout_locked:
+            STDOUT_LOCK.release()
+        elif session.file_io:
+            try:
+                close_file(session.file_io)
+            except Exception as e:
+                logger.error('%s' % e)
+            session.file_io = None
+        self.release_part_files(session)
+        session.stats.files = session.files
+        session.stats.finish(err)
+        self.report_stats(session.stats)
+        if session.bar is not None:
+            session.bar.close()
+            logger.info('%s - %s' % (err, session))
+            session.bar = None
 
     def recv_feed_text(self, data, from_addr):
-        if not self._file_io:
-            self._file_io = io.BytesIO()
-        self._file_io.write(data)
+        session = self.get_session(from_addr)
+        if not session.file_io:
+            session.file_io = io.BytesIO()
+        session.file_io.write(data)
 
     def recv_finish_text(self, from_addr):
-        data = self._file_io.getvalue()
+        session = self.get_session(from_addr)
+        data = session.file_io.getvalue()
         text = data.decode('utf-8')
         logger.info('TEXT: %s' % text)
-        self._file_io.close()
-        self._file_io = None
+        session.file_io.close()
+        session.file_io = None
         return text
 
     def get_nodes(self):
@@ -170,72 +761,186 @@ class NetDropClient(NetDrop):
     _name = 'NdropClient'
     _transport = None
     _bar = None
-    _md5 = None
+    _hasher = None
+    _file = None
+    # write every sent file under process bar
+    _list_files = True
+    # err of last send_finish
+    result = None
+    # set by cancel() from other thread
+    _cancelled = False
 
-    def __init__(self, addr, mode=None, ssl_ck=None):
+    def __init__(self, addr, mode=None, ssl_ck=None, sendfile=True, hash_algorithm='md5', resume=False,
+                 stats_file=None, read_ahead=READ_AHEAD, streams=1, connections=CONNECTIONS, compress=None,
+                 delta=False, skip_same=False, limit_rate=0, engine='thread'):
         self.addr = addr
         self.mode = mode
-        if mode == 'dukto':
-            self._transport = dukto.DuktoClient(self, addr, ssl_ck=ssl_ck)
-        elif mode == 'nitroshare':
-            self._transport = nitroshare.NitroshareClient(self, addr, ssl_ck=ssl_ck)
+        self.engine = engine
+        self._hash_algorithm = hash_algorithm
+        self._limit_rate = limit_rate
+        # RateLimit of current transfer, shared by its connections
+        self._limit = None
+        self._stats = None
+        self._connections = connections
+        self._batches = None
+        self._retry_batches = []
+        self._workers = 0
+        self._batches_lock = threading.Lock()
+        self.init_stats(stats_file)
+        self._options = dict(
+            ssl_ck=ssl_ck, sendfile=sendfile, resume=resume, read_ahead=read_ahead, streams=streams,
+            compress=compress, delta=delta, skip_same=skip_same)
+        self._transport = self.create_transport(self)
+
+    def create_transport(self, upper_level):
+        coroutines = self.engine == 'asyncio'
+        if self.mode == 'dukto':
+            client = aio.AsyncDuktoClient if coroutines else dukto.DuktoClient
+        elif self.mode == 'nitroshare':
+            client = aio.AsyncNitroshareClient if coroutines else nitroshare.NitroshareClient
         else:
-            raise ValueError('unknown mode: %s' % mode)
+            raise ValueError('unknown mode: %s' % self.mode)
+        return client(upper_level, self.addr, **self._options)
 
     def __str__(self):
         return '%s [%s]' % (self.addr, self.mode)
 
     def send_files(self, files):
-        all_files = []
-        total_size = 0
-        for f in files:
-            abs_path = os.path.abspath(f)
-            base_path = os.path.dirname(abs_path)
-            rel_path = os.path.relpath(abs_path, base_path)
-
-            if os.path.isdir(abs_path):
-                size = -1
-            else:
-                size = os.path.getsize(abs_path)
-                total_size += size
-            all_files.append((abs_path, rel_path, size))
-
-            if size == -1:
-                for root, dirs, files in os.walk(abs_path):
-                    for name in dirs:
-                        sub_abs_path = os.path.join(root, name)
-                        rel_path = os.path.relpath(sub_abs_path, base_path)
-                        all_files.append((sub_abs_path, rel_path, -1))
-
-                    for name in files:
-                        sub_abs_path = os.path.join(root, name)
-                        rel_path = os.path.relpath(sub_abs_path, base_path)
-                        size = os.path.getsize(sub_abs_path)
-                        total_size += size
-                        all_files.append((sub_abs_path, rel_path, size))
+        total_size, all_files = scan_files(files)
 
+        self._limit = create_limit('send', self._limit_rate)
         # always create process bar
-        self._bar = self.init_bar(total_size)
-        self._transport.send_files(total_size, all_files)
+        self._bar = self.init_bar(total_size, self._limit)
+        self._stats = TransferStats('send', self.mode)
+        if self._connections > 1 and len(all_files) > 1:
+            self.send_batches(total_size, all_files)
+            return
+        self._hasher = create_hasher(self._hash_algorithm, stats=self._stats)
+        self._transport.send_files(total_size, all_files, stats=self._stats, limit=self._limit)
+
+    def send_shared(self, total_size, files, source):
+        """send FILES of NetDropFanOut, file data is from FanOutReader SOURCE"""
+        self._limit = create_limit('send', self._limit_rate)
+        self._bar = self.init_bar(total_size, self._limit)
+        self._stats = TransferStats('send', self.mode)
+        self._list_files = False
+        try:
+            self._transport.send_files(total_size, files, stats=self._stats, source=source, limit=self._limit)
+        finally:
+            source.detach()
+
+    def send_batches(self, total_size, files):
+        """send FILES by several connections, every one sends batches until none is left
+
+        batch is a standard transfer, so receiver needn't be ndrop. connection
+        which is idle takes next batch, a large file doesn't hold back others.
+        batch of failed connection is sent again by others, and the connection
+        quits, such as receiver which accepts one connection at a time.
+        """
+        self._batches = split_batches(files, total_size, self._connections)
+        self._retry_batches = []
+        workers = [SendWorker(self) for _ in range(self._connections)]
+        self._workers = len(workers)
+        err = 'done'
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            self.stop_batches()
+        for worker in workers:
+            self._stats.peer = self._stats.peer or worker.stats.peer
+            self._stats.merge(worker.stats)
+            if err == 'done' and worker.err is not None:
+                err = worker.err
+        self.send_finish(err)
+
+    def next_batch(self):
+        """(batch, tries) to send, None when worker should quit"""
+        with self._batches_lock:
+            if self._retry_batches:
+                return self._retry_batches.pop()
+            batch = next(self._batches, None)
+            if batch is None:
+                self._workers -= 1
+                return None
+            return batch, 0
+
+    def retry_batch(self, batch, tries):
+        """put BATCH of failed worker back
+
+        return True if the worker sends it again as the last one, False if
+        the worker quits, None if it failed too many times.
+        """
+        with self._batches_lock:
+            if tries >= BATCH_RETRIES:
+                self._workers -= 1
+                return None
+            self._retry_batches.append((batch, tries + 1))
+            if self._workers > 1:
+                self._workers -= 1
+                return False
+            return True
+
+    def stop_batches(self):
+        with self._batches_lock:
+            self._batches = iter(())
+            self._retry_batches = []
+
+    def cancel(self):
+        """interrupt transfer from other thread, it finishes with ConnectionAbortedError"""
+        self._cancelled = True
+        if self._batches is not None:
+            self.stop_batches()
+
+    def check_cancelled(self):
+        if self._cancelled:
+            raise ConnectionAbortedError('Cancelled')
 
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        # raised into pack_files, transport aborts connection
+        self.check_cancelled()
         if file_size > -1:
-            if not self._md5:  # one md5 every file
-                self._md5 = hashlib.md5()
+            self._file = path
             self._bar.update(len(data))
-            self._md5.update(data)
+            if self._hasher and data:
+                # FileRange is read by hasher, its file is open until send_finish_file
+                self._hasher.update(data)
 
     def send_finish_file(self, path):
-        if self._md5:  # file
-            digest = self._md5.hexdigest()
-            self._md5 = None
-            self._bar.write('%s  %s' % (digest, path), file=sys.stderr)
-        else:  # directory
+        if self._file:  # file
+            self._file = None
+            self._stats.files += 1
+            if self._hasher:
+                digest = self._hasher.hexdigest()
+                self._bar.write('%s  %s' % (digest, path), file=sys.stderr)
+            elif self._list_files:
+                self._bar.write('%s' % (path), file=sys.stderr)
+        elif self._list_files:  # directory
             if not path.endswith(os.sep):
                 path += os.sep
             self._bar.write('%s' % (path), file=sys.stderr)
 
+    def send_same_file(self, path, file_size):
+        self._bar.update(file_size)
+        self._stats.files += 1
+        self._stats.skipped += file_size
+        if self._list_files:
+            self._bar.write('%s  (same)' % path, file=sys.stderr)
+
     def send_finish(self, err):
+        self.result = err
+        if self._hasher:
+            try:
+                self._hasher.close()
+            except Exception as e:
+                logger.error('%s' % e)
+            self._hasher = None
+        if self._stats is not None:
+            self._stats.finish(err)
+            self.report_stats(self._stats)
+            self._stats = None
         if self._bar is not None:
             self._bar.close()
             logger.info(err)
@@ -244,3 +949,166 @@ class NetDropClient(NetDrop):
     def send_text(self, text):
         logger.info('Send TEXT...')
         self._transport.send_text(text)
+
+
+def parse_destination(dest, mode=None):
+    """(mode, addr) of "[mode://]ip[:port]", MODE if it has no mode"""
+    if '://' in dest:
+        mode, dest = dest.split('://', 1)
+    return mode, dest
+
+
+class NetDropFanOut(NetDrop):
+    """send the same files to several receivers at the same time, every file is read once
+
+    clients: NetDropClient of every receiver, mixed Dukto and NitroShare.
+    receiver which fails is dropped, others go on.
+    """
+    _name = 'NdropFanOut'
+
+    def __init__(self, clients, hash_algorithm='md5', read_ahead=READ_AHEAD):
+        self._clients = clients
+        for client in clients:
+            client._desc = client._desc or '%s' % client
+        self._hash_algorithm = hash_algorithm
+        self._read_ahead = read_ahead
+        self.summary = []
+
+    def write(self, message):
+        tqdm.write(message, file=sys.stderr)
+
+    def send_files(self, files):
+        total_size, all_files = scan_files(files)
+        hasher = create_hasher(self._hash_algorithm)
+        fanout = FanOut(
+            all_files, len(self._clients), self._read_ahead, hasher=hasher,
+            on_file=self.finish_file)
+        threads = []
+        for client, source in zip(self._clients, fanout.readers):
+            thread = threading.Thread(
+                name='Ndrop client', target=client.send_shared, args=(total_size, all_files, source))
+            thread.start()
+            threads.append(thread)
+        fanout.start()
+        for thread in threads:
+            thread.join()
+        fanout.join()
+        if hasher:
+            hasher.close()
+        self.report_summary()
+
+    def cancel(self):
+        """interrupt sending to all receivers from other thread"""
+        for client in self._clients:
+            client.cancel()
+
+    def finish_file(self, name, digest):
+        """called by FanOut when data of file is read"""
+        if digest:
+            self.write('%s  %s' % (digest, name))
+        else:
+            self.write('%s' % name)
+
+    def send_text(self, text):
+        for client in self._clients:
+            client.send_text(text)
+        self.report_summary()
+
+    def report_summary(self):
+        """log result of every receiver, summary is [(client, result, record)]"""
+        self.summary = []
+        for client in self._clients:
+            record = client.transfer_stats[-1] if client.transfer_stats else None
+            self.summary.append((client, client.result, record))
+            if record is None:
+                logger.info('%s - %s' % (client, client.result))
+            else:
+                logger.info('%s - %s, %s in %.2fs' % (
+                    client, client.result, human_size(record['bytes']), record['wall']))
+        return self.summary
+
+
+class SendWorker(NetDropClient):
+    """one connection of NetDropClient.send_batches, with file state and stats of its own"""
+    def __init__(self, client):
+        # one connection, records of stats are made by client
+        super().__init__(
+            client.addr, mode=client.mode, hash_algorithm=client._hash_algorithm, connections=1,
+            limit_rate=client._limit_rate, engine=client.engine, **client._options)
+        self._client = client
+        self._bar = client._bar
+        self._limit = client._limit
+        self._stats = TransferStats('send', client.mode)
+        self._hasher = create_hasher(client._hash_algorithm, stats=self._stats)
+        self._thread = threading.Thread(target=self.run, name='Ndrop sender', daemon=True)
+        self.stats = self._stats
+        self.err = None
+        self._sent_size = 0
+        self._sent_files = 0
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def run(self):
+        try:
+            while True:
+                item = self._client.next_batch()
+                if item is None:
+                    break
+                batch, tries = item
+                total_size = sum(size for path, name, size in batch if size > 0)
+                self._sent_size = 0
+                self._sent_files = 0
+                self._transport.send_files(total_size, batch, stats=self._stats, limit=self._limit)
+                if self.err is None:
+                    continue
+                if self._client._cancelled:
+                    break
+                # progress of batch is counted again by other worker
+                self._bar.update(-self._sent_size)
+                self._stats.files -= self._sent_files
+                if self._file:  # drop digest of unfinished file
+                    self._file = None
+                    if self._hasher:
+                        self._hasher.hexdigest()
+                retry = self._client.retry_batch(batch, tries)
+                if retry is None:
+                    self._client.stop_batches()
+                    break
+                logger.info('%s - send %s files again' % (self.err, len(batch)))
+                self.err = None
+                if not retry:
+                    break
+        finally:
+            if self._hasher:
+                try:
+                    self._hasher.close()
+                except Exception as e:
+                    logger.error('%s' % e)
+                self._hasher = None
+
+    def check_cancelled(self):
+        self._client.check_cancelled()
+
+    def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        if file_size > 0 and data:
+            self._sent_size += len(data)
+        super().send_feed_file(path, data, send_size, file_size, total_send_size, total_size)
+
+    def send_finish_file(self, path):
+        if self._file:
+            self._sent_files += 1
+        super().send_finish_file(path)
+
+    def send_same_file(self, path, file_size):
+        self._sent_size += file_size
+        self._sent_files += 1
+        super().send_same_file(path, file_size)
+
+    def send_finish(self, err):
+        """end of one batch"""
+        if '%s' % err != 'done':
+            self.err = err
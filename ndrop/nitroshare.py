@@ -4,15 +4,21 @@ import time
 import logging
 import os.path
 import threading
+import itertools
 import socket
 import socketserver
 import struct
-import ssl
 import platform
 import uuid
 import json
 
-from .transport import Transport, get_broadcast_address, CHUNK_SIZE, set_chunk_size
+from .stats import TransferStats
+from .transport import Transport, ThreadingTCPServer, RecvHandler, StreamBuffer, FileRange, BufferList, \
+    get_broadcast_address, local_name, ext_offer, StripeSender, create_ssl_context, tls_mode, can_sendfile, send_chunks, \
+    encode_chunks, skip_files, tls_sessions, set_socket_buffer, ChunkTuner, SENDFILE_MIN_SIZE, SENDFILE_CHUNK_SIZE
+from .pipeline import ReadAhead, READ_AHEAD_SIZE
+from .compress import FrameEncoder, offer_codecs
+from .delta import Copy
 from .about import get_system_symbol
 
 
@@ -31,6 +37,7 @@ STATUS = {
 
 class Packet():
     _status = STATUS['idle']
+    resume = None
     _record = 0
     _recv_record = 0
     _total_size = 0
@@ -38,6 +45,7 @@ class Packet():
     _filename = None
     _filesize = 0
     _recv_file_size = 0
+    _packet_size = 0
 
     def pack_hello(self, node, dest):
         hello_node = {}
@@ -85,8 +93,33 @@ class Packet():
         data.extend(bdata)
         return data
 
-    def pack_files(self, agent, total_size, files):
-        data = bytearray()
+    def _chunk_size(self, pending, chunk_size):
+        """data size of next binary packet, every binary packet fits in a chunk
+
+        pending: length of buffered data, that is not yielded yet
+        chunk_size: of connection, see ChunkTuner
+        """
+        size = chunk_size - pending - 5
+        # a long file header may fill whole chunk
+        return size if size > 0 else chunk_size - 5
+
+    def pack_files(self, agent, total_size, files, sendfile=False, resume=None, stats=None, read_ahead=0,
+                   source=None, compress=None, delta=None, tuner=None):
+        """sendfile: yield FileRange for file data instead of reading it
+        resume: {name: offset}, data before offset is in .part file of receiver
+        read_ahead: count of buffers read by ReadAhead thread, 0 to read in this thread
+        source: FanOutReader, file data read once for several receivers
+        compress: FrameEncoder, its sample of file decides whether data is compressed,
+            only raw data is sent by sendfile
+        delta: {name: Basis}, data which receiver has in basis file is sent as Copy
+        stats: TransferStats, time of reading file is 'read'
+        tuner: ChunkTuner of connection, size of data read and sent at a time
+        """
+        stats = stats or TransferStats('send')
+        tuner = tuner or ChunkTuner()
+        data = BufferList(tuner.size)
+        # buffer length if all data is yielded in chunks, decides packet size
+        pending = 0
         total_send_size = 0
         transfer_abort = False
         for path, name, size in files:
@@ -106,9 +139,8 @@ class Packet():
             # packet format
             # L    B   B * (size - 1)
             # size tag data
-            data.extend((len(bdata) + 1).to_bytes(4, byteorder='little', signed=True))
-            data.append(0x02)
-            data.extend(bdata)
+            data.append(struct.pack('<lb', len(bdata) + 1, 0x02) + bdata)
+            pending += len(bdata) + 5
             send_size = 0
 
             if size < 0:    # directory
@@ -124,86 +156,178 @@ class Packet():
             else:
                 file_changed = False
                 with open(path, 'rb') as f:
-                    while not file_changed:
-                        chunk = f.read(CHUNK_SIZE - len(data) - 5)
-                        if not chunk:
-                            break
-                        if (send_size + len(chunk)) > size:
-                            file_changed = True
-                            # correct size
-                            chunk = chunk[:size - send_size]
-                            logger.error('File Changed: [%s] %s => %s.' % (name, size, send_size))
-                            cont = input('Drop data and continue? [Yes/No]')
-                            if cont != 'Yes':
-                                transfer_abort = True
-                        # binary header, every binary packet is less than CHUNK_SIZE
-                        data.extend((len(chunk) + 1).to_bytes(4, byteorder='little', signed=True))
-                        data.append(0x03)
-                        send_size += len(chunk)
-                        total_send_size += len(chunk)
-                        agent.send_feed_file(
-                            name, chunk,
-                            send_size, size, total_send_size, total_size,
-                        )
-                        data.extend(chunk)
-                        # send if packet_size more than chunk_size
-                        if len(data) >= CHUNK_SIZE:
-                            yield data[:CHUNK_SIZE]
-                            del data[:CHUNK_SIZE]
-            agent.send_finish_file(name)
+                    if resume and name in resume:
+                        # skipped data is only passed to agent for progress and hash
+                        offset = resume[name]
+                        while send_size < offset:
+                            chunk = FileRange(f, send_size, min(SENDFILE_CHUNK_SIZE, offset - send_size))
+                            send_size += len(chunk)
+                            total_send_size += len(chunk)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                        f.seek(send_size)
+                    packing = compress.start_file(f, send_size, size) if compress else False
+                    basis = delta.get(name) if delta else None
+                    if basis:
+                        # receiver copies data of its basis file, packet header is sent
+                        for piece in basis.match(f, send_size, size, tuner.size - 5, SENDFILE_CHUNK_SIZE):
+                            data.append(struct.pack('<lb', len(piece) + 1, 0x03))
+                            if isinstance(piece, Copy):
+                                # sent data is hashed from the same range of file
+                                chunk = FileRange(f, send_size, len(piece))
+                                yield data
+                                data = BufferList(tuner.size)
+                                yield piece
+                            else:
+                                chunk = piece
+                                data.append(piece)
+                            pending = (pending + len(piece) + 5) % tuner.size
+                            send_size += len(piece)
+                            total_send_size += len(piece)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                            if data.full():
+                                yield data
+                                data = BufferList(tuner.size)
+                        # check whether file grows as below
+                        f.seek(send_size)
+                    elif sendfile and not packing and size >= SENDFILE_MIN_SIZE and \
+                            os.fstat(f.fileno()).st_size == size:
+                        # binary header from buffer, packet data by os.sendfile
+                        while send_size < size:
+                            count = min(self._chunk_size(pending, tuner.size), size - send_size)
+                            data.append(struct.pack('<lb', count + 1, 0x03))
+                            chunk = FileRange(f, send_size, count, b''.join(data))
+                            data = BufferList(tuner.size)
+                            pending += count + 5
+                            if pending >= tuner.size:
+                                pending -= tuner.size
+                            send_size += count
+                            total_send_size += count
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                            yield chunk
+                        # check whether file grows as below
+                        f.seek(send_size)
+                    reader = source
+                    if reader is None and read_ahead and size - send_size > READ_AHEAD_SIZE:
+                        reader = ReadAhead(f, read_ahead, stats=stats)
+                    try:
+                        while not file_changed:
+                            if reader:
+                                chunk = reader.read(self._chunk_size(pending, tuner.size))
+                            else:
+                                with stats.stage('read'):
+                                    chunk = f.read(self._chunk_size(pending, tuner.size))
+                                stats.count('read')
+                            if not chunk:
+                                break
+                            if (send_size + len(chunk)) > size:
+                                file_changed = True
+                                # correct size
+                                chunk = chunk[:size - send_size]
+                                logger.error('File Changed: [%s] %s => %s.' % (name, size, send_size))
+                                cont = input('Drop data and continue? [Yes/No]')
+                                if cont != 'Yes':
+                                    transfer_abort = True
+                            # binary header, every binary packet is less than chunk size
+                            data.append(struct.pack('<lb', len(chunk) + 1, 0x03))
+                            send_size += len(chunk)
+                            total_send_size += len(chunk)
+                            agent.send_feed_file(
+                                name, chunk,
+                                send_size, size, total_send_size, total_size,
+                            )
+                            # buffer of reader is sent by reference
+                            data.append(chunk.view if reader else chunk)
+                            pending += len(chunk) + 5
+                            # send if packet_size more than chunk_size
+                            if pending >= tuner.size:
+                                pending -= tuner.size
+                            if data.full():
+                                yield data
+                                data = BufferList(tuner.size)
+                                if reader:
+                                    reader.recycle()
+                    finally:
+                        if reader:
+                            reader.close()
+                    # before closing file, FileRange may be read for hash
+                    agent.send_finish_file(name)
+            if size <= 0:
+                agent.send_finish_file(name)
             if transfer_abort:
                 break
-        if len(data) > 0:
+            if data.full():
+                yield data
+                data = BufferList(tuner.size)
+        if data:
             yield data
-            data.clear()
         if transfer_abort:
             sys.exit('Transfer Abort!!!')
 
+    def unpack_packet(self, data):
+        """return (type, payload) of a whole packet, or None to wait for more data"""
+        if len(data) < 5:
+            return
+        size, typ = struct.unpack('<lb', data.peek(5))
+        if len(data) < 4 + size:
+            return
+        data.read(5)
+        return typ, data.read(size - 1)
+
     def unpack_tcp(self, agent, data, from_addr):
+        """data: StreamBuffer, file data is passed to agent as memoryview"""
         while len(data) > 0:
             if self._status == STATUS['idle']:  # transfer header
-                size, typ = struct.unpack('<lb', data[:5])
-                size -= 1
-                if size > len(data):
+                packet = self.unpack_packet(data)
+                if not packet:
                     return
-                del data[:5]
-                if size == 0 and typ == 0x00:
+                typ, payload = packet
+                if typ == 0x00:
                     return
-                elif size > 0 and typ == 0x01:
-                    message = data[:size].decode('utf-8')
-                    del data[:size]
+                elif typ == 0x01:
+                    message = str(payload, 'utf-8')
                     logger.info('Error: %s' % message)
                     return
                 elif typ == 0x02:   # json, transfer header
-                    jdata = json.loads(data[:size])
-                    del data[:size]
+                    jdata = json.loads(bytes(payload))
                     if 'count' not in jdata:
                         raise ValueError('Error: %s' % jdata)
                     self._total_size = int(jdata['size'])
                     self._record = int(jdata['count'])
+                    if self._record == 0:
+                        # ndrop sender skipped all files, receiver has them
+                        return True
                     self._status = STATUS['header']
             elif self._status == STATUS['header']:  # json, file header
-                size, typ = struct.unpack('<lb', data[:5])
-                size -= 1
-                if size > len(data):
+                packet = self.unpack_packet(data)
+                if not packet:
                     return
-                del data[:5]
+                typ, payload = packet
                 if typ == 0x02:   # json
-                    jdata = json.loads(data[:size])
-                    del data[:size]
+                    jdata = json.loads(bytes(payload))
                     if 'directory' not in jdata:  # file header
                         raise ValueError('Error: %s' % jdata)
                     self._recv_file_size = 0
-                    if sys.platform == 'win32':
-                        self._filename = jdata['name'].replace('/', '\\')
-                    else:
-                        self._filename = jdata['name'].replace('\\', '/')
+                    self._filename = local_name(jdata['name'])
                     if jdata['directory']:  # directory
                         self._filesize = -1
                     else:
                         self._filesize = int(jdata['size'])
 
                     if self._filesize > 0:
+                        if self.resume and self._filename in self.resume:
+                            # data before offset is in .part file, sender skips it
+                            self._recv_file_size = self.resume.pop(self._filename)
+                            self._total_recv_size += self._recv_file_size
+                        self._packet_size = 0
                         self._status = STATUS['data']
                     else:
                         if self._filesize < 0:
@@ -227,30 +351,32 @@ class Packet():
                 else:
                     raise ValueError('Error Type: %s' % typ)
             elif self._status == STATUS['data']:
-                size, typ = struct.unpack('<lb', data[:5])
-                data_size = size - 1
-                if data_size > (len(data) - 5):    # wait for more packet data
-                    return
-                if typ == 0x03:   # data
-                    self._recv_file_size += data_size
-                    self._total_recv_size += data_size
-                    agent.recv_feed_file(
-                        self._filename, data[5:5 + data_size],
-                        self._recv_file_size, self._filesize,
-                        self._total_recv_size, self._total_size,
-                        from_addr,
-                    )
-                    del data[:5 + data_size]
-                    if self._recv_file_size == self._filesize:
-                        self._status = STATUS['header']
-                        self._recv_record += 1
-                        agent.recv_finish_file(self._filename, from_addr)
-                    if self._record == self._recv_record and  \
-                            self._total_recv_size == self._total_size:
-                        self._status = STATUS['idle']
-                        return True
-                else:
-                    raise ValueError('Error Type: %s' % typ)
+                if self._packet_size == 0:  # binary header
+                    if len(data) < 5:
+                        return
+                    size, typ = struct.unpack('<lb', data.read(5))
+                    if typ != 0x03:
+                        raise ValueError('Error Type: %s' % typ)
+                    self._packet_size = size - 1
+                # pass packet data as it arrives, don't wait for whole packet
+                chunk = data.read(self._packet_size)
+                self._packet_size -= len(chunk)
+                self._recv_file_size += len(chunk)
+                self._total_recv_size += len(chunk)
+                agent.recv_feed_file(
+                    self._filename, chunk,
+                    self._recv_file_size, self._filesize,
+                    self._total_recv_size, self._total_size,
+                    from_addr,
+                )
+                if self._recv_file_size == self._filesize:
+                    self._status = STATUS['header']
+                    self._recv_record += 1
+                    agent.recv_finish_file(self._filename, from_addr)
+                if self._record == self._recv_record and  \
+                        self._total_recv_size == self._total_size:
+                    self._status = STATUS['idle']
+                    return True
 
 
 class UDPHandler(socketserver.BaseRequestHandler):
@@ -263,36 +389,20 @@ class UDPHandler(socketserver.BaseRequestHandler):
             self._packet.unpack_udp(self.server.agent, data, self.client_address)
 
 
-class TCPHandler(socketserver.BaseRequestHandler):
-    def setup(self):
-        self._recv_buff = bytearray()
-        self._packet = Packet()
-        self.request.settimeout(20)
+class TCPHandler(RecvHandler):
+    _name = 'NitroShare'
+    _packet_class = Packet
 
-    def handle(self):
-        logger.info('[NitroShare] connect from %s:%s' % self.client_address)
-        err = ''
-        while True:
-            try:
-                data = self.request.recv(CHUNK_SIZE)
-                if not data:
-                    err = 'abort'
-                    break
-                self._recv_buff.extend(data)
-                ret = self._packet.unpack_tcp(self.server.agent, self._recv_buff, self.client_address)
-            except Exception as e:
-                err = e
-                logger.error('%s' % err)
-                break
-            if ret:
-                data = self._packet.pack_success()
-                self.request.sendall(data)
-                err = 'done'
-                break
-        self.server.agent.recv_finish(self.client_address, err)
+    def finish_transfer(self):
+        data = self._packet.pack_success()
+        self.request.sendall(data)
 
-    def finish(self):
-        pass
+    def abort_transfer(self, err):
+        data = self._packet.pack_error('%s' % err)
+        try:
+            self.request.sendall(data)
+        except OSError:
+            pass
 
 
 class NitroshareServer(Transport):
@@ -314,7 +424,7 @@ class NitroshareServer(Transport):
     _loop_hello = True
     _hello_interval = 2
 
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    def __init__(self, upper_level, addr, ssl_ck=None, sessions=None):
         if ssl_ck:
             self._cert, self._key = ssl_ck
         self._upper_level = upper_level
@@ -337,24 +447,26 @@ class NitroshareServer(Transport):
         self._node = data
 
         self._nodes = {}
-        self._udp_server = socketserver.UDPServer((ip, self._udp_port), UDPHandler)
-        self._udp_server.agent = self
-
-        self._tcp_server = socketserver.TCPServer((ip, self._tcp_port), TCPHandler)
+        ssl_context = None
         if self._cert and self._key:
-            self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            self._ssl_context.load_cert_chain(self._cert, keyfile=self._key)
-            self._tcp_server.socket = self._ssl_context.wrap_socket(
-                self._tcp_server.socket, server_side=True)
-        self._tcp_server.agent = self
-        set_chunk_size()
+            ssl_context = create_ssl_context(True, self._cert, self._key)
+        self.create_servers(ip, sessions, ssl_context)
 
         self._unicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self._ip_addrs, self._broadcasts = get_broadcast_address(ip)
 
-    def wait_for_request(self):
+    def create_servers(self, ip, sessions=None, ssl_context=None):
+        """bind UDP and TCP servers, they serve from wait_for_request"""
+        self._udp_server = socketserver.UDPServer((ip, self._udp_port), UDPHandler)
+        self._udp_server.agent = self
+        self._tcp_server = ThreadingTCPServer(
+            (ip, self._tcp_port), TCPHandler,
+            sessions=sessions, ssl_context=ssl_context)
+        self._tcp_server.agent = self
+
+    def start_servers(self):
         threading.Thread(
             name='nitroshare server',
             target=self._udp_server.serve_forever,
@@ -366,6 +478,12 @@ class NitroshareServer(Transport):
             daemon=True,
         ).start()
 
+    def stop_servers(self):
+        self._udp_server.shutdown()
+
+    def wait_for_request(self):
+        self.start_servers()
+
         if self._tcp_server.server_address[0] == '0.0.0.0':
             logger.info('[NitroShare] listen on %s:%s(tcp):%s(udp) - bind on %s' % (
                 self._tcp_server.server_address[0], self._tcp_server.server_address[1],
@@ -383,7 +501,7 @@ class NitroshareServer(Transport):
 
     def quit_request(self):
         self._loop_hello = False
-        self._udp_server.shutdown()
+        self.stop_servers()
 
     def fileno(self):
         return self._tcp_server.fileno()
@@ -395,9 +513,39 @@ class NitroshareServer(Transport):
             path, data,
             recv_size, file_size, total_recv_size, total_size, from_addr)
 
+    def recv_start(self, from_addr):
+        return self._upper_level.recv_start(from_addr)
+
+    def recv_limit(self, from_addr):
+        return self._upper_level.recv_limit(from_addr)
+
+    def recv_flush(self, from_addr):
+        self._upper_level.recv_flush(from_addr)
+
     def recv_finish_file(self, path, from_addr):
         self._upper_level.recv_finish_file(path, from_addr)
 
+    def recv_part_file(self, path, from_addr):
+        return self._upper_level.recv_part_file(path, from_addr)
+
+    def recv_basis_file(self, path, from_addr):
+        return self._upper_level.recv_basis_file(path, from_addr)
+
+    def recv_hash_index(self, from_addr):
+        return self._upper_level.recv_hash_index(from_addr)
+
+    def recv_same_file(self, path, digest, from_addr):
+        return self._upper_level.recv_same_file(path, digest, from_addr)
+
+    def recv_max_streams(self, from_addr):
+        return self._upper_level.recv_max_streams(from_addr)
+
+    def recv_stripes(self, token, stripes, from_addr):
+        self._upper_level.recv_stripes(token, stripes, from_addr)
+
+    def recv_range(self, token, path, begin, count, from_addr):
+        return self._upper_level.recv_range(token, path, begin, count, from_addr)
+
     def recv_finish(self, from_addr, err):
         self._upper_level.recv_finish(from_addr, err)
 
@@ -422,10 +570,13 @@ class NitroshareServer(Transport):
             except Exception as err:
                 logger.error('[NitroShare]send to "%s" error: %s' % (dest, err))
 
+    def hello(self):
+        self.say_hello(('<broadcast>', self._udp_port))
+        self.check_node()
+
     def loop_say_hello(self):
         while self._loop_hello:
-            self.say_hello(('<broadcast>', self._udp_port))
-            self.check_node()
+            self.hello()
             time.sleep(self._hello_interval)
 
     def add_node(self, ip, node):
@@ -477,10 +628,25 @@ class NitroshareClient(Transport):
     _upper_level = None
     _packet = None
     _timeout = 5
-
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    _sendfile = True
+    _resume = False
+    _read_ahead = 0
+    _streams = 1
+    _compress = None
+    _delta = False
+    _skip_same = False
+
+    def __init__(self, upper_level, addr, ssl_ck=None, sendfile=True, resume=False, read_ahead=0, streams=1,
+                 compress=None, delta=False, skip_same=False):
         if ssl_ck:
             self._cert, self._key = ssl_ck
+        self._sendfile = sendfile
+        self._resume = resume
+        self._read_ahead = read_ahead
+        self._streams = streams
+        self._compress = compress
+        self._delta = delta
+        self._skip_same = skip_same
         self._upper_level = upper_level
         addr = addr.split(':')
         ip = addr.pop(0)
@@ -490,33 +656,69 @@ class NitroshareClient(Transport):
             tcp_port = DEFAULT_TCP_PORT
         self._address = (ip, tcp_port)
         self._packet = Packet()
-        set_chunk_size()
 
-    def send_files(self, total_size, files):
+    def connect(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_socket_buffer(sock, socket.SO_SNDBUF)
+        if self._cert and self._key:
+            sock = tls_sessions.wrap_socket(sock, self._address)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._address)
+        except Exception:
+            sock.close()
+            raise
         if self._cert and self._key:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            sock = ssl_context.wrap_socket(sock, server_side=False)
+            logger.info('[NitroShare] %s:%s - %s' % (self._address + (tls_mode(sock), )))
+        return sock
 
+    def send_files(self, total_size, files, stats=None, source=None, limit=None):
         uname = platform.uname()
-        sock.settimeout(self._timeout)
+        stats = stats or TransferStats('send')
+        stats.peer = self._address
+        sock = None
+        stripes = None
         err = 'done'
         try:
+            sock = self.connect()
+            resume = None
+            compress = None
+            delta = None
+            if self._resume or self._streams > 1 or self._compress or self._delta or self._skip_same:
+                codecs = offer_codecs(self._compress) if self._compress else None
+                with stats.stage('resume'):
+                    ext = ext_offer(
+                        sock, files, self._timeout, resume=self._resume, streams=self._streams, compress=codecs,
+                        delta=self._delta and source is None, check=self._skip_same and source is None)
+                if ext is None:
+                    logger.info('[NitroShare] %s:%s - not ndrop, send all files in one connection' % self._address)
+                    tls_sessions.close(sock, self._address)
+                    sock = self.connect()
+                else:
+                    resume, ranges, token, streams, codec, delta, skipped = ext
+                    if skipped:
+                        total_size, files = skip_files(self, total_size, files, skipped)
+                    if codec or delta:
+                        compress = FrameEncoder(codec, stats)
+                    if ranges:
+                        stripes = StripeSender(
+                            self.connect, token, ranges, streams - 1, sendfile=self._sendfile, stats=stats,
+                            limit=limit)
             header = self._packet.pack_files_header(uname.node, total_size, len(files))
-            sock.connect(self._address)
-            sock.sendall(header)
-
-            for chunk in self._packet.pack_files(self, total_size, files):
-                sock.sendall(chunk)
+            zero_copy = self._sendfile and can_sendfile(sock) and source is None
+            tuner = ChunkTuner(sock)
+            chunks = itertools.chain([header], self._packet.pack_files(
+                self, total_size, files, sendfile=zero_copy, resume=resume, stats=stats,
+                read_ahead=self._read_ahead, source=source, compress=compress, delta=delta, tuner=tuner))
+            if compress:
+                chunks = encode_chunks(chunks, compress)
+            send_chunks(sock, chunks, stats, tuner, limit)
+            if stripes:
+                stripes.join()
             # receive feedback message
-            data = bytearray()
-            while True:
-                chunk = sock.recv(CHUNK_SIZE)
-                if not chunk:
-                    break
-                data.extend(chunk)
+            data = StreamBuffer(tuner.size)
+            while data.recv_into(sock):
+                pass
             self._packet.unpack_tcp(self, data, self._address)
         except KeyboardInterrupt:
             pass
@@ -526,7 +728,10 @@ class NitroshareClient(Transport):
         except Exception as e:
             err = e
             logger.error(err)
-        sock.close()
+        if stripes:
+            stripes.stop()
+        if sock:
+            tls_sessions.close(sock, self._address)
         self.send_finish(err)
 
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
@@ -535,5 +740,8 @@ class NitroshareClient(Transport):
     def send_finish_file(self, path):
         self._upper_level.send_finish_file(path)
 
+    def send_same_file(self, path, file_size):
+        self._upper_level.send_same_file(path, file_size)
+
     def send_finish(self, err):
         self._upper_level.send_finish(err)
@@ -0,0 +1,506 @@
+import os
+import queue
+import threading
+import logging
+import hashlib
+
+from .transport import FileRange
+from .stats import TransferStats
+
+
+logger = logging.getLogger(__name__)
+
+
+class Chunk(object):
+    """reusable buffer shared by stages, return to pool when all stages release it"""
+    __slots__ = ('pool', 'buff', 'size', 'refs')
+
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.buff = bytearray(size)
+        self.size = 0
+        self.refs = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def view(self):
+        return memoryview(self.buff)[:self.size]
+
+    def fill(self, data):
+        size = len(data)
+        if size > len(self.buff):
+            self.buff = bytearray(size)
+        self.buff[:size] = data
+        self.size = size
+
+    def retain(self):
+        self.pool.retain(self)
+        return self
+
+    def release(self):
+        self.pool.release(self)
+
+
+class ChunkView(object):
+    """part of a Chunk, retain() and release() keep the whole chunk"""
+    __slots__ = ('chunk', 'start', 'stop')
+
+    def __init__(self, chunk, start, stop):
+        self.chunk = chunk
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(len(self))
+        return ChunkView(self.chunk, self.start + start, self.start + max(start, stop))
+
+    @property
+    def view(self):
+        return memoryview(self.chunk.buff)[self.start:self.stop]
+
+    def retain(self):
+        self.chunk.retain()
+        return self
+
+    def release(self):
+        self.chunk.release()
+
+
+class ChunkPool(object):
+    """at most COUNT chunks, acquire() blocks until a chunk is released.
+
+    it gives backpressure to producer when consumer is slow.
+    """
+    def __init__(self, count, size):
+        self._count = count
+        self._size = size
+        self._created = 0
+        self._free = []
+        self._cond = threading.Condition()
+
+    def acquire(self, data=None):
+        """get a free chunk, copy DATA into it"""
+        with self._cond:
+            while not self._free:
+                if self._created < self._count:
+                    self._created += 1
+                    self._free.append(Chunk(self, self._size))
+                    break
+                self._cond.wait()
+            chunk = self._free.pop()
+            chunk.refs = 1
+        if data is not None:
+            chunk.fill(data)
+        return chunk
+
+    def retain(self, chunk):
+        with self._cond:
+            chunk.refs += 1
+
+    def release(self, chunk):
+        with self._cond:
+            chunk.refs -= 1
+            if chunk.refs == 0:
+                self._free.append(chunk)
+                self._cond.notify()
+
+
+class Stage(threading.Thread):
+    """handle items of a bounded queue on its own thread.
+
+    the first error stops handling, following items are only done().
+    error is raised to producer by put() and close().
+    stats: TransferStats, producer waiting for stage is counted as 'stall'
+    """
+    def __init__(self, name, maxsize=0, stats=None):
+        super().__init__(name=name, daemon=True)
+        self._queue = queue.Queue(maxsize)
+        self.error = None
+        self.stats = stats or TransferStats(name)
+        self.start()
+
+    def put(self, item):
+        """block if queue is full"""
+        if self.error:
+            raise self.error
+        with self.stats.stage('stall'):
+            self._queue.put(item)
+
+    def close(self):
+        """wait for all items"""
+        with self.stats.stage('stall'):
+            self._queue.put(None)
+            self.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if self.error is None:
+                    self.handle(item)
+            except Exception as err:
+                logger.debug('%s: %s' % (self.name, err))
+                self.error = err
+            finally:
+                self.done(item)
+
+    def handle(self, item):
+        pass
+
+    def done(self, item):
+        """always called, release resource of item"""
+        pass
+
+
+READ_AHEAD_SIZE = 1024 * 1024
+
+
+class ReadAhead(threading.Thread):
+    """read file on its own thread into DEPTH reused buffers, while the socket
+    sends previous ones. it starts from current position of file.
+
+    data of read() is valid until recycle(), call it when the data is sent.
+    stats: TransferStats, reading is 'read', waiting for reader is 'stall'
+    """
+    def __init__(self, file, depth, size=READ_AHEAD_SIZE, stats=None):
+        super().__init__(name='Ndrop reader', daemon=True)
+        self._file = file
+        # data of one yield may be in two buffers, the last one and current one
+        self._pool = ChunkPool(max(depth, 2), size)
+        # bounded by pool
+        self._queue = queue.Queue()
+        self._current = None
+        self._pos = 0
+        self._used = []
+        self._eof = False
+        self._closed = False
+        self.error = None
+        self.stats = stats or TransferStats('read')
+        self.start()
+
+    def run(self):
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(self._file.fileno(), self._file.tell(), 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+            while not self._closed:
+                chunk = self._pool.acquire()
+                if self._closed:
+                    chunk.release()
+                    break
+                with self.stats.stage('read'):
+                    size = self._file.readinto(chunk.buff)
+                self.stats.count('readinto')
+                if not size:
+                    chunk.release()
+                    break
+                chunk.size = size
+                self._queue.put(chunk)
+                if size < len(chunk.buff):
+                    # end of file, don't wait for a free buffer to find it
+                    break
+        except Exception as err:
+            logger.debug('%s: %s' % (self.name, err))
+            self.error = err
+        finally:
+            self._queue.put(None)
+
+    def read(self, size):
+        """ChunkView of at most SIZE bytes, b'' at end of file"""
+        while self._current is None or self._pos >= len(self._current):
+            if self._current is not None:
+                self._used.append(self._current)
+                self._current = None
+            if self._eof:
+                return b''
+            with self.stats.stage('stall'):
+                chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+                if self.error:
+                    raise self.error
+                return b''
+            self._current = chunk
+            self._pos = 0
+        view = ChunkView(self._current, self._pos, min(self._pos + size, len(self._current)))
+        self._pos = view.stop
+        return view
+
+    def recycle(self):
+        """data of read() is sent, reuse its buffers"""
+        for chunk in self._used:
+            chunk.release()
+        self._used = []
+
+    def close(self):
+        """stop reading, file may be closed after it"""
+        self._closed = True
+        self.recycle()
+        if self._current is not None:
+            self._current.release()
+            self._current = None
+        while not self._eof:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                chunk.release()
+        self.join()
+
+
+HASH_ALGORITHMS = ['md5', 'sha256', 'blake2b', 'none']
+
+
+class InlineHasher(object):
+    """hash in the calling thread, for data which can't be kept such as receive buffer"""
+    def __init__(self, algorithm, stats=None):
+        self._algorithm = algorithm
+        self._hash = None
+        self.stats = stats or TransferStats(algorithm)
+
+    def update(self, data):
+        if self._hash is None:
+            self._hash = hashlib.new(self._algorithm)
+        if isinstance(data, FileRange):
+            with self.stats.stage('read'):
+                data = data.read()
+            self.stats.count('pread')
+        elif isinstance(data, (Chunk, ChunkView)):
+            data = data.view
+        with self.stats.stage('hash'):
+            self._hash.update(data)
+
+    def hexdigest(self):
+        """digest of current file, next update() starts a new file"""
+        digest = (self._hash or hashlib.new(self._algorithm)).hexdigest()
+        self._hash = None
+        return digest
+
+    def close(self):
+        pass
+
+
+class Hasher(Stage):
+    """hash on its own thread, hashlib releases GIL for large data.
+
+    item: bytes, Chunk, ChunkView, FileRange or queue to return digest
+    """
+    def __init__(self, algorithm, maxsize=0, stats=None):
+        super().__init__('Ndrop hasher', maxsize, stats)
+        self._hasher = InlineHasher(algorithm, self.stats)
+
+    def update(self, data):
+        if isinstance(data, (Chunk, ChunkView)):
+            data.retain()
+        try:
+            self.put(data)
+        except Exception:
+            if isinstance(data, (Chunk, ChunkView)):
+                data.release()
+            raise
+
+    def hexdigest(self):
+        """wait for queued data of current file"""
+        result = queue.Queue(1)
+        self.put(result)
+        with self.stats.stage('stall'):
+            digest = result.get()
+        if self.error:
+            raise self.error
+        return digest
+
+    def handle(self, item):
+        if isinstance(item, queue.Queue):
+            item.put(self._hasher.hexdigest())
+        elif isinstance(item, (Chunk, ChunkView)):
+            self._hasher.update(item.view)
+        else:
+            self._hasher.update(item)
+
+    def done(self, item):
+        if isinstance(item, (Chunk, ChunkView)):
+            item.release()
+        elif isinstance(item, queue.Queue) and self.error:
+            item.put(None)
+
+
+def create_hasher(algorithm, threaded=True, maxsize=16, stats=None):
+    if not algorithm or algorithm == 'none':
+        return None
+    if threaded:
+        return Hasher(algorithm, maxsize, stats)
+    return InlineHasher(algorithm, stats)
+
+
+class FanOut(threading.Thread):
+    """read files once on its own thread for several senders
+
+    files are read one after another into DEPTH reused buffers, every sender
+    gets the same ChunkView of every file from its FanOutReader. a buffer is
+    reused when all senders have sent its data, so the fastest sender is at
+    most DEPTH buffers ahead of the slowest one. sender which fails is detached.
+    files: [(path, name, size)], data of files larger than 0 is read, as many as SIZE.
+    on_file(name, digest): called when file is read, digest is None without HASHER
+    stats: TransferStats, reading is 'read', waiting for slowest sender is 'stall'
+    """
+    def __init__(self, files, count, depth, size=READ_AHEAD_SIZE, hasher=None, on_file=None, stats=None):
+        super().__init__(name='Ndrop fan-out', daemon=True)
+        self._files = files
+        # a sender keeps data of the last yield, in two buffers, and reads the next one
+        self._pool = ChunkPool(max(depth, 4), size)
+        self._hasher = hasher
+        self._on_file = on_file
+        self._lock = threading.Lock()
+        self.readers = [FanOutReader(self) for _ in range(count)]
+        self.error = None
+        self.stats = stats or TransferStats('read')
+
+    def active(self):
+        return any(not reader.detached for reader in self.readers)
+
+    def publish(self, item):
+        """pass ChunkView, None at end of file or error to every attached reader"""
+        with self._lock:
+            for reader in self.readers:
+                if not reader.detached:
+                    if isinstance(item, ChunkView):
+                        item.retain()
+                    reader.queue.put(item)
+
+    def detach(self, reader):
+        with self._lock:
+            reader.detached = True
+        while True:
+            try:
+                item = reader.queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, ChunkView):
+                item.release()
+        # wake up read() or close() waiting for data
+        reader.queue.put(None)
+
+    def run(self):
+        chunk = None
+        fill = 0
+        try:
+            for path, name, size in self._files:
+                if size <= 0:
+                    continue
+                if not self.active():
+                    break
+                with open(path, 'rb') as f:
+                    if hasattr(os, 'posix_fadvise'):
+                        try:
+                            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                        except OSError:
+                            pass
+                    left = size
+                    while left > 0 and self.active():
+                        if chunk is None or fill == len(chunk.buff):
+                            # small files share a buffer
+                            if chunk is not None:
+                                chunk.release()
+                                chunk = None
+                            with self.stats.stage('stall'):
+                                chunk = self._pool.acquire()
+                            fill = 0
+                        with self.stats.stage('read'):
+                            n = f.readinto(memoryview(chunk.buff)[fill:fill + min(left, len(chunk.buff) - fill)])
+                        self.stats.count('readinto')
+                        if not n:
+                            break
+                        data = ChunkView(chunk, fill, fill + n)
+                        fill += n
+                        chunk.size = fill
+                        left -= n
+                        if self._hasher:
+                            self._hasher.update(data)
+                        self.publish(data)
+                self.publish(None)
+                digest = self._hasher.hexdigest() if self._hasher else None
+                if self._on_file:
+                    self._on_file(name, digest)
+        except Exception as err:
+            logger.debug('%s: %s' % (self.name, err))
+            self.error = err
+            self.publish(err)
+        finally:
+            if chunk is not None:
+                chunk.release()
+
+
+class FanOutReader(object):
+    """data of FanOut for one sender, read(), recycle() and close() as ReadAhead
+
+    close() skips rest of current file, next read() is from next file. data
+    of read() is valid until recycle() or detach(), also after close().
+    """
+    def __init__(self, fanout):
+        self._fanout = fanout
+        self.queue = queue.Queue()
+        self.detached = False
+        self._current = None
+        self._pos = 0
+        self._used = []
+        self._eof = False
+
+    def read(self, size):
+        """ChunkView of at most SIZE bytes, b'' at end of file"""
+        while self._current is None or self._pos >= len(self._current):
+            if self._current is not None:
+                self._used.append(self._current)
+                self._current = None
+            if self._eof:
+                return b''
+            with self._fanout.stats.stage('stall'):
+                item = self.queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if item is None:
+                self._eof = True
+                return b''
+            self._current = item
+            self._pos = 0
+        view = self._current[self._pos:self._pos + size]
+        self._pos += len(view)
+        return view
+
+    def recycle(self):
+        """data of read() is sent, reuse its buffers"""
+        for data in self._used:
+            data.release()
+        self._used = []
+
+    def close(self):
+        """end of current file, its data may still wait for sending"""
+        if self._current is not None:
+            self._used.append(self._current)
+            self._current = None
+        while not self._eof and not self.detached:
+            item = self.queue.get()
+            if isinstance(item, ChunkView):
+                item.release()
+            else:
+                self._eof = True
+        self._eof = False
+
+    def detach(self):
+        """sender is finished or failed, don't keep buffers for it"""
+        if self._current is not None:
+            self._used.append(self._current)
+            self._current = None
+        self.recycle()
+        self._fanout.detach(self)
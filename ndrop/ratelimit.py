@@ -0,0 +1,111 @@
+import time
+import threading
+import logging
+
+from .transport import human_size
+
+
+logger = logging.getLogger(__name__)
+
+# seconds of data at the rate which may go at once after being idle
+BURST_TIME = 0.1
+# bytes per second of all transfers of a direction ('send', 'recv'), 0 is unlimited
+TOTAL_RATE = {'send': 0, 'recv': 0}
+_total_buckets = {}
+_total_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """RATE bytes per second, shared by threads
+
+    take() pays for data which is sent or received. the bucket may go into
+    debt, so a chunk larger than the bucket isn't split, the caller sleeps
+    until the debt is paid by the rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate * BURST_TIME), 1)
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        """return seconds to sleep for SIZE bytes"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= size
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+class RateLimit(object):
+    """limit of one transfer and the total limit of its direction
+
+    rate: bytes per second of this transfer, 0 is only the total limit
+    """
+    def __init__(self, direction, rate=0):
+        self.direction = direction
+        self.rate = rate
+        self._buckets = []
+        if rate:
+            self._buckets.append(TokenBucket(rate))
+        total = total_bucket(direction)
+        if total:
+            self._buckets.append(total)
+
+    def __bool__(self):
+        return bool(self._buckets)
+
+    def cap(self):
+        """bytes per second this transfer may reach, 0 is unlimited"""
+        rates = [bucket.rate for bucket in self._buckets]
+        return min(rates) if rates else 0
+
+    def delay(self, size):
+        """pay for SIZE bytes, return seconds until they fit in the limits"""
+        return max(bucket.take(size) for bucket in self._buckets)
+
+    def wait(self, size, stats=None):
+        """sleep until SIZE bytes fit in the limits, stats: time is 'limit'"""
+        delay = self.delay(size)
+        if delay > 0:
+            if stats:
+                with stats.stage('limit'):
+                    time.sleep(delay)
+            else:
+                time.sleep(delay)
+
+
+def set_total_rate(direction, rate):
+    """bytes per second shared by all following transfers of DIRECTION, 0 is unlimited"""
+    with _total_lock:
+        TOTAL_RATE[direction] = rate
+        _total_buckets.pop(direction, None)
+    logger.debug('TOTAL_RATE %s: %s' % (direction, rate))
+
+
+def total_bucket(direction):
+    with _total_lock:
+        rate = TOTAL_RATE.get(direction)
+        if not rate:
+            return
+        bucket = _total_buckets.get(direction)
+        if bucket is None:
+            bucket = _total_buckets[direction] = TokenBucket(rate)
+        return bucket
+
+
+def create_limit(direction, rate=0):
+    """RateLimit of a transfer, None if it has no limit"""
+    limit = RateLimit(direction, rate)
+    return limit if limit else None
+
+
+def format_cap(limit):
+    """text of configured cap for progress, '' if LIMIT is None"""
+    if not limit:
+        return ''
+    return '<= %s/s' % human_size(limit.cap())
@@ -0,0 +1,152 @@
+import os
+import logging
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# directories listed at the same time, os.scandir and stat release GIL
+SCAN_THREADS = 8
+# one transfer of files sent by several connections, at most BATCH_FILES entries
+# and BATCH_SIZE bytes, it gets smaller when less is left to send
+BATCH_FILES = 1000
+BATCH_SIZE = 64 * 1024 * 1024
+BATCH_MIN_SIZE = 1024 * 1024
+
+
+def scan_dir(path):
+    """return (dirs, files) of one directory
+
+    dirs: [(name, is_symlink)], files: [(name, size)].
+    like os.walk, directory which can't be listed is empty.
+    """
+    dirs = []
+    files = []
+    try:
+        it = os.scandir(path)
+    except OSError as err:
+        logger.debug('%s' % err)
+        return dirs, files
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append((entry.name, entry.is_symlink()))
+            else:
+                files.append((entry.name, entry.stat().st_size))
+    return dirs, files
+
+
+class Manifest(object):
+    """files to send, iterated as (abs_path, rel_path, size), size of directory is -1.
+
+    entries of one directory are kept together: paths of the directory once,
+    names in one string and sizes in an array, so memory grows with count
+    of directories, not with Python objects of every file.
+    """
+    def __init__(self):
+        # (abs_path, rel_path, names joined by NUL)
+        self._dirs = []
+        self._sizes = array('q')
+        self.total_size = 0
+
+    def add(self, root, rel_root, entries):
+        """entries: [(name, size)] in ROOT, name '' is ROOT itself"""
+        if not entries:
+            return
+        self._dirs.append((root, rel_root, '\0'.join(name for name, size in entries)))
+        for name, size in entries:
+            self._sizes.append(size)
+            if size > 0:
+                self.total_size += size
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __iter__(self):
+        index = 0
+        for root, rel_root, names in self._dirs:
+            for name in names.split('\0'):
+                size = self._sizes[index]
+                index += 1
+                if name:
+                    yield os.path.join(root, name), os.path.join(rel_root, name), size
+                else:
+                    yield root, rel_root, size
+
+
+def scan_files(paths, threads=SCAN_THREADS):
+    """return (total_size, Manifest) to send
+
+    rel_path is relative to parent of every path. order is the same as
+    os.walk, directories are listed in parallel by a thread pool.
+    """
+    manifest = Manifest()
+    with ThreadPoolExecutor(max(threads, 1), thread_name_prefix='Ndrop scan') as pool:
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            rel_path = os.path.relpath(abs_path, os.path.dirname(abs_path))
+            if not os.path.isdir(abs_path):
+                manifest.add(abs_path, rel_path, [('', os.path.getsize(abs_path))])
+                continue
+            manifest.add(abs_path, rel_path, [('', -1)])
+            # depth first as os.walk, sub directories are listed before they are reached
+            stack = [(abs_path, rel_path, pool.submit(scan_dir, abs_path))]
+            while stack:
+                root, rel_root, future = stack.pop()
+                dirs, files = future.result()
+                sub_dirs = []
+                for name, is_symlink in dirs:
+                    # symlink to directory is sent as empty directory
+                    if not is_symlink:
+                        sub_abs_path = os.path.join(root, name)
+                        sub_dirs.append((
+                            sub_abs_path, os.path.join(rel_root, name), pool.submit(scan_dir, sub_abs_path)))
+                manifest.add(root, rel_root, [(name, -1) for name, is_symlink in dirs] + files)
+                stack.extend(reversed(sub_dirs))
+    return manifest.total_size, manifest
+
+
+def split_batches(files, total_size, count):
+    """yield lists of (abs_path, rel_path, size) from FILES, each one is sent as a transfer
+
+    lazy, batch is made when a connection asks for it. it is up to 1/(2*COUNT)
+    of data left, so connections finish at about the same time, and file
+    larger than that is sent alone. parent directories of files are repeated
+    at begin of batch, receiver creates them before files.
+    """
+    dirs = {}   # rel_path: abs_path of directory
+    batch = []
+    batch_dirs = set()
+    batch_size = 0
+    left = total_size
+    limit = 0
+    for abs_path, rel_path, size in files:
+        if not batch:
+            limit = min(BATCH_SIZE, max(left // (count * 2), BATCH_MIN_SIZE))
+        elif batch_size + max(size, 0) > limit or len(batch) >= BATCH_FILES:
+            yield batch
+            left -= batch_size
+            batch = []
+            batch_dirs = set()
+            batch_size = 0
+            limit = min(BATCH_SIZE, max(left // (count * 2), BATCH_MIN_SIZE))
+        parents = []
+        parent = os.path.dirname(rel_path)
+        while parent in dirs and parent not in batch_dirs:
+            parents.append((dirs[parent], parent, -1))
+            batch_dirs.add(parent)
+            parent = os.path.dirname(parent)
+        batch.extend(reversed(parents))
+        if size < 0:
+            dirs[rel_path] = abs_path
+            batch_dirs.add(rel_path)
+        else:
+            batch_size += size
+        batch.append((abs_path, rel_path, size))
+    if batch:
+        yield batch
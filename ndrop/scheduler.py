@@ -0,0 +1,157 @@
+import itertools
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# transfers running at the same time, of all peers and of one peer, 0 is unlimited
+MAX_ACTIVE = 4
+MAX_PER_PEER = 1
+
+QUEUED = 'queued'
+ACTIVE = 'active'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class TransferJob(object):
+    """files queued for one or several peers
+
+    run: function doing the transfer in a thread of scheduler, it returns
+        result of transfer, 'done' for success
+    cancel: function interrupting run from other thread
+    priority: higher one starts first
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, peers, name, run, cancel=None, priority=0):
+        self.id = next(self._ids)
+        self.peers = tuple(peers)
+        self.name = name
+        self.priority = priority
+        self.state = QUEUED
+        self.result = None
+        self.cancelled = False
+        self._run = run
+        self._cancel = cancel
+
+    def __str__(self):
+        return '#%s %s => %s' % (self.id, self.name, ', '.join(self.peers))
+
+
+class TransferScheduler(object):
+    """run queued transfers, up to MAX_ACTIVE at once and MAX_PER_PEER to one peer
+
+    jobs of higher priority start first, others in order of submit. a job
+    whose peer is busy doesn't hold back jobs of other peers.
+    on_change: called from any thread when a job is queued, starts or ends
+    """
+    def __init__(self, max_active=MAX_ACTIVE, max_per_peer=MAX_PER_PEER, on_change=None):
+        self.max_active = max_active
+        self.max_per_peer = max_per_peer
+        self.on_change = on_change
+        self._queued = []
+        self._active = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _order(job):
+        return (-job.priority, job.id)
+
+    def submit(self, peers, name, run, cancel=None, priority=0):
+        """queue a transfer to PEERS, return its TransferJob"""
+        job = TransferJob(peers, name, run, cancel, priority)
+        with self._lock:
+            self._queued.append(job)
+        logger.debug('queue %s' % job)
+        self.schedule()
+        return job
+
+    def jobs(self):
+        """active jobs, then queued ones in the order they start"""
+        with self._lock:
+            return list(self._active) + sorted(self._queued, key=self._order)
+
+    def set_limits(self, max_active, max_per_peer):
+        with self._lock:
+            self.max_active = max_active
+            self.max_per_peer = max_per_peer
+        self.schedule()
+
+    def set_priority(self, job, priority):
+        """reorder a queued job, it has no effect when job has started"""
+        with self._lock:
+            if job.state != QUEUED:
+                return
+            job.priority = priority
+        self.schedule()
+
+    def cancel(self, job):
+        """drop a queued job, or interrupt an active one"""
+        cancel = None
+        with self._lock:
+            if job.state == QUEUED:
+                self._queued.remove(job)
+                job.state = CANCELLED
+                job.cancelled = True
+            elif job.state == ACTIVE and not job.cancelled:
+                job.cancelled = True
+                cancel = job._cancel
+            else:
+                return
+        logger.info('cancel %s' % job)
+        if cancel:
+            cancel()
+        self.changed()
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def _peer_busy(self, job):
+        """one of peers of JOB has MAX_PER_PEER active jobs"""
+        if not self.max_per_peer:
+            return False
+        for peer in job.peers:
+            if sum(1 for active in self._active if peer in active.peers) >= self.max_per_peer:
+                return True
+        return False
+
+    def schedule(self):
+        """start queued jobs which fit in the limits"""
+        started = []
+        with self._lock:
+            for job in sorted(self._queued, key=self._order):
+                if self.max_active and len(self._active) >= self.max_active:
+                    break
+                if self._peer_busy(job):
+                    continue
+                self._queued.remove(job)
+                job.state = ACTIVE
+                self._active.append(job)
+                started.append(job)
+        for job in started:
+            threading.Thread(
+                name='Ndrop job %s' % job.id, target=self._run_job, args=(job, ), daemon=True,
+            ).start()
+        self.changed()
+
+    def _run_job(self, job):
+        try:
+            result = job._run()
+        except Exception as err:
+            logger.error('%s: %s' % (job, err))
+            result = err
+        with self._lock:
+            self._active.remove(job)
+            job.result = result
+            if job.cancelled:
+                job.state = CANCELLED
+            elif '%s' % result == 'done':
+                job.state = DONE
+            else:
+                job.state = FAILED
+        logger.debug('%s - %s' % (job, job.state))
+        self.schedule()
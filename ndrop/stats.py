@@ -0,0 +1,170 @@
+import time
+import json
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_write_lock = threading.Lock()
+
+
+class _StageTimer(object):
+    __slots__ = ('stats', 'name')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.leave()
+
+
+class TransferStats(object):
+    """timers and counters of one transfer
+
+    stages: seconds spent in every stage. stages of one thread nest, time of
+    inner stage isn't counted by outer stage, such as 'write' in 'parse'.
+    disk writer and hasher threads add their own time in parallel.
+    stall: waiting for full queue of writer or hasher
+    limit: sleeping for bandwidth limit of transfer
+    calls: I/O calls, such as recv_into, send, sendfile, read, write
+    codec: compression of file data, plain is its size before compression
+    and packed on the wire, bytes counts the whole connection
+    copied: data of delta transfer which receiver copies from its basis file
+    skipped: size of files which aren't sent, receiver has the same
+    chunk: size of data chunks sent by a connection, the largest one of
+    connections, which is tuned by throughput with auto chunk size
+    """
+    def __init__(self, direction, mode=None, peer=None):
+        self.direction = direction
+        self.mode = mode
+        self.peer = peer
+        self.start_time = time.time()
+        self.wall = None
+        self.result = None
+        self.bytes = 0
+        self.files = 0
+        self.codec = None
+        self.plain = 0
+        self.packed = 0
+        self.copied = 0
+        self.skipped = 0
+        self.chunk = 0
+        self.stages = {}
+        self.calls = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._timers = {}
+
+    def stage(self, name):
+        """with stats.stage('write'): ..."""
+        timer = self._timers.get(name)
+        if timer is None:
+            timer = self._timers[name] = _StageTimer(self, name)
+        return timer
+
+    def enter(self, name):
+        now = time.perf_counter()
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        elif stack:
+            # pause outer stage
+            outer = stack[-1]
+            self.add(outer[0], now - outer[1])
+        stack.append([name, now])
+
+    def leave(self):
+        now = time.perf_counter()
+        stack = self._local.stack
+        name, start = stack.pop()
+        self.add(name, now - start)
+        if stack:
+            stack[-1][1] = now
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + n
+
+    def merge(self, other):
+        """add bytes, files, stages and calls of OTHER, such as one connection of a transfer"""
+        record = other.as_dict()
+        with self._lock:
+            self.bytes += record['bytes']
+            self.files += record['files']
+            self.copied += record['copied']
+            self.skipped += record['skipped']
+            self.chunk = max(self.chunk, record['chunk'])
+            if record['compress']:
+                self.codec = self.codec or record['compress']['codec']
+                self.plain += record['compress']['plain']
+                self.packed += record['compress']['packed']
+            self.stages['stall'] = self.stages.get('stall', 0.0) + record['stall']
+            for name, seconds in record['stages'].items():
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+            for name, n in record['calls'].items():
+                self.calls[name] = self.calls.get(name, 0) + n
+
+    def finish(self, result):
+        if self.wall is None:
+            self.wall = time.perf_counter() - self._start
+            self.result = '%s' % result
+
+    def as_dict(self):
+        with self._lock:
+            stages = dict(self.stages)
+            calls = dict(self.calls)
+        wall = self.wall if self.wall is not None else time.perf_counter() - self._start
+        compress = None
+        if self.codec:
+            seconds = stages.get('compress', 0.0) + stages.get('decompress', 0.0)
+            compress = {
+                'codec': self.codec,
+                'plain': self.plain,
+                'packed': self.packed,
+                'ratio': self.plain / self.packed if self.packed else 0.0,
+                'speed': self.plain / seconds if seconds else 0.0,
+            }
+        return {
+            'direction': self.direction,
+            'mode': self.mode,
+            'peer': '%s:%s' % self.peer if isinstance(self.peer, tuple) else self.peer,
+            'start': self.start_time,
+            'wall': wall,
+            'result': self.result,
+            'bytes': self.bytes,
+            'files': self.files,
+            'compress': compress,
+            'copied': self.copied,
+            'skipped': self.skipped,
+            'chunk': self.chunk,
+            'stall': stages.pop('stall', 0.0),
+            'stages': stages,
+            'calls': calls,
+        }
+
+    def __str__(self):
+        record = self.as_dict()
+        stages = ', '.join('%s %.2fs' % item for item in sorted(record['stages'].items()))
+        text = 'wall %.2fs, stall %.2fs, %s' % (record['wall'], record['stall'], stages)
+        if record['compress']:
+            text += ', %(codec)s %(ratio).1fx' % record['compress']
+        return text
+
+
+def append_record(path, record):
+    """append one JSON line to PATH"""
+    line = json.dumps(record)
+    with _write_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
@@ -1,27 +1,116 @@
 
+import os
+import sys
+import ntpath
 import logging
 import socket
+import socketserver
+import threading
+import select
+import ssl
 import ipaddress
 import math
+import json
+import struct
+import hashlib
+import queue
+import uuid
+import time
 
 import ifaddr
 
+from .stats import TransferStats
+from .compress import FrameDecoder, choose_codec
+from .delta import Copy, Basis, signatures, DELTA_MIN_SIZE
+from .index import file_digest
+
 logger = logging.getLogger(__name__)
 
 
+# data of one send, every connection takes it when it starts, see ChunkTuner
 CHUNK_SIZE = 1024 * 64
+CHUNK_SIZE_MIN = 1024 * 4
+CHUNK_SIZE_MAX = 1024 * 1024 * 4
+# chunk size of connection is doubled while throughput rises
+AUTO_CHUNK_SIZE = False
+# seconds of sending with one chunk size before throughput is compared
+AUTO_CHUNK_INTERVAL = 0.05
+# larger chunk is kept if throughput rises by this ratio at least
+AUTO_CHUNK_GAIN = 1.05
+# SO_SNDBUF of sending and SO_RCVBUF of receiving sockets, 0 keeps kernel autotuning
+SOCKET_BUFFER_SIZE = 0
+RECV_BUFFER_SIZE = CHUNK_SIZE * 4
+# smaller files are cheaper to copy than to send with a syscall of their own
+SENDFILE_MIN_SIZE = CHUNK_SIZE
+SENDFILE_CHUNK_SIZE = CHUNK_SIZE * 16
+# buffers in one sendmsg
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# linux/tls.h
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
+# SSL_OP_ENABLE_KTLS of OpenSSL 3.0+, ssl module names it since python 3.12
+if hasattr(ssl, 'OP_ENABLE_KTLS'):
+    OP_ENABLE_KTLS = ssl.OP_ENABLE_KTLS
+elif ssl.OPENSSL_VERSION_INFO >= (3, 0):
+    OP_ENABLE_KTLS = 1 << 3
+else:
+    OP_ENABLE_KTLS = 0
 
+# ndrop extension, it precedes Dukto or NitroShare stream when both ends are ndrop.
+# as Dukto record count or NitroShare packet size it is negative, stock peer rejects it.
+EXT_MAGIC = b'ND\x00\xffRP\x00\xff'
+EXT_VERSION = 1
+EXT_MAX_SIZE = 1024 * 1024 * 64
+# slowest disk expected when hashing prefix of .part files, extends timeout
+HASH_RATE = 1024 * 1024 * 50
+# smaller files aren't split into ranges of parallel connections
+STRIPE_MIN_SIZE = 1024 * 1024 * 16
+# range boundary
+STRIPE_ALIGN = 1024 * 1024
+# seconds a TLS session of peer is kept for its next connection, 0 is a full handshake every time
+TLS_SESSION_IDLE = 300
 
-def set_chunk_size(size=None):
-    global CHUNK_SIZE
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sndbuf = s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
-    CHUNK_SIZE = min(sndbuf, CHUNK_SIZE)
+def set_chunk_size(size=None, auto=False):
+    """chunk size of connections, which start from SIZE and are tuned by throughput if AUTO"""
+    global CHUNK_SIZE, AUTO_CHUNK_SIZE
 
     if size:
-        CHUNK_SIZE = min(size, sndbuf)
-    logger.debug('CHUNK_SIZE: %s' % CHUNK_SIZE)
+        CHUNK_SIZE = max(CHUNK_SIZE_MIN, min(size, CHUNK_SIZE_MAX))
+    AUTO_CHUNK_SIZE = auto
+    logger.debug('CHUNK_SIZE: %s%s' % (CHUNK_SIZE, ', auto' if auto else ''))
+
+
+def set_socket_buffer_size(size):
+    """SO_SNDBUF and SO_RCVBUF of connections, 0 is kernel autotuning"""
+    global SOCKET_BUFFER_SIZE
+
+    SOCKET_BUFFER_SIZE = size
+    logger.debug('SOCKET_BUFFER_SIZE: %s' % SOCKET_BUFFER_SIZE)
+
+
+def set_socket_buffer(sock, option):
+    """set SO_SNDBUF or SO_RCVBUF of SOCK before it connects or listens
+
+    buffer set by hand isn't grown by kernel, the receive window of a
+    connection is scaled for SO_RCVBUF of listening socket.
+    """
+    if SOCKET_BUFFER_SIZE:
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+
+
+def set_recv_buffer_size(size):
+    """size of pooled receive buffers, one buffer per connection"""
+    global RECV_BUFFER_SIZE
+
+    RECV_BUFFER_SIZE = max(size, CHUNK_SIZE)
+    buffer_pool.clear()
+    logger.debug('RECV_BUFFER_SIZE: %s' % RECV_BUFFER_SIZE)
 
 
 def human_size(size):
@@ -34,6 +123,15 @@ def human_size(size):
     return "%s %s" % (s, unit[i])
 
 
+def parse_size(text):
+    """'64K', '1.5M', '1G' => bytes"""
+    text = text.strip().upper().rstrip('B')
+    units = 'KMGT'
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * 1024 ** (units.index(text[-1]) + 1))
+    return int(text)
+
+
 def get_broadcast_address(ip_addr=None):
     ip_addrs = []
     broadcasts = []
@@ -59,13 +157,971 @@ def get_broadcast_address(ip_addr=None):
     return ip_addrs, broadcasts
 
 
+class FileRange(object):
+    """file data sent by os.sendfile, header is sent just before it"""
+    __slots__ = ('file', 'offset', 'count', 'header')
+
+    def __init__(self, file, offset, count, header=None):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.header = header
+
+    def __len__(self):
+        return self.count
+
+    def read(self):
+        return os.pread(self.file.fileno(), self.count, self.offset)
+
+
+class BufferList(list):
+    """headers and data sent together by vectored I/O, instead of copying into one buffer
+
+    limit: it is full with so many bytes, chunk size of connection
+    """
+    def __init__(self, limit=None):
+        super().__init__()
+        self.size = 0
+        self.limit = limit or CHUNK_SIZE
+
+    def append(self, data):
+        if data:
+            super().append(data)
+            self.size += len(data)
+
+    def full(self):
+        return self.size >= self.limit or len(self) >= IOV_MAX
+
+
+class ChunkTuner(object):
+    """chunk size of one connection, taken from its socket
+
+    chunk isn't larger than SO_SNDBUF of the connected socket, so one send
+    fits in kernel buffer. auto: chunk size is doubled after every interval
+    while throughput rises, up to CHUNK_SIZE_MAX and SO_SNDBUF, which kernel
+    grows as connection speeds up. it goes back to the last size when
+    throughput drops, and is kept from then on.
+    """
+    def __init__(self, sock=None, size=None, auto=None):
+        self._sock = sock
+        self.auto = AUTO_CHUNK_SIZE if auto is None else auto
+        self.size = min(size or CHUNK_SIZE, self.limit())
+        self._last_size = self.size
+        self._rate = 0
+        self._start = None
+        self._bytes = 0
+
+    def limit(self):
+        """largest chunk size of connection"""
+        if self._sock is None:
+            return CHUNK_SIZE_MAX
+        try:
+            sndbuf = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        except OSError:
+            return CHUNK_SIZE_MAX
+        return max(CHUNK_SIZE_MIN, min(sndbuf, CHUNK_SIZE_MAX))
+
+    def sent(self, size):
+        """SIZE bytes are sent, next chunks are larger if throughput rises"""
+        if not self.auto:
+            return
+        now = time.monotonic()
+        if self._start is None:
+            # first send is header and handshake of peer, not throughput
+            self._start = now
+            return
+        self._bytes += size
+        seconds = now - self._start
+        if seconds < AUTO_CHUNK_INTERVAL:
+            return
+        rate = self._bytes / seconds
+        self._start = now
+        self._bytes = 0
+        if self._rate and rate < self._rate * AUTO_CHUNK_GAIN:
+            if rate < self._rate:
+                self.size = self._last_size
+            self.auto = False
+            logger.debug('chunk size %s, %s/s' % (self.size, human_size(max(rate, self._rate))))
+            return
+        limit = self.limit()
+        if self.size >= limit:
+            self.auto = False
+            logger.debug('chunk size %s, %s/s' % (self.size, human_size(rate)))
+            return
+        self._rate = rate
+        self._last_size = self.size
+        self.size = min(self.size * 2, limit)
+
+
+def send_buffers(sock, buffers):
+    """sendall for list of buffers by socket.sendmsg, return count of calls"""
+    buffers = list(buffers)
+    start = 0
+    calls = 0
+    while start < len(buffers):
+        sent = sock.sendmsg(buffers[start:start + IOV_MAX])
+        calls += 1
+        while sent:
+            size = len(buffers[start])
+            if sent >= size:
+                sent -= size
+                start += 1
+            else:   # partial send, slice without copy
+                buffers[start] = memoryview(buffers[start])[sent:]
+                sent = 0
+    return calls
+
+
+def create_ssl_context(server_side, cert=None, key=None):
+    """TLS context, ask OpenSSL to offload encryption to kernel (kTLS) if it can"""
+    if server_side:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, keyfile=key)
+    else:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    # OpenSSL built with ktls, linux "tls" module, tls_mode() tells whether a connection has it
+    if OP_ENABLE_KTLS:
+        context.options |= OP_ENABLE_KTLS
+    else:
+        logger.debug('kTLS unavailable: %s, TLS is done in user space' % ssl.OPENSSL_VERSION)
+    return context
+
+
+class TLSSessionCache(object):
+    """one TLS context of all client connections, and last session of every peer
+
+    next connection to the peer resumes its session, abbreviated handshake
+    skips certificate and key exchange. session unused for IDLE seconds is dropped.
+    """
+    def __init__(self, idle=TLS_SESSION_IDLE):
+        self.idle = idle
+        self._context = None
+        # {address: (session, last used)}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def evict(self, now):
+        for address, (session, used) in list(self._sessions.items()):
+            if now - used > self.idle:
+                del self._sessions[address]
+
+    def wrap_socket(self, sock, address):
+        """client TLS socket of SOCK, which connects to ADDRESS"""
+        # Finished of resumed handshake and first data are small writes before
+        # any reply, Nagle would hold the data until delayed ACK of peer
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self.idle:
+            return create_ssl_context(False).wrap_socket(sock, server_side=False)
+        context = self.context()
+        with self._lock:
+            self.evict(time.monotonic())
+            session = self._sessions.get(address, (None, 0))[0]
+        return context.wrap_socket(sock, server_side=False, session=session)
+
+    def context(self):
+        """client TLS context shared by connections"""
+        with self._lock:
+            if self._context is None:
+                self._context = create_ssl_context(False)
+            return self._context
+
+    def close(self, sock, address):
+        """close SOCK, keep its TLS session for next connection to ADDRESS"""
+        session = getattr(sock, 'session', None)
+        # TLS 1.3 ticket comes after handshake, it is there once data is received
+        if self.idle and session is not None and session.has_ticket:
+            with self._lock:
+                self._sessions[address] = (session, time.monotonic())
+        sock.close()
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+tls_sessions = TLSSessionCache()
+
+
+def ktls_status(sock):
+    """return (tx, rx) whether kernel TLS is enabled on connected socket"""
+    status = []
+    for direction in (TLS_TX, TLS_RX):
+        try:
+            sock.getsockopt(SOL_TLS, direction, 64)
+            status.append(True)
+        except OSError:
+            status.append(False)
+    return tuple(status)
+
+
+def tls_mode(sock):
+    """describe encryption of socket for log"""
+    if not isinstance(sock, ssl.SSLSocket):
+        return 'plaintext'
+    tx, rx = ktls_status(sock)
+    if tx and rx:
+        return 'TLS, kernel offload (kTLS)'
+    elif tx:
+        return 'TLS, kernel offload (kTLS) to send'
+    elif rx:
+        return 'TLS, kernel offload (kTLS) to receive'
+    return 'TLS, user space'
+
+
+def can_sendfile(sock):
+    """zero copy for plaintext socket, or TLS socket encrypted by kernel"""
+    if not hasattr(os, 'sendfile'):
+        return False
+    if isinstance(sock, ssl.SSLSocket):
+        return ktls_status(sock)[0]
+    return True
+
+
+def ktls_sendfile(sock, file, offset, count):
+    """os.sendfile to kTLS socket, kernel encrypts file data.
+
+    socket.sendfile() of SSLSocket always reads file in python.
+    """
+    timeout = sock.gettimeout()
+    total_sent = 0
+    while total_sent < count:
+        try:
+            sent = os.sendfile(sock.fileno(), file.fileno(), offset + total_sent, count - total_sent)
+        except BlockingIOError:
+            if not select.select([], [sock], [], timeout)[1]:
+                raise socket.timeout('timed out')
+            continue
+        if sent == 0:   # EOF
+            break
+        total_sent += sent
+    return total_sent
+
+
+def send_chunks(sock, chunks, stats=None, tuner=None, limit=None):
+    """send bytes and FileRange chunks from pack_files
+
+    stats: time of generating chunks is 'pack', of sending is 'socket'
+    tuner: ChunkTuner of pack_files, it measures throughput of sent chunks
+    limit: RateLimit of transfer, it sleeps after every chunk as 'limit'
+    """
+    stats = stats or TransferStats('send')
+    # header of SSLSocket is written through OpenSSL to kernel, no flags
+    tls = isinstance(sock, ssl.SSLSocket)
+    more = 0 if tls else getattr(socket, 'MSG_MORE', 0)
+    vectored = not tls and hasattr(sock, 'sendmsg')
+    chunks = iter(chunks)
+    while True:
+        with stats.stage('pack'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with stats.stage('socket'):
+            if isinstance(chunk, FileRange):
+                size = 0
+                if chunk.header:
+                    # hold header and send it with the file data
+                    sock.sendall(chunk.header, more)
+                    stats.count('send')
+                    stats.bytes += len(chunk.header)
+                    size = len(chunk.header)
+                if tls:
+                    # FileRange comes to TLS socket only when can_sendfile(), kernel encrypts it
+                    sent = ktls_sendfile(sock, chunk.file, chunk.offset, chunk.count)
+                else:
+                    sent = sock.sendfile(chunk.file, chunk.offset, chunk.count)
+                stats.count('sendfile')
+                stats.bytes += sent
+                size += sent
+                if sent != chunk.count:
+                    raise IOError('File Changed: [%s] %s => %s.' % (
+                        chunk.file.name, chunk.offset + chunk.count, chunk.offset + sent))
+            elif isinstance(chunk, BufferList):
+                if vectored:
+                    stats.count('sendmsg', send_buffers(sock, chunk))
+                else:
+                    # one copy, and one TLS record instead of one for every buffer
+                    sock.sendall(b''.join(chunk))
+                    stats.count('send')
+                stats.bytes += chunk.size
+                size = chunk.size
+            else:
+                sock.sendall(chunk)
+                stats.count('send')
+                stats.bytes += len(chunk)
+                size = len(chunk)
+        if limit:
+            limit.wait(size, stats)
+        if tuner:
+            tuner.sent(size)
+    if tuner:
+        stats.chunk = max(stats.chunk, tuner.size)
+
+
+def encode_chunks(chunks, encoder):
+    """frames of FrameEncoder from chunks of pack_files, FileRange is sent by os.sendfile in a raw frame"""
+    for chunk in chunks:
+        if isinstance(chunk, FileRange):
+            header = b''
+            if chunk.header:
+                header = encoder.raw_header(len(chunk.header)) + chunk.header
+            yield FileRange(chunk.file, chunk.offset, chunk.count, header + encoder.raw_header(len(chunk)))
+            continue
+        if isinstance(chunk, Copy):
+            yield encoder.copy_header(chunk)
+            continue
+        buffers = chunk if isinstance(chunk, BufferList) else [chunk]
+        if encoder.packing:
+            frame = encoder.compress(buffers)
+            if frame:
+                yield frame
+        else:
+            frames = BufferList()
+            frames.append(encoder.raw_header(sum(len(buff) for buff in buffers)))
+            for buff in buffers:
+                frames.append(buff)
+            yield frames
+    frame = encoder.flush()
+    if frame:
+        yield frame
+
+
+def wait_for_close(sock):
+    """read until peer closes connection
+
+    unread data such as TLS session ticket makes close() send RST, then
+    peer may lose the tail of transfer.
+    """
+    buff = bytearray(1024)
+    try:
+        while sock.recv_into(buff):
+            pass
+    except OSError:
+        pass
+
+
+class StreamBuffer(object):
+    """receive buffer consumed through a read cursor
+
+    bytes between the read and the write cursor are not parsed yet.
+    read() returns memoryview slices without copying, they are valid
+    until the next write into the buffer.
+    """
+    def __init__(self, size=None):
+        self._buff = bytearray(size or RECV_BUFFER_SIZE)
+        self._view = memoryview(self._buff)
+        self._rpos = 0
+        self._wpos = 0
+
+    def __len__(self):
+        return self._wpos - self._rpos
+
+    def reserve(self, size):
+        """return writable memoryview with room for SIZE bytes at least"""
+        if len(self._buff) - self._wpos < size:
+            self.compact(size)
+        return self._view[self._wpos:]
+
+    def commit(self, size):
+        self._wpos += size
+
+    def compact(self, size=0):
+        """move the unparsed tail to the front, grow if it is still too small"""
+        length = self._wpos - self._rpos
+        if length + size > len(self._buff):
+            buff = bytearray(max(len(self._buff) * 2, length + size))
+            buff[:length] = self._view[self._rpos:self._wpos]
+            self._buff = buff
+            self._view = memoryview(buff)
+        elif length > 0 and self._rpos > 0:
+            # only a partial frame header is left, it is short
+            self._view[:length] = self._view[self._rpos:self._wpos]
+        self._rpos = 0
+        self._wpos = length
+
+    def free_space(self):
+        """writable memoryview to receive into, half of buffer at least"""
+        return self.reserve(len(self._buff) // 2)
+
+    def recv_into(self, sock):
+        """receive from socket into free space of buffer without allocation"""
+        view = self.free_space()
+        size = sock.recv_into(view)
+        self._wpos += size
+        return size
+
+    def extend(self, data):
+        size = len(data)
+        self.reserve(size)[:size] = data
+        self._wpos += size
+
+    def peek(self, size):
+        return self._view[self._rpos:min(self._rpos + size, self._wpos)]
+
+    def read(self, size):
+        size = min(size, self._wpos - self._rpos)
+        view = self._view[self._rpos:self._rpos + size]
+        self._rpos += size
+        if self._rpos == self._wpos:
+            # nothing left, write from the beginning again
+            self._rpos = self._wpos = 0
+        return view
+
+    def find(self, sub):
+        pos = self._buff.find(sub, self._rpos, self._wpos)
+        return pos - self._rpos if pos >= 0 else pos
+
+    def clear(self):
+        self._rpos = self._wpos = 0
+
+
+class BufferPool(object):
+    """reuse preallocated receive buffers between connections"""
+    max_free = 16
+
+    def __init__(self):
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return StreamBuffer(RECV_BUFFER_SIZE)
+
+    def release(self, buff):
+        buff.clear()
+        with self._lock:
+            # drop buffer which has been grown by a long header
+            if len(buff._buff) == RECV_BUFFER_SIZE and len(self._free) < self.max_free:
+                self._free.append(buff)
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+
+buffer_pool = BufferPool()
+
+
+def local_name(name):
+    """file name of transfer to local path separator"""
+    if sys.platform == 'win32':
+        return name.replace('/', '\\')
+    return name.replace('\\', '/')
+
+
+def safe_name(name):
+    """local_name of a file name from peer, which stays in receive directory
+
+    absolute paths, drives and '..' would lead out of it, ValueError
+    """
+    if not isinstance(name, str) or not name or '\x00' in name or ntpath.splitdrive(name)[0]:
+        raise ValueError('Invalid file name: %r' % (name,))
+    parts = name.replace('\\', '/').split('/')
+    if parts[0] == '' or '..' in parts:
+        raise ValueError('Invalid file name: %r' % (name,))
+    return local_name(name)
+
+
+def prefix_digest(path, size):
+    """sha256 of first SIZE bytes of file"""
+    md = hashlib.sha256()
+    buff = bytearray(SENDFILE_CHUNK_SIZE)
+    view = memoryview(buff)
+    with open(path, 'rb') as f:
+        while size > 0:
+            n = f.readinto(view[:min(size, len(buff))])
+            if not n:
+                break
+            md.update(view[:n])
+            size -= n
+    return md.hexdigest()
+
+
+def hash_timeout(size):
+    return size / HASH_RATE
+
+
+def pack_ext(message):
+    data = json.dumps(message).encode('utf-8')
+    return EXT_MAGIC + struct.pack('<I', len(data)) + data
+
+
+def unpack_ext(data):
+    """message of ndrop extension from StreamBuffer, None to wait for more data"""
+    if len(data) < 12:
+        return
+    header = bytes(data.peek(12))
+    if header[:8] != EXT_MAGIC:
+        raise ValueError('Not ndrop extension')
+    size = struct.unpack('<I', header[8:])[0]
+    if size > EXT_MAX_SIZE:
+        raise ValueError('ndrop extension too large: %s' % size)
+    if len(data) < 12 + size:
+        return
+    data.read(12)
+    return json.loads(bytes(data.read(size)))
+
+
+def recv_ext(sock, data):
+    while True:
+        message = unpack_ext(data)
+        if message is not None:
+            return message
+        if not data.recv_into(sock):
+            raise ConnectionError('Connection closed')
+
+
+def split_ranges(start, size, count):
+    """split [start, size) into at most COUNT ranges [(begin, count)] aligned to STRIPE_ALIGN"""
+    count = max(1, min(count, (size - start) // STRIPE_ALIGN))
+    step = (size - start) // count // STRIPE_ALIGN * STRIPE_ALIGN
+    ranges = []
+    for i in range(count - 1):
+        ranges.append((start + i * step, step))
+    begin = start + (count - 1) * step
+    ranges.append((begin, size - begin))
+    return ranges
+
+
+def ext_offer(sock, files, timeout, resume=False, streams=1, compress=None, delta=False, check=False):
+    """ndrop extension before transfer
+
+    resume: ask ndrop receiver which files can be resumed
+    streams: connections of transfer, large files are split into ranges
+    compress: codecs which sender can use, receiver chooses one
+    delta: ask for signatures of files which receiver already has
+    check: ask for digests of files of the same size in receive directory
+    return (offsets, stripes, token, streams, codec, bases, skipped), None if peer
+    doesn't answer, it isn't ndrop and connection can't be used.
+    offsets: {name: offset}, data before offset isn't sent in this connection
+    stripes: [(path, name, begin, count)] sent by other connections with token
+    streams: connections accepted by receiver
+    codec: compression of this connection, None if receiver has none of COMPRESS
+    bases: {name: Basis}, only changed data of these files is sent
+    skipped: names of files which receiver has, they aren't sent
+    """
+    offer = [[name, size] for path, name, size in files if size > 0] if resume else []
+    delta = [[name, size] for path, name, size in files if size >= DELTA_MIN_SIZE] if delta else []
+    check = [[name, size] for path, name, size in files if size > 0] if check else []
+    sock.sendall(pack_ext({
+        'version': EXT_VERSION, 'offer': offer, 'streams': streams, 'compress': compress or [],
+        'delta': delta, 'check': check}))
+    data = StreamBuffer(CHUNK_SIZE)
+    try:
+        hello = recv_ext(sock, data)
+    except (OSError, ValueError) as err:
+        logger.debug('no ndrop extension: %s' % err)
+        return
+    # receiver hashes its .part files before answer
+    sock.settimeout(timeout + hash_timeout(hello['hashing']))
+    answer = recv_ext(sock, data)
+    # only files of the same size as one of receiver are hashed
+    digests = dict((size, set(values)) for size, values in answer.get('check', []))
+    skipped = {}
+    for path, name, size in files:
+        if size in digests:
+            digest = file_digest(path)
+            if digest in digests[size]:
+                skipped[name] = digest
+    wanted = set(name for name, offset, digest in answer['resume'] if name not in skipped)
+    paths = dict((name, (path, size)) for path, name, size in files if name in wanted)
+    offsets = {}
+    for name, offset, digest in answer['resume']:
+        path, size = paths.get(name, (None, 0))
+        if 0 < offset < size and prefix_digest(path, offset) == digest:
+            offsets[name] = offset
+    # resumed file goes on from its .part file
+    bases = dict((name, Basis(index, block, sums))
+                 for index, (name, block, sums) in enumerate(answer.get('delta', []))
+                 if name not in offsets and name not in skipped)
+    # older ndrop receives in one connection
+    streams = min(streams, hello.get('streams', 1))
+    codec = hello.get('compress')
+    if codec not in (compress or []):
+        codec = None
+    stripes = []
+    message = []
+    if streams > 1:
+        for path, name, size in files:
+            start = offsets.get(name, 0)
+            if size - start < STRIPE_MIN_SIZE or name in bases or name in skipped:
+                continue
+            # last range is sent in this connection, as resumed from its begin
+            ranges = split_ranges(start, size, streams)
+            if len(ranges) < 2:
+                continue
+            offsets[name] = ranges[-1][0]
+            stripes.extend((path, name, begin, count) for begin, count in ranges[:-1])
+            message.append([name, size, ranges[:-1]])
+    token = uuid.uuid4().hex
+    sock.sendall(pack_ext({
+        'accept': [[name, offset] for name, offset in offsets.items()],
+        'stripes': message,
+        'transfer': token,
+        'compress': codec,
+        'delta': bool(bases),
+        'skip': [[name, digest] for name, digest in skipped.items()],
+    }))
+    sock.settimeout(timeout)
+    return offsets, stripes, token, streams, codec, bases, set(skipped)
+
+
+def skip_files(agent, total_size, files, skipped):
+    """return (total_size, files) without SKIPPED names, which are passed to agent.send_same_file"""
+    left = []
+    for path, name, size in files:
+        if name in skipped:
+            total_size -= size
+            agent.send_same_file(name, size)
+        else:
+            left.append((path, name, size))
+    return total_size, left
+
+
+class StripeSender(object):
+    """send ranges of large files by STREAMS connections of their own,
+    beside the connection of transfer
+
+    connect: function returning a connected socket
+    limit: RateLimit of transfer, shared with its connection
+    """
+    def __init__(self, connect, token, stripes, streams, sendfile=True, stats=None, limit=None):
+        self._connect = connect
+        self._token = token
+        self._sendfile = sendfile
+        self._limit = limit
+        self.stats = stats or TransferStats('send')
+        self.error = None
+        self._stopped = False
+        self._queue = queue.Queue()
+        for stripe in stripes:
+            self._queue.put(stripe)
+        self._threads = []
+        for i in range(min(streams, len(stripes))):
+            thread = threading.Thread(target=self.run, name='Ndrop stream %s' % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self):
+        while self.error is None and not self._stopped:
+            try:
+                path, name, begin, count = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self.send_range(path, name, begin, count)
+            except Exception as err:
+                logger.debug('%s: %s' % (threading.current_thread().name, err))
+                self.error = err
+
+    def send_range(self, path, name, begin, count):
+        sock = self._connect()
+        try:
+            sock.sendall(pack_ext({'version': EXT_VERSION, 'range': [self._token, name, begin, count]}))
+            with open(path, 'rb') as f:
+                chunks = self.pack_range(f, begin, count, self._sendfile and can_sendfile(sock))
+                send_chunks(sock, chunks, self.stats, limit=self._limit)
+            # receiver closes when range is on disk
+            wait_for_close(sock)
+        finally:
+            sock.close()
+
+    def pack_range(self, f, begin, count, sendfile):
+        end = begin + count
+        while begin < end and self.error is None and not self._stopped:
+            chunk = FileRange(f, begin, min(SENDFILE_CHUNK_SIZE, end - begin))
+            begin += len(chunk)
+            if sendfile:
+                yield chunk
+            else:
+                with self.stats.stage('read'):
+                    data = chunk.read()
+                self.stats.count('pread')
+                if not data:
+                    raise IOError('File Changed: %s' % f.name)
+                yield data
+
+    def join(self):
+        """wait for all ranges, raise error of any connection"""
+        for thread in self._threads:
+            thread.join()
+        if self.error:
+            raise self.error
+
+    def stop(self):
+        """transfer fails, stop other connections after current chunk"""
+        self._stopped = True
+        for thread in self._threads:
+            thread.join()
+
+
+class RecvHandler(socketserver.BaseRequestHandler):
+    """receive a transfer with recv_into a pooled buffer and parse it"""
+    _name = None
+    _packet_class = None
+
+    def setup(self):
+        self._recv_buff = buffer_pool.acquire()
+        self._packet = self._packet_class()
+        # ndrop extension may come before transfer
+        self._ext = True
+        # range of striped file, instead of transfer
+        self._range = None
+        self._range_pos = 0
+        self._range_end = 0
+        # transfer in frames of compression or delta
+        self._decoder = None
+        # paths of files whose signatures are sent for delta
+        self._bases = []
+        # HashIndex of receive directory, digests of its files are sent for check
+        self._index = None
+
+    def handle(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            logger.info('[%s] connect from %s:%s - %s' % (
+                (self._name, ) + self.client_address + (tls_mode(self.request), )))
+        else:
+            logger.info('[%s] connect from %s:%s' % ((self._name, ) + self.client_address))
+        stats = self.server.agent.recv_start(self.client_address) or TransferStats('recv')
+        stats.mode = self._name.lower()
+        stats.peer = self.client_address
+        self.stats = stats
+        limit = self.server.agent.recv_limit(self.client_address)
+        err = ''
+        while True:
+            try:
+                with stats.stage('socket'):
+                    size = self._recv_buff.recv_into(self.request)
+                stats.count('recv_into')
+                stats.bytes += size
+                if not size:
+                    err = 'abort'
+                    break
+                if limit:
+                    # kernel buffer fills while sleeping, window of sender closes
+                    limit.wait(size, stats)
+                if self._ext and not self.unpack_ext():
+                    continue
+                if self._range:
+                    ret = self.feed_range()
+                else:
+                    ret = self.parse()
+                if ret:
+                    # data is on disk before reporting success
+                    self.server.agent.recv_flush(self.client_address)
+                    if not self._range:
+                        self.finish_transfer()
+                    err = 'done'
+                    break
+            except Exception as e:
+                err = e
+                logger.error('%s' % err)
+                if self._range:
+                    self._range.abort(err)
+                else:
+                    self.abort_transfer(err)
+                break
+        if self._range and err == 'abort':
+            self._range.abort(ConnectionError('Connection closed'))
+        self.server.agent.recv_finish(self.client_address, err)
+
+    def parse(self):
+        """parse received data, after decoding frames of compression or delta"""
+        if not self._decoder:
+            with self.stats.stage('parse'):
+                return self._packet.unpack_tcp(self.server.agent, self._recv_buff, self.client_address)
+        while True:
+            data = self._decoder.feed(self._recv_buff)
+            size = len(data)
+            with self.stats.stage('parse'):
+                ret = self._packet.unpack_tcp(self.server.agent, data, self.client_address)
+            # decoded data is limited, parser takes it before more is decoded
+            if ret or not self._decoder.pending():
+                return ret
+            if len(data) == size:
+                raise ValueError('Header is too long: %s' % size)
+
+    def unpack_ext(self):
+        """handle ndrop extension, return True when transfer begins"""
+        while self._ext:
+            head = bytes(self._recv_buff.peek(len(EXT_MAGIC)))
+            if not EXT_MAGIC.startswith(head):
+                self._ext = False
+            elif len(head) < len(EXT_MAGIC):
+                return False
+            else:
+                message = unpack_ext(self._recv_buff)
+                if message is None:
+                    return False
+                with self.stats.stage('resume'):
+                    self.handle_ext(message)
+        return len(self._recv_buff) > 0
+
+    def handle_ext(self, message):
+        """offer: [[name, size]], sender asks for .part files to resume, and
+            streams, count of connections it can use, compress, its codecs,
+            delta: [[name, size]], files whose signatures it asks for, and
+            check: [[name, size]], files to find in receive directory by digest
+        accept: [[name, offset]], sender skips OFFSET bytes of file
+        skip: [[name, digest]], files which aren't sent, receiver has the same
+        stripes: [[name, size, [[begin, count]]]], ranges of files sent by other
+            connections of transfer
+        compress, delta: codec of transfer and whether signatures are used, data
+            after accept is in frames of FrameEncoder
+        range: [transfer, name, begin, count], this connection sends a range
+        """
+        agent = self.server.agent
+        if 'offer' in message:
+            parts = []
+            for name, size in message['offer']:
+                path = agent.recv_part_file(safe_name(name), self.client_address)
+                if path and os.path.isfile(path):
+                    part_size = os.path.getsize(path)
+                    if 0 < part_size < size:
+                        parts.append((name, part_size, path))
+            self._bases = []
+            for name, size in message.get('delta', []):
+                path = agent.recv_basis_file(safe_name(name), self.client_address)
+                if path and os.path.isfile(path):
+                    self._bases.append((name, path))
+            check = message.get('check')
+            self._index = agent.recv_hash_index(self.client_address) if check else None
+            if not self._index:
+                check = []
+            hashing = sum(part_size for name, part_size, path in parts)
+            hashing += sum(os.path.getsize(path) for name, path in self._bases)
+            # receiver hashes its files of these sizes which aren't in index, then sender hashes its files
+            hashing += sum(size for name, size in check)
+            self.request.sendall(pack_ext({
+                'version': EXT_VERSION, 'hashing': hashing,
+                'streams': agent.recv_max_streams(self.client_address) or 1,
+                'compress': choose_codec(message.get('compress')),
+            }))
+            resume = [[name, part_size, prefix_digest(path, part_size)] for name, part_size, path in parts]
+            delta = [[name] + list(signatures(path)) for name, path in self._bases]
+            digests = self._index.candidates(size for name, size in check) if check else {}
+            self.request.sendall(pack_ext({
+                'resume': resume, 'delta': delta, 'check': [[size, values] for size, values in digests.items()]}))
+            # sender hashes the same files
+            self.request.settimeout(self.server.request_timeout + hash_timeout(hashing))
+        elif 'accept' in message:
+            if message.get('skip'):
+                if not self._index:
+                    raise ValueError('Files are not checked')
+                for name, digest in message['skip']:
+                    agent.recv_same_file(safe_name(name), digest, self.client_address)
+                logger.info('[%s] skip %s files which are here' % (self._name, len(message['skip'])))
+            if message.get('stripes'):
+                stripes = dict((safe_name(name), (size, ranges)) for name, size, ranges in message['stripes'])
+                agent.recv_stripes(message['transfer'], stripes, self.client_address)
+                logger.info('[%s] receive %s files by parallel connections' % (self._name, len(stripes)))
+            self._packet.resume = dict((safe_name(name), offset) for name, offset in message['accept'])
+            self.request.settimeout(self.server.request_timeout)
+            if self._packet.resume:
+                logger.info('[%s] resume %s files' % (self._name, len(self._packet.resume)))
+            if message.get('compress') or message.get('delta'):
+                self._decoder = FrameDecoder(
+                    message.get('compress'), StreamBuffer(), self.stats,
+                    bases=[path for name, path in self._bases])
+            if message.get('compress'):
+                logger.info('[%s] receive compressed by %s' % (self._name, message['compress']))
+            if message.get('delta'):
+                logger.info('[%s] receive changes of %s files' % (self._name, len(self._bases)))
+            self._ext = False
+        elif 'range' in message:
+            token, name, begin, count = message['range']
+            self._range = agent.recv_range(token, safe_name(name), begin, count, self.client_address)
+            if not self._range:
+                raise ValueError('Unknown range: %s %s+%s' % (name, begin, count))
+            self._range_pos = begin
+            self._range_end = begin + count
+            self._ext = False
+
+    def feed_range(self):
+        """write data of range connection, return True when range is complete"""
+        while len(self._recv_buff) > 0 and self._range_pos < self._range_end:
+            data = self._recv_buff.read(min(len(self._recv_buff), self._range_end - self._range_pos))
+            with self.stats.stage('write'):
+                self._range.write(self._range_pos, data)
+            self.stats.count('pwrite')
+            self._range_pos += len(data)
+        if self._range_pos < self._range_end:
+            return False
+        self._range.finish()
+        return True
+
+    def finish_transfer(self):
+        pass
+
+    def abort_transfer(self, err):
+        pass
+
+    def finish(self):
+        if self._decoder:
+            self._decoder.close()
+        buffer_pool.release(self._recv_buff)
+        self._recv_buff = None
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """serve every connection in its own thread
+
+    sessions: semaphore shared by all servers to limit concurrent connections
+    ssl_context: TLS handshake is done in the connection thread, not in accept
+    """
+    daemon_threads = True
+    request_timeout = 20
+
+    def __init__(self, server_address, RequestHandlerClass, sessions=None, ssl_context=None):
+        self.sessions = sessions
+        self.ssl_context = ssl_context
+        super().__init__(server_address, RequestHandlerClass)
+
+    def server_bind(self):
+        # accepted connections take receive buffer of listening socket
+        set_socket_buffer(self.socket, socket.SO_RCVBUF)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if self.sessions:
+            # wait for a free session. this connection is accepted and holds
+            # its socket meanwhile, accept loop stalls, so the next ones wait
+            # in backlog of listening socket and their senders are held back
+            self.sessions.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            if self.sessions:
+                self.sessions.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            request.settimeout(self.request_timeout)
+            if self.ssl_context:
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+            self.finish_request(request, client_address)
+        except Exception as err:
+            self.handle_error(request, client_address, err)
+        finally:
+            self.shutdown_request(request)
+            if self.sessions:
+                self.sessions.release()
+
+    def handle_error(self, request, client_address, err=None):
+        logger.error('%s:%s - %s' % (client_address[0], client_address[1], err))
+
+
 class Transport(object):
     _timeout = 5
 
     def send_text(self, text):
         pass
 
-    def send_files(self, total_size, files):
+    def send_files(self, total_size, files, stats=None, source=None, limit=None):
         pass
 
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
@@ -74,9 +1130,24 @@ class Transport(object):
     def send_finish_file(self, path):
         pass
 
+    def send_same_file(self, path, file_size):
+        """file isn't sent, receiver has the same"""
+        pass
+
     def send_finish(self, err=None):
         pass
 
+    def recv_start(self, from_addr):
+        """return TransferStats of connection"""
+        pass
+
+    def recv_limit(self, from_addr):
+        """RateLimit of connection, None if it isn't limited"""
+        pass
+
+    def recv_flush(self, from_addr):
+        pass
+
     def recv_finish(self, err=None):
         pass
 
@@ -85,3 +1156,33 @@ class Transport(object):
 
     def recv_finish_file(self, path, from_addr):
         pass
+
+    def recv_part_file(self, path, from_addr):
+        """local .part file of PATH, None if it can't be resumed"""
+        pass
+
+    def recv_basis_file(self, path, from_addr):
+        """local complete file of PATH, basis of delta transfer, None if there is none"""
+        pass
+
+    def recv_hash_index(self, from_addr):
+        """HashIndex of receive directory, None if files can't be checked"""
+        pass
+
+    def recv_same_file(self, path, digest, from_addr):
+        """put file of DIGEST in HashIndex at PATH, instead of receiving it"""
+        pass
+
+    def recv_max_streams(self, from_addr):
+        """connections which a transfer may use, 1 if files can't be split"""
+        return 1
+
+    def recv_stripes(self, token, stripes, from_addr):
+        """stripes: {path: (size, [[begin, count]])}, ranges of files received by
+        other connections with TOKEN, data behind last range is in this transfer
+        """
+        pass
+
+    def recv_range(self, token, path, begin, count, from_addr):
+        """return registered range of file, with write(pos, data), finish() and abort(err)"""
+        pass
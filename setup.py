@@ -45,5 +45,8 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     zip_safe=False,
 )
@@ -0,0 +1,126 @@
+import os
+import zlib
+import tempfile
+import unittest
+
+from ndrop.compress import FrameEncoder, FrameDecoder, CODECS, COPY_SIZE
+from ndrop.delta import Basis, Copy, signatures
+from ndrop.transport import StreamBuffer
+
+
+def decode(codec, wire, bases=None, step=64 * 1024):
+    """(decoded data, largest buffer of decoder) of WIRE received STEP bytes at a time"""
+    decoder = FrameDecoder(codec, StreamBuffer(), bases=bases)
+    buff = StreamBuffer()
+    out = bytearray()
+    largest = 0
+    for pos in range(0, len(wire), step):
+        buff.extend(wire[pos:pos + step])
+        while True:
+            data = decoder.feed(buff)
+            largest = max(largest, len(data))
+            out += data.read(len(data))
+            if not decoder.pending():
+                break
+        buff.compact()
+    decoder.close()
+    return bytes(out), largest
+
+
+class FrameTest(unittest.TestCase):
+    def round_trip(self, codec):
+        text = b'ndrop frame ' * 50000
+        noise = os.urandom(100000)
+        encoder = FrameEncoder(codec)
+        wire = encoder.compress([text[:1000], text[1000:]])
+        wire += encoder.raw_header(len(noise)) + noise
+        wire += encoder.compress([text]) + encoder.flush()
+        self.assertLess(len(wire), len(text) * 2)
+        for step in [1, 7, 64 * 1024]:
+            data, largest = decode(codec, wire, step=step)
+            self.assertEqual(data, text + noise + text)
+
+    def test_zlib(self):
+        self.round_trip('zlib')
+
+    @unittest.skipUnless('zstd' in CODECS, 'zstandard is not installed')
+    def test_zstd(self):
+        self.round_trip('zstd')
+
+    def test_raw(self):
+        encoder = FrameEncoder(None)
+        wire = encoder.raw_header(3) + b'abc' + encoder.raw_header(0) + encoder.raw_header(2) + b'de'
+        self.assertEqual(decode(None, wire, step=1)[0], b'abcde')
+
+    def test_bounded(self):
+        """a frame of zeros isn't decoded at once, parser drains it"""
+        for codec in CODECS:
+            encoder = FrameEncoder(codec)
+            wire = encoder.compress([bytes(1024 * 1024)] * 32) + encoder.flush()
+            data, largest = decode(codec, wire)
+            self.assertEqual(len(data), 32 * 1024 * 1024)
+            self.assertEqual(data.count(0), len(data))
+            self.assertLessEqual(largest, COPY_SIZE * 2, codec)
+
+    def test_unknown_frame(self):
+        buff = StreamBuffer()
+        buff.extend(b'\x09\x01\x00\x00\x00x')
+        with self.assertRaises(ValueError):
+            FrameDecoder(None, StreamBuffer()).feed(buff)
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.basis = os.path.join(self.tmp.name, 'basis')
+        self.new = os.path.join(self.tmp.name, 'new')
+        old = os.urandom(3 * 1024 * 1024)
+        # changed in the middle, and data moved by an insertion
+        self.data = old[:1000000] + os.urandom(5000) + old[1005000:2000000] + b'inserted' + old[2000000:]
+        with open(self.basis, 'wb') as f:
+            f.write(old)
+        with open(self.new, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def encode(self, codec):
+        basis = Basis(0, *signatures(self.basis))
+        encoder = FrameEncoder(codec)
+        wire = bytearray()
+        with open(self.new, 'rb') as f:
+            for item in basis.match(f, 0, len(self.data), 256 * 1024, 4 * 1024 * 1024):
+                if isinstance(item, Copy):
+                    wire += encoder.copy_header(item)
+                elif codec:
+                    wire += encoder.compress([item])
+                else:
+                    wire += encoder.raw_header(len(item)) + item
+        wire += encoder.flush()
+        return bytes(wire), encoder.stats
+
+    def test_round_trip(self):
+        for codec in [None] + CODECS:
+            wire, stats = self.encode(codec)
+            self.assertGreater(stats.copied, len(self.data) * 0.9, codec)
+            self.assertLess(len(wire), len(self.data) * 0.1, codec)
+            data, largest = decode(codec, wire, bases=[self.basis])
+            self.assertEqual(zlib.crc32(data), zlib.crc32(self.data), codec)
+            self.assertLessEqual(largest, COPY_SIZE * 2, codec)
+
+    def test_unknown_basis(self):
+        wire, stats = self.encode(None)
+        with self.assertRaises(ValueError):
+            decode(None, wire, bases=[])
+
+    def test_changed_basis(self):
+        wire, stats = self.encode(None)
+        with open(self.basis, 'r+b') as f:
+            f.truncate(1024 * 1024)
+        with self.assertRaises(IOError):
+            decode(None, wire, bases=[self.basis])
+
+
+if __name__ == '__main__':
+    unittest.main()
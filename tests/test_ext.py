@@ -0,0 +1,191 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ndrop.netdrop import NetDropServer
+from ndrop.index import file_digest
+from ndrop import transport
+from ndrop.compress import choose_codec
+from ndrop.transport import safe_name, pack_ext, unpack_ext, StreamBuffer, EXT_MAGIC, EXT_MAX_SIZE
+
+
+class SafeNameTest(unittest.TestCase):
+    def test_relative(self):
+        self.assertEqual(safe_name('dir/file.txt'), os.path.join('dir', 'file.txt'))
+        self.assertEqual(safe_name('dir\\file.txt'), os.path.join('dir', 'file.txt'))
+        self.assertEqual(safe_name('..file'), '..file')
+
+    def test_refused(self):
+        for name in ['', '/etc/passwd', '\\etc\\passwd', '../x', 'a/../../x', 'a\\..\\x',
+                     'C:/Windows', 'C:x', '\\\\server\\share\\x', 'a\x00b', None, 1]:
+            with self.assertRaises(ValueError, msg=name):
+                safe_name(name)
+
+
+class ExtMessageTest(unittest.TestCase):
+    def test_round_trip(self):
+        message = {'offer': [['dir/file', 10]], 'streams': 4, 'compress': ['zstd', 'zlib']}
+        wire = pack_ext(message) + pack_ext({'accept': []}) + b'data'
+        data = StreamBuffer()
+        # None until the whole message is received
+        for i in range(len(wire)):
+            data.extend(wire[i:i + 1])
+            answer = unpack_ext(data)
+            if answer is not None:
+                break
+        self.assertEqual(answer, message)
+        self.assertEqual(i + 1, len(pack_ext(message)))
+        data.extend(wire[i + 1:])
+        self.assertEqual(unpack_ext(data), {'accept': []})
+        self.assertEqual(bytes(data.read(len(data))), b'data')
+
+    def test_invalid(self):
+        data = StreamBuffer()
+        data.extend(b'X' * 12)
+        with self.assertRaises(ValueError):
+            unpack_ext(data)
+        data = StreamBuffer()
+        data.extend(EXT_MAGIC + struct.pack('<I', EXT_MAX_SIZE + 1))
+        with self.assertRaises(ValueError):
+            unpack_ext(data)
+
+    def test_choose_codec(self):
+        self.assertEqual(choose_codec(['lz4', 'zlib']), 'zlib')
+        self.assertIsNone(choose_codec(['lz4']))
+        self.assertIsNone(choose_codec(None))
+
+
+class ExtensionNameTest(unittest.TestCase):
+    """receiver refuses names of ndrop extension which lead out of its directory"""
+    engine = 'thread'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'drop')
+        outside = os.path.join(self.tmp.name, 'outside')
+        os.makedirs(outside)
+        with open(os.path.join(outside, 'secret'), 'wb') as f:
+            f.write(b's' * 100)
+        self.server = NetDropServer('127.0.0.1:0:0', mode='dukto', hash_algorithm='none', engine=self.engine)
+        self.server.saved_to(self.root)
+        with open(os.path.join(self.root, 'basis'), 'wb') as f:
+            f.write(b'b' * 10)
+        os.symlink(outside, os.path.join(self.root, 'link'))
+        self.tcp_server = self.server._transport[0]._tcp_server
+        self.start()
+
+    def tearDown(self):
+        self.stop()
+        self.tmp.cleanup()
+
+    def start(self):
+        threading.Thread(target=self.tcp_server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.tcp_server.shutdown()
+        self.tcp_server.server_close()
+        self.server._transport[0]._udp_server.server_close()
+
+    def offer(self, message):
+        """answer of receiver, None if it closes connection"""
+        with socket.create_connection(self.tcp_server.server_address, timeout=5) as sock:
+            sock.sendall(pack_ext(message))
+            return self.answer(sock, StreamBuffer())
+
+    def answer(self, sock, data):
+        while True:
+            message = unpack_ext(data)
+            if message is not None:
+                return message
+            try:
+                if not data.recv_into(sock):
+                    return None
+            except ConnectionResetError:
+                return None
+
+    def test_delta_basis(self):
+        answer = self.offer({'offer': [], 'delta': [['basis', 10]]})
+        self.assertEqual(answer['hashing'], 10)
+        for name in ['../outside/secret', os.path.join(self.tmp.name, 'outside', 'secret'), 'link/secret']:
+            self.assertIsNone(self.offer({'offer': [], 'delta': [[name, 100]]}), name)
+
+    def test_part_file(self):
+        with open(os.path.join(self.root, 'file' + '.part'), 'wb') as f:
+            f.write(b'p' * 10)
+        answer = self.offer({'offer': [['file', 20]]})
+        self.assertEqual(answer['hashing'], 10)
+        secret = os.path.join(self.tmp.name, 'outside', 'secret')
+        os.rename(secret, secret + '.part')
+        for name in ['../outside/secret', os.path.join(self.tmp.name, 'outside', 'secret'), 'link/secret']:
+            self.assertIsNone(self.offer({'offer': [[name, 200]]}), name)
+
+    def skip(self, name, digest):
+        """answer after receiver links file of DIGEST as NAME, None if it closes connection"""
+        with socket.create_connection(self.tcp_server.server_address, timeout=5) as sock:
+            sock.sendall(pack_ext({'offer': [], 'check': [['file', 10]]}))
+            data = StreamBuffer()
+            self.answer(sock, data)
+            self.answer(sock, data)
+            sock.sendall(pack_ext({'accept': [], 'skip': [[name, digest]]}))
+            # nothing is sent after accept, receiver closes connection when it fails
+            sock.settimeout(0.5)
+            try:
+                return self.answer(sock, data)
+            except socket.timeout:
+                return True
+
+    def test_same_file(self):
+        digest = file_digest(os.path.join(self.root, 'basis'))
+        self.assertTrue(self.skip('copy', digest))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'copy')))
+        for name in ['../outside/copy', os.path.join(self.tmp.name, 'outside', 'copy'), 'link/copy']:
+            self.assertIsNone(self.skip(name, digest), name)
+            self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'outside', 'copy')))
+
+    def test_stripes(self):
+        for name in ['../outside/striped', os.path.join(self.tmp.name, 'outside', 'striped'), 'link/striped']:
+            stripes = [[name, 200, [[0, 100], [100, 100]]]]
+            self.assertIsNone(self.offer({'accept': [], 'transfer': 'token', 'stripes': stripes}), name)
+        for name in ['../outside/striped', os.path.join(self.tmp.name, 'outside', 'striped')]:
+            self.assertIsNone(self.offer({'range': ['token', name, 100, 100]}), name)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, 'outside')), ['secret'])
+
+    def test_hello_before_hashing(self):
+        """sender extends its timeout by hello while receiver hashes .part files"""
+        with open(os.path.join(self.root, 'file.part'), 'wb') as f:
+            f.write(b'p' * 10)
+        hashed = threading.Event()
+
+        def prefix_digest(path, size):
+            # longer than timeout of sender
+            hashed.wait(10)
+            return digest(path, size)
+
+        digest = transport.prefix_digest
+        with mock.patch.object(transport, 'prefix_digest', prefix_digest):
+            with socket.create_connection(self.tcp_server.server_address, timeout=5) as sock:
+                sock.sendall(pack_ext({'offer': [['file', 20]]}))
+                data = StreamBuffer()
+                self.assertEqual(self.answer(sock, data)['hashing'], 10)
+                hashed.set()
+                self.assertEqual(self.answer(sock, data)['resume'][0][:2], ['file', 10])
+
+
+class AsyncExtensionNameTest(ExtensionNameTest):
+    engine = 'asyncio'
+
+    def start(self):
+        self.server._transport[0].start_servers()
+
+    def stop(self):
+        self.server._transport[0].stop_servers()
+        self.tcp_server.socket.close()
+        self.server._transport[0]._udp_server.socket.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
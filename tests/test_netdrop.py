@@ -0,0 +1,15 @@
+import unittest
+
+from ndrop.netdrop import parse_destination
+
+
+class ParseDestinationTest(unittest.TestCase):
+    def test_mode(self):
+        self.assertEqual(parse_destination('192.168.0.1'), (None, '192.168.0.1'))
+        self.assertEqual(parse_destination('192.168.0.1:4644', 'dukto'), ('dukto', '192.168.0.1:4644'))
+        self.assertEqual(parse_destination('nitroshare://192.168.0.1:40818', 'dukto'),
+                         ('nitroshare', '192.168.0.1:40818'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import threading
+import unittest
+
+from ndrop.pipeline import ChunkPool
+
+
+class ChunkPoolTest(unittest.TestCase):
+    def test_reuse(self):
+        pool = ChunkPool(2, 16)
+        chunk = pool.acquire(b'abc')
+        self.assertEqual(bytes(chunk.view), b'abc')
+        chunk.release()
+        self.assertIs(pool.acquire(b'de'), chunk)
+        self.assertEqual(bytes(chunk.view), b'de')
+        # larger data grows the buffer
+        chunk.fill(b'x' * 100)
+        self.assertEqual(len(chunk), 100)
+
+    def test_refs(self):
+        """chunk is free when every stage releases it"""
+        pool = ChunkPool(1, 16)
+        chunk = pool.acquire(b'abc')
+        chunk.retain()
+        chunk.retain()
+        self.assertEqual(chunk.refs, 3)
+        chunk.release()
+        chunk.release()
+        self.assertEqual(pool._free, [])
+        chunk.release()
+        self.assertEqual(pool._free, [chunk])
+
+    def test_backpressure(self):
+        """acquire blocks while all COUNT chunks are held"""
+        pool = ChunkPool(2, 16)
+        held = [pool.acquire(b'1'), pool.acquire(b'2')]
+        acquired = []
+        producer = threading.Thread(target=lambda: acquired.append(pool.acquire(b'3')), daemon=True)
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(acquired, [])
+        # retained chunk isn't free by one release
+        held[0].retain()
+        held[0].release()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+        held[0].release()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertIs(acquired[0], held[0])
+        self.assertEqual(bytes(acquired[0].view), b'3')
+        self.assertEqual(pool._created, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()